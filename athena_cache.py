@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import s3_urls
+
+# Splits sql into single quoted literals, double quoted identifiers and everything else so whitespace can be collapsed
+# without touching what's inside quotes.
+QUOTED = re.compile(r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")")
+
+
+def normalize_sql(sql):
+  parts = QUOTED.split(sql.strip().rstrip(';').strip())
+  return ''.join(part if i % 2 else re.sub(r'\s+', ' ', part) for i, part in enumerate(parts)).strip()
+
+
+def fingerprint(sql, database, data_version):
+  text = '\n'.join([normalize_sql(sql), database or '', data_version or ''])
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+# A data version token for everything under an s3 prefix, e.g. a table's LOCATION. It changes whenever an object is
+# added, removed or rewritten, which is what matters for deciding whether a cached result is still good.
+def s3_prefix_token(s3_client, location):
+  bucket, prefix = s3_urls.split_s3_url(location)
+  digest = hashlib.sha256()
+  for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      digest.update(('%s %s %d\n' % (obj['Key'], obj['ETag'], obj['Size'])).encode('utf-8'))
+  return digest.hexdigest()
+
+
+# The same idea for a table in the glue catalog: its location's contents plus its partition list, so adding a
+# partition that points outside the table location still invalidates the cache.
+def glue_table_token(glue_client, s3_client, database, table):
+  location = glue_client.get_table(DatabaseName=database, Name=table)['Table']['StorageDescriptor']['Location']
+  digest = hashlib.sha256(s3_prefix_token(s3_client, location).encode('utf-8'))
+  for page in glue_client.get_paginator('get_partitions').paginate(DatabaseName=database, TableName=table):
+    for partition in sorted(page['Partitions'], key=lambda p: p['Values']):
+      digest.update(('%s %s\n' % (partition['Values'], partition['StorageDescriptor']['Location'])).encode('utf-8'))
+  return digest.hexdigest()
+
+
+class LocalIndex(object):
+
+  def __init__(self, path):
+    self.path = path
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return {}
+    with open(self.path) as f:
+      return json.load(f)
+
+  def save(self, entries):
+    directory = os.path.dirname(os.path.abspath(self.path))
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+      json.dump(entries, f, indent=1, sort_keys=True)
+    os.rename(f.name, self.path)
+
+
+class S3Index(object):
+
+  def __init__(self, s3_client, bucket, key):
+    self.s3_client = s3_client
+    self.bucket = bucket
+    self.key = key
+
+  def load(self):
+    try:
+      return json.loads(self.s3_client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read())
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+        return {}
+      raise
+
+  def save(self, entries):
+    self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=json.dumps(entries, sort_keys=True).encode('utf-8'))
+
+
+# Maps a query fingerprint (normalized sql, database and a data version token) to the OutputLocation of the last run
+# that succeeded for it. Entries older than ttl seconds are dropped and once there are more than max_entries the
+# oldest go first. The index is loaded lazily and only written back when flush() is called.
+class QueryResultCache(object):
+
+  def __init__(self, index, ttl=7 * 24 * 3600, max_entries=1000, clock=time.time):
+    self.index = index
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+    self._entries = None
+    self._dirty = False
+    self._lock = threading.Lock()
+
+  def _load(self):
+    if self._entries is None:
+      self._entries = self.index.load()
+
+  def get(self, key):
+    with self._lock:
+      self._load()
+      entry = self._entries.get(key)
+      if entry is not None and self.ttl is not None and self.clock() - entry['created'] > self.ttl:
+        del self._entries[key]
+        self._dirty = True
+        entry = None
+      if entry is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+      return entry
+
+  def put(self, key, execution):
+    with self._lock:
+      self._load()
+      self._entries[key] = {
+        'created': self.clock(),
+        'query_execution_id': execution['QueryExecutionId'],
+        'output_location': execution['ResultConfiguration']['OutputLocation']
+      }
+      self._evict()
+      self._dirty = True
+
+  def discard(self, key):
+    with self._lock:
+      self._load()
+      if self._entries.pop(key, None) is not None:
+        self._dirty = True
+
+  def _evict(self):
+    if self.ttl is not None:
+      now = self.clock()
+      for key in [k for k, e in self._entries.items() if now - e['created'] > self.ttl]:
+        del self._entries[key]
+    if len(self._entries) > self.max_entries:
+      for key in sorted(self._entries, key=lambda k: self._entries[k]['created'])[:len(self._entries) - self.max_entries]:
+        del self._entries[key]
+
+  def flush(self):
+    with self._lock:
+      if self._dirty:
+        self._evict()
+        self.index.save(self._entries)
+        self._dirty = False
@@ -1,31 +1,224 @@
 import boto3
+import csv
+import io
+import threading
 import time
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
-client = boto3.client('athena')
-s3_client = boto3.client('s3')
+from botocore.exceptions import ClientError
+
+import athena_cache
+import s3_urls
 
 sql_query_string = 'SELECT * FROM "census"."adult_data_manual" limit 11'
 query_bucket = 'aws-athena-query-results-007038732177-us-west-2'
 query_bucket_url = 's3://' + query_bucket + '/'
-response = client.start_query_execution(
-        QueryString=sql_query_string,
-        QueryExecutionContext={
-            'Database': 'census'
-        },
-        ResultConfiguration={
-            'OutputLocation': query_bucket_url 
-        }
+
+# batch_get_query_execution takes at most 50 ids per call
+BATCH_SIZE = 50
+DONE_STATES = ('SUCCEEDED', 'FAILED', 'CANCELLED')
+CHUNK_SIZE = 1024 * 1024
+
+
+class QueryFailed(Exception):
+
+  def __init__(self, executions):
+    self.executions = executions
+    Exception.__init__(self, '; '.join('%s %s: %s' % (e['QueryExecutionId'], e['Status']['State'],
+                                                        e['Status'].get('StateChangeReason', ''))
+                                       for e in executions))
+
+
+# Runs a batch of athena queries and waits on all of them at once. Rather than sleeping a fixed two seconds between
+# checks the poll interval starts short, so quick queries come back quickly, and grows by `multiplier` every round up
+# to `max_interval` so long scans don't burn api calls. Every round checks all outstanding queries with a single
+# batch_get_query_execution call per 50 ids.
+#
+# With a cache (see athena_cache.QueryResultCache) and a data_version callable, run() skips start_query_execution for
+# any query whose sql, database and data version match a previous successful run and hands back that run's output
+# location instead. data_version(sql, database) should return a token that changes when the underlying data does, e.g.
+# athena_cache.glue_table_token for the tables the query reads, or None if the query shouldn't be cached.
+class AthenaRunner(object):
+
+  def __init__(self, client=None, s3_client=None, output_location=query_bucket_url, database='census',
+               min_interval=0.2, max_interval=5.0, multiplier=2.0, max_submitters=4, clock=time.time,
+               sleep=time.sleep, cache=None, data_version=None):
+    self.client = client or boto3.client('athena')
+    self.s3_client = s3_client or boto3.client('s3')
+    self.output_location = output_location
+    self.database = database
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.multiplier = multiplier
+    self.max_submitters = max_submitters
+    self.clock = clock
+    self.sleep = sleep
+    self.cache = cache
+    self.data_version = data_version
+    self.api_calls = 0
+    self._lock = threading.Lock()
+
+  def _count_call(self):
+    with self._lock:
+      self.api_calls += 1
+
+  def submit(self, sql, database=None):
+    self._count_call()
+    response = self.client.start_query_execution(
+      QueryString=sql,
+      QueryExecutionContext={
+        'Database': database or self.database
+      },
+      ResultConfiguration={
+        'OutputLocation': self.output_location
+      }
     )
-query_id = response['QueryExecutionId']
-
-#response = client.get_query_results(QueryExecutionId=query_id)
-while True:
-  response = client.get_query_execution(QueryExecutionId=query_id)  
-  if response['QueryExecution']['Status']['State'] in 'SUCCEEDED':
-    key = response['QueryExecution']['ResultConfiguration']['OutputLocation'].split("/")[-1] 
-    obj = s3_client.get_object(Bucket=query_bucket, Key=key)
-    print obj['Body'].read()
-    break
-  else:
-    time.sleep(2)
+    return response['QueryExecutionId']
+
+  def submit_all(self, queries, database=None):
+    if len(queries) <= 1:
+      return [self.submit(sql, database) for sql in queries]
+    with ThreadPoolExecutor(max_workers=min(self.max_submitters, len(queries))) as pool:
+      return list(pool.map(lambda sql: self.submit(sql, database), queries))
+
+  # Returns {query id: QueryExecution} once every query has reached a final state. Raises RuntimeError if timeout
+  # seconds pass first. Ids athena can't report on (unknown or expired ones) never will reach one, so they're given a
+  # FAILED execution with athena's error message as the reason.
+  def wait(self, query_ids, timeout=None):
+    pending = list(query_ids)
+    finished = {}
+    interval = self.min_interval
+    deadline = None if timeout is None else self.clock() + timeout
+    while pending:
+      for i in range(0, len(pending), BATCH_SIZE):
+        self._count_call()
+        response = self.client.batch_get_query_execution(QueryExecutionIds=pending[i:i + BATCH_SIZE])
+        for execution in response['QueryExecutions']:
+          if execution['Status']['State'] in DONE_STATES:
+            finished[execution['QueryExecutionId']] = execution
+        for unprocessed in response.get('UnprocessedQueryExecutionIds', []):
+          finished[unprocessed['QueryExecutionId']] = {
+            'QueryExecutionId': unprocessed['QueryExecutionId'],
+            'Status': {'State': 'FAILED', 'StateChangeReason': '%s: %s' % (unprocessed.get('ErrorCode'),
+                                                                           unprocessed.get('ErrorMessage'))}
+          }
+      pending = [query_id for query_id in pending if query_id not in finished]
+      if not pending:
+        break
+      if deadline is not None and self.clock() + interval > deadline:
+        raise RuntimeError('%d athena queries still running after %ss' % (len(pending), timeout))
+      self.sleep(interval)
+      interval = min(self.max_interval, interval * self.multiplier)
+    return finished
+
+  # Submits every query, waits for all of them and returns their QueryExecutions in the same order as the queries.
+  # Any query that ends up FAILED or CANCELLED raises QueryFailed unless raise_on_failure is turned off.
+  def run(self, queries, database=None, timeout=None, raise_on_failure=True):
+    executions = [None] * len(queries)
+    keys = [None] * len(queries)
+    if self.cache is not None and self.data_version is not None:
+      for i, sql in enumerate(queries):
+        keys[i] = self._cache_key(sql, database or self.database)
+        executions[i] = self._cached_execution(keys[i])
+
+    to_run = [i for i, execution in enumerate(executions) if execution is None]
+    query_ids = self.submit_all([queries[i] for i in to_run], database)
+    finished = self.wait(query_ids, timeout)
+    for i, query_id in zip(to_run, query_ids):
+      executions[i] = finished[query_id]
+      if keys[i] is not None and executions[i]['Status']['State'] == 'SUCCEEDED':
+        self.cache.put(keys[i], executions[i])
+    if self.cache is not None:
+      self.cache.flush()
+
+    failed = [e for e in executions if e['Status']['State'] != 'SUCCEEDED']
+    if failed and raise_on_failure:
+      raise QueryFailed(failed)
+    return executions
+
+  def _cache_key(self, sql, database):
+    version = self.data_version(sql, database)
+    if version is None:
+      return None
+    return athena_cache.fingerprint(sql, database, version)
+
+  # A cached result is only any good if the csv is still there, results buckets often have lifecycle rules on them.
+  def _cached_execution(self, key):
+    if key is None:
+      return None
+    entry = self.cache.get(key)
+    if entry is None:
+      return None
+    bucket, result_key = s3_urls.split_s3_url(entry['output_location'])
+    try:
+      self._count_call()
+      self.s3_client.head_object(Bucket=bucket, Key=result_key)
+    except ClientError:
+      self.cache.discard(key)
+      return None
+    return {
+      'QueryExecutionId': entry['query_execution_id'],
+      'Status': {'State': 'SUCCEEDED'},
+      'ResultConfiguration': {'OutputLocation': entry['output_location']},
+      'Cached': True
+    }
+
+  def read_result(self, execution):
+    bucket, key = s3_urls.split_s3_url(execution['ResultConfiguration']['OutputLocation'])
+    self._count_call()
+    return self.s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+  # Like read_result but for results too big to hold in memory. See iter_record_batches.
+  def iter_result_batches(self, execution, batch_size=10000, as_dataframe=False, chunk_size=CHUNK_SIZE):
+    bucket, key = s3_urls.split_s3_url(execution['ResultConfiguration']['OutputLocation'])
+    self._count_call()
+    body = self.s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    try:
+      for batch in iter_record_batches(body, batch_size, as_dataframe, chunk_size):
+        yield batch
+    finally:
+      body.close()
+
+
+# Adapts anything with a read(n) method (an s3 StreamingBody, an open file) into a raw stream so it can be buffered and
+# decoded chunk by chunk instead of being read in one go.
+class _ChunkedStream(io.RawIOBase):
+
+  def __init__(self, body):
+    self.body = body
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    data = self.body.read(len(b))
+    b[:len(data)] = data
+    return len(data)
+
+
+# Parses an athena csv result incrementally, chunk_size bytes at a time, and yields lists of at most batch_size rows
+# (or pandas DataFrames of them with as_dataframe) so memory use depends on the batch size rather than the size of the
+# result. The header row is used for the DataFrame columns and is not included in the batches.
+def iter_record_batches(body, batch_size=10000, as_dataframe=False, chunk_size=CHUNK_SIZE):
+  if as_dataframe:
+    import pandas as pd
+  text = io.TextIOWrapper(io.BufferedReader(_ChunkedStream(body), buffer_size=chunk_size), encoding='utf-8',
+                          newline='')
+  reader = csv.reader(text)
+  header = next(reader, None)
+  if header is None:
+    return
+  batch = []
+  for row in reader:
+    batch.append(row)
+    if len(batch) >= batch_size:
+      yield pd.DataFrame(batch, columns=header) if as_dataframe else batch
+      batch = []
+  if batch:
+    yield pd.DataFrame(batch, columns=header) if as_dataframe else batch
+
+
+if __name__ == '__main__':
+  runner = AthenaRunner()
+  execution = runner.run([sql_query_string])[0]
+  print(runner.read_result(execution))
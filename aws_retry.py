@@ -0,0 +1,220 @@
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+log = logging.getLogger()
+
+THROTTLING = 'throttling'
+RETRYABLE = 'retryable'
+FATAL = 'fatal'
+
+THROTTLING_CODES = frozenset([
+  'Throttling',
+  'ThrottlingException',
+  'ThrottledException',
+  'RequestThrottled',
+  'RequestThrottledException',
+  'TooManyRequestsException',
+  'RequestLimitExceeded',
+  'SlowDown',
+  'ProvisionedThroughputExceededException'
+])
+
+RETRYABLE_CODES = frozenset([
+  'InternalError',
+  'InternalFailure',
+  'InternalServerError',
+  'ServiceUnavailable',
+  'ServiceUnavailableException',
+  'RequestTimeout',
+  'RequestTimeoutException',
+  'PriorRequestNotComplete'
+])
+
+
+# botocore retries throttling on its own with a fixed number of attempts and no idea how long the lambda has left. The
+# clients handed to RetryingClient should be built with this config so the two layers don't multiply each other.
+# botocore.config is imported here rather than at the top, it pulls in most of botocore's http stack and that would
+# otherwise land on the import of every lambda module using the retries.
+def client_config(**kwargs):
+  from botocore.config import Config
+  return Config(retries={'max_attempts': 0}, **kwargs)
+
+
+def classify(error):
+  if isinstance(error, ClientError):
+    code = error.response.get('Error', {}).get('Code')
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+    if code in THROTTLING_CODES or status == 429:
+      return THROTTLING
+    if code in RETRYABLE_CODES or status >= 500:
+      return RETRYABLE
+    return FATAL
+  if isinstance(error, (ConnectionError, HTTPClientError)):
+    return RETRYABLE
+  return FATAL
+
+
+# Retries throttled and transient failures with decorrelated jitter backoff (each sleep is picked at random between the
+# base delay and three times the previous one, capped). The policy is started once per invocation with the lambda
+# context so no sleep is ever allowed to run past the time the function has left, less a reserve for reporting the
+# result back to the pipeline. It's shared by every client in the module so the counters cover the whole invocation.
+class RetryPolicy(object):
+
+  def __init__(self, base=0.1, cap=5.0, max_attempts=8, reserve=5.0, clock=time.time, sleep=time.sleep,
+               rand=random.uniform):
+    self.base = base
+    self.cap = cap
+    self.max_attempts = max_attempts
+    self.reserve = reserve
+    self.clock = clock
+    self.sleep = sleep
+    self.rand = rand
+    self.deadline = None
+    self._lock = threading.Lock()
+    self._reset_counters()
+
+  def _reset_counters(self):
+    self.calls = 0
+    self.retries = 0
+    self.throttles = 0
+    self.backoff_seconds = 0.0
+
+  def start(self, context=None):
+    with self._lock:
+      self._reset_counters()
+      if context is not None:
+        self.deadline = self.clock() + context.get_remaining_time_in_millis() / 1000.0 - self.reserve
+      else:
+        self.deadline = None
+
+  def remaining(self):
+    if self.deadline is None:
+      return None
+    return self.deadline - self.clock()
+
+  def stats(self):
+    with self._lock:
+      return {'calls': self.calls, 'retries': self.retries, 'throttles': self.throttles,
+              'backoff_seconds': round(self.backoff_seconds, 3)}
+
+  def call(self, func, *args, **kwargs):
+    return self._call((THROTTLING, RETRYABLE), func, args, kwargs)
+
+  # For calls that aren't safe to repeat once the service may have acted on them (creating a training job, say). A
+  # throttled request was turned away before anything happened so it's retried, but a 5xx or a dropped connection may
+  # have come after the job was created, and the retry would then fail on the duplicate name, so those are raised.
+  def call_once(self, func, *args, **kwargs):
+    return self._call((THROTTLING,), func, args, kwargs)
+
+  def _call(self, kinds, func, args, kwargs):
+    delay = self.base
+    attempt = 0
+    while True:
+      attempt += 1
+      with self._lock:
+        self.calls += 1
+      try:
+        return func(*args, **kwargs)
+      except Exception as e:
+        kind = classify(e)
+        if kind not in kinds or attempt >= self.max_attempts:
+          raise
+        delay = min(self.cap, self.rand(self.base, delay * 3))
+        remaining = self.remaining()
+        if remaining is not None and delay > remaining:
+          log.warning('not retrying %s, %.2fs backoff would overrun the %.2fs left', getattr(func, '__name__', func),
+                      delay, remaining)
+          raise
+        with self._lock:
+          self.retries += 1
+          if kind == THROTTLING:
+            self.throttles += 1
+          self.backoff_seconds += delay
+        log.info('%s error from %s, retry %d in %.2fs: %s', kind, getattr(func, '__name__', func), attempt, delay, e)
+        self.sleep(delay)
+
+
+# Wraps a boto3 client so every api call on it goes through a RetryPolicy, the ones in NON_IDEMPOTENT through
+# RetryPolicy.call_once. Anything that isn't an api call (waiters, paginators, meta and so on) is handed back untouched.
+class RetryingClient(object):
+
+  NON_IDEMPOTENT = frozenset(['create_training_job'])
+
+  def __init__(self, client, policy):
+    self._client = client
+    self._policy = policy
+
+  def __getattr__(self, name):
+    attr = getattr(self._client, name)
+    if name in self._client.meta.method_to_api_mapping or name in ('download_file', 'upload_file'):
+      retry = self._policy.call_once if name in self.NON_IDEMPOTENT else self._policy.call
+
+      def call(*args, **kwargs):
+        return retry(attr, *args, **kwargs)
+      call.__name__ = name
+      return call
+    return attr
+
+
+# Builds each service's client the first time something calls it instead of when the module is imported, so a cold
+# start only pays for boto3 and the clients an invocation actually uses. All the clients come from one boto3 session
+# (and so share its botocore session, credentials and loaded service models) and are kept for warm invocations. Creating
+# clients from a session isn't thread safe, so they're created one at a time under a lock.
+class ClientRegistry(object):
+
+  def __init__(self, policy, session_factory=None):
+    self.policy = policy
+    self.session_factory = session_factory
+    self._session = None
+    self._clients = {}
+    self._lock = threading.Lock()
+
+  def _new_session(self):
+    if self.session_factory is not None:
+      return self.session_factory()
+    import boto3.session
+    return boto3.session.Session()
+
+  def get(self, service):
+    client = self._clients.get(service)
+    if client is not None:
+      return client
+    with self._lock:
+      client = self._clients.get(service)
+      if client is None:
+        if self._session is None:
+          self._session = self._new_session()
+        client = RetryingClient(self._session.client(service, config=client_config()), self.policy)
+        self._clients[service] = client
+      return client
+
+  # Puts client (wrapped in the policy) in place of the one the registry would build, for benchmarks and local runs.
+  def install(self, service, client):
+    with self._lock:
+      self._clients[service] = RetryingClient(client, self.policy)
+
+  # The services whose clients have been built or installed so far.
+  def created(self):
+    with self._lock:
+      return sorted(self._clients)
+
+  def lazy(self, service):
+    return LazyClient(self, service)
+
+
+# Stands in for a registry's client at module level. Nothing is built until the first attribute is looked up on it.
+class LazyClient(object):
+
+  def __init__(self, registry, service):
+    self._registry = registry
+    self._service = service
+
+  def __getattr__(self, name):
+    return getattr(self._registry.get(self._service), name)
+
+  def __repr__(self):
+    return '<LazyClient %s>' % self._service
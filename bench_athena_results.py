@@ -0,0 +1,86 @@
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import athena_query
+
+# Benchmarks reading a large athena style csv result two ways: the old read-everything approach and the streaming
+# batch reader in athena_query. Each mode runs in its own process so the peak rss numbers don't bleed into each other.
+# Run it with no arguments to build the fixture (if it isn't there already) and compare both modes.
+
+HEADER = ['age', 'workclass', 'fnlwgt', 'education', 'education_num', 'marital_status', 'occupation', 'relationship',
+          'race', 'gender', 'capital_gain', 'capital_loss', 'hours_per_week', 'native_country', 'income_bracket']
+WORKCLASSES = ['Private', 'Self-emp-not-inc', 'Local-gov', 'State-gov', 'Federal-gov', 'Without-pay']
+EDUCATION = ['Bachelors', 'HS-grad', 'Some-college', 'Masters', 'Doctorate', '11th', 'Assoc-voc']
+
+
+def quote(value):
+  return '"%s"' % value
+
+
+def build_fixture(path, rows):
+  rng = random.Random(42)
+  with open(path, 'w') as f:
+    f.write(','.join(quote(h) for h in HEADER) + '\n')
+    for _ in range(rows):
+      row = [rng.randint(17, 90), rng.choice(WORKCLASSES), rng.randint(10000, 1000000), rng.choice(EDUCATION),
+             rng.randint(1, 16), 'Never-married', 'Adm-clerical', 'Not-in-family', 'White',
+             rng.choice(['Male', 'Female']), rng.randint(0, 99999), 0, rng.randint(1, 99), 'United-States',
+             rng.choice(['<=50K', '>50K'])]
+      f.write(','.join(quote(v) for v in row) + '\n')
+
+
+def peak_rss_mb():
+  # ru_maxrss is kilobytes on linux and bytes on mac
+  scale = 1024.0 * 1024 if sys.platform == 'darwin' else 1024.0
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def run_mode(path, mode, batch_size):
+  start = time.time()
+  rows = 0
+  with open(path, 'rb') as body:
+    if mode == 'read':
+      rows = len(list(csv.reader(io.StringIO(body.read().decode('utf-8'), newline='')))) - 1
+    elif mode == 'dataframe':
+      for batch in athena_query.iter_record_batches(body, batch_size, as_dataframe=True):
+        rows += len(batch)
+    else:
+      for batch in athena_query.iter_record_batches(body, batch_size):
+        rows += len(batch)
+  elapsed = time.time() - start
+  return {'mode': mode, 'rows': rows, 'seconds': round(elapsed, 3), 'rows_per_second': int(rows / elapsed),
+          'peak_rss_mb': round(peak_rss_mb(), 1)}
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--fixture', default='athena_results_fixture.csv')
+  parser.add_argument('--rows', type=int, default=2000000)
+  parser.add_argument('--batch-size', type=int, default=10000)
+  parser.add_argument('--modes', default='read,stream,dataframe')
+  parser.add_argument('--mode', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.mode:
+    print(json.dumps(run_mode(args.fixture, args.mode, args.batch_size)))
+    return
+
+  if not os.path.exists(args.fixture):
+    build_fixture(args.fixture, args.rows)
+  print('fixture %s is %.1f MB' % (args.fixture, os.path.getsize(args.fixture) / 1024.0 / 1024))
+  for mode in args.modes.split(','):
+    output = subprocess.check_output([sys.executable, __file__, '--fixture', args.fixture, '--batch-size',
+                                      str(args.batch_size), '--mode', mode])
+    print(output.decode('utf-8').strip())
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import bench_athena_results
+import stage_data
+
+# Benchmarks the conversion half of stage_data.py against local files: how many bytes each format would move into a
+# training container compared to the raw csv, and how fast the conversion runs on one process versus all of them.
+# Nothing here touches s3.
+
+
+def _convert_file(args):
+  path, out_dir, fmt, shard_bytes, level = args
+  with open(path, 'rb') as body:
+    writer = stage_data.convert_stream(body, out_dir, os.path.basename(path), fmt, shard_bytes, level)
+  return writer.raw_bytes, sum(os.path.getsize(p) for p in writer.paths), len(writer.paths)
+
+
+def run(paths, fmt, processes, shard_bytes, level):
+  out_dir = tempfile.mkdtemp()
+  try:
+    work = [(path, out_dir, fmt, shard_bytes, level) for path in paths]
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+      results = pool.map(_convert_file, work, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+    elapsed = time.time() - start
+  finally:
+    shutil.rmtree(out_dir, ignore_errors=True)
+  raw_bytes = sum(r[0] for r in results)
+  staged_bytes = sum(r[1] for r in results)
+  return {
+    'format': fmt,
+    'processes': processes,
+    'raw_mb': round(raw_bytes / 1048576.0, 1),
+    'staged_mb': round(staged_bytes / 1048576.0, 1),
+    'ratio': round(staged_bytes / float(raw_bytes), 3),
+    'shards': sum(r[2] for r in results),
+    'seconds': round(elapsed, 2),
+    'raw_mb_per_second': round(raw_bytes / 1048576.0 / elapsed, 1)
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--fixture-dir', default='staging_fixture')
+  parser.add_argument('--files', type=int, default=8)
+  parser.add_argument('--rows-per-file', type=int, default=250000)
+  parser.add_argument('--shard-mb', type=int, default=16)
+  parser.add_argument('--level', type=int, default=6)
+  args = parser.parse_args()
+
+  if not os.path.isdir(args.fixture_dir):
+    os.makedirs(args.fixture_dir)
+  paths = []
+  for i in range(args.files):
+    path = os.path.join(args.fixture_dir, 'adult-%02d.csv' % i)
+    if not os.path.exists(path):
+      bench_athena_results.build_fixture(path, args.rows_per_file)
+    paths.append(path)
+
+  for fmt in stage_data.FORMATS:
+    for processes in sorted(set([1, multiprocessing.cpu_count()])):
+      print(json.dumps(run(paths, fmt, processes, args.shard_mb * 1024 * 1024, args.level)))
+
+
+if __name__ == '__main__':
+  main()
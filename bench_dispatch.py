@@ -0,0 +1,434 @@
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import zipfile
+
+from botocore.exceptions import ClientError
+
+# Benchmarks sageDispatch.lambda_handler end to end without aws. Every client the module would build is swapped
+# for an in-process stand-in for s3, codecommit, sagemaker, codepipeline and ecr, wrapped in the module's own retry
+# policy, and every call to a stand-in takes --latency-ms (plus up to --jitter-ms) and is throttled with probability
+# --throttle-rate. Both take SERVICE=VALUE to set one service, e.g. --latency-ms 5 sagemaker=150.
+#
+#   python bench_dispatch.py --artifact-mb 1 50 --concurrency 1 4 --invocations 20 --out bench_dispatch.json
+#   python bench_dispatch.py --compare bench_dispatch.json      # same run again, with the change against the last one
+#
+# Each concurrency level starts that many fresh python processes side by side, one per container. A container's first
+# invocation is its cold start (importing sageDispatch plus the invocation, with init reported on its own as well) and
+# the rest are warm. Events are event.json pointed at artifacts that are zips of MANIFEST plus incompressible padding
+# up to --artifact-mb. Each warm invocation gets the artifact at a new key so the manifest cache doesn't hide the
+# read, unless --same-artifact. The manifest turns off dedup (SkipIfUnchanged) so every invocation goes all the way to
+# create_training_job, --dedup leaves it on and measures warm invocations that reuse the first job. The stand-in s3
+# keeps its one copy of the artifact in the container process, so peak memory includes it.
+
+SERVICES = ('s3', 'codecommit', 'sagemaker', 'codepipeline', 'ecr')
+
+BENCH_ENV = {
+  'AWS_DEFAULT_REGION': 'us-west-2',
+  'AWS_ACCESS_KEY_ID': 'bench',
+  'AWS_SECRET_ACCESS_KEY': 'bench',
+  'LOG_LEVEL': 'ERROR',
+  'METRICS_SINK': 'off',
+  'APP_BUNDLE': 'output',
+  'CODE_COMMIT_REPO': 'census',
+  'TRAINING_IMAGE': '007038732177.dkr.ecr.us-west-2.amazonaws.com/census',
+  'SAGEMAKER_ROLE_ARN': 'arn:aws:iam::007038732177:role/SagemakerExecutionRole',
+  'INPUT_BUCKET': 's3://bench-input/',
+  'OUTPUT_BUCKET': 's3://bench-output/output/',
+  'STAGING_URL': 's3://bench-output/staged/',
+  'BUCKET_KEY_ARN': 'arn:aws:kms:us-west-2:007038732177:key/bench',
+  # The real limit is there to keep a burst of pipelines under sagemaker's rate limit. A benchmark container sees far
+  # more invocations a second than a real one ever would, so it's lifted unless --env says otherwise.
+  'CREATE_JOB_TPS': '10000',
+  'CREATE_JOB_BURST': '10000'
+}
+
+ARTIFACT_BUCKET = 'codepipeline-bench'
+
+MANIFEST = {
+  'TrainingJobName': 'census',
+  'SkipIfUnchanged': False,
+  'HyperParameters': {'train_data': 'adult.data', 'test_data': 'adult.test', 'model_type': 'wide',
+                      'train_epochs': '40'},
+  'ResourceConfig': {'InstanceType': 'ml.m5.xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 10},
+  'StoppingCondition': {'MaxRuntimeInSeconds': 3600}
+}
+
+
+def client_error(code, operation, status=400, message=''):
+  return ClientError({'Error': {'Code': code, 'Message': message}, 'ResponseMetadata': {'HTTPStatusCode': status}},
+                     operation)
+
+
+class _Meta(object):
+
+  def __init__(self, operations):
+    self.method_to_api_mapping = dict((name, name) for name in operations)
+
+
+# Base of the stand-ins. Subclasses list their api calls in OPERATIONS, which is what aws_retry.RetryingClient looks
+# at to decide what to retry, and start each one with self._call().
+class StandIn(object):
+
+  OPERATIONS = ()
+
+  def __init__(self, latency=0.0, jitter=0.0, throttle_rate=0.0, seed=0):
+    self.latency = latency
+    self.jitter = jitter
+    self.throttle_rate = throttle_rate
+    self.rng = random.Random(seed)
+    self.meta = _Meta(self.OPERATIONS)
+    self.calls = 0
+    self.throttled = 0
+
+  def _call(self, operation):
+    self.calls += 1
+    delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0)
+    if delay:
+      time.sleep(delay)
+    if self.throttle_rate and self.rng.random() < self.throttle_rate:
+      self.throttled += 1
+      raise client_error('ThrottlingException', operation, message='Rate exceeded')
+
+
+class S3StandIn(StandIn):
+
+  OPERATIONS = ('head_object', 'get_object', 'put_object', 'download_file')
+
+  def __init__(self, objects, **kwargs):
+    StandIn.__init__(self, **kwargs)
+    self.objects = objects
+
+  def _object(self, bucket, key, operation):
+    data = self.objects.get((bucket, key))
+    if data is None:
+      raise client_error('NoSuchKey' if operation == 'GetObject' else '404', operation, 404)
+    return data
+
+  def _etag(self, bucket, key):
+    return '"%s"' % hashlib.md5((bucket + key).encode('utf-8')).hexdigest()
+
+  def head_object(self, Bucket, Key):
+    self._call('HeadObject')
+    data = self._object(Bucket, Key, 'HeadObject')
+    return {'ContentLength': len(data), 'ETag': self._etag(Bucket, Key), 'VersionId': 'v-' + Key[-8:]}
+
+  def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+    self._call('GetObject')
+    data = self._object(Bucket, Key, 'GetObject')
+    if Range is None:
+      return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+    start, end = [int(value) for value in Range[len('bytes='):].split('-')]
+    end = min(end, len(data) - 1)
+    return {'Body': io.BytesIO(data[start:end + 1]), 'ContentLength': end + 1 - start,
+            'ContentRange': 'bytes %d-%d/%d' % (start, end, len(data))}
+
+  def put_object(self, Bucket, Key, Body, **kwargs):
+    self._call('PutObject')
+    self.objects[(Bucket, Key)] = Body
+    return {'ETag': self._etag(Bucket, Key)}
+
+  def download_file(self, bucket, key, filename):
+    self._call('GetObject')
+    with open(filename, 'wb') as f:
+      f.write(self._object(bucket, key, 'GetObject'))
+
+
+class CodeCommitStandIn(StandIn):
+
+  OPERATIONS = ('get_branch',)
+
+  def get_branch(self, repositoryName, branchName):
+    self._call('GetBranch')
+    return {'branch': {'branchName': branchName, 'commitId': 'd74c5af072e904aab942fc68d8f8a1d90743f6fc'}}
+
+
+class SageMakerStandIn(StandIn):
+
+  OPERATIONS = ('create_training_job', 'describe_training_job', 'list_tags')
+
+  def __init__(self, **kwargs):
+    StandIn.__init__(self, **kwargs)
+    self.jobs = {}
+
+  def create_training_job(self, **request):
+    self._call('CreateTrainingJob')
+    # Real job names are only unique to the minute, which a benchmark goes through many times over, so a repeated name
+    # replaces the job instead of failing like sagemaker would.
+    name = request['TrainingJobName']
+    arn = 'arn:aws:sagemaker:us-west-2:007038732177:training-job/' + name.lower()
+    self.jobs[name] = dict(request, TrainingJobArn=arn, TrainingJobStatus='InProgress')
+    return {'TrainingJobArn': arn}
+
+  def describe_training_job(self, TrainingJobName):
+    self._call('DescribeTrainingJob')
+    if TrainingJobName not in self.jobs:
+      raise client_error('ValidationException', 'DescribeTrainingJob', message='Requested resource not found.')
+    return self.jobs[TrainingJobName]
+
+  def list_tags(self, ResourceArn):
+    self._call('ListTags')
+    return {'Tags': []}
+
+
+class CodePipelineStandIn(StandIn):
+
+  OPERATIONS = ('put_job_success_result', 'put_job_failure_result')
+
+  def __init__(self, **kwargs):
+    StandIn.__init__(self, **kwargs)
+    self.results = []
+
+  def put_job_success_result(self, jobId, **kwargs):
+    self._call('PutJobSuccessResult')
+    self.results.append((jobId, 'success', kwargs))
+
+  def put_job_failure_result(self, jobId, failureDetails):
+    self._call('PutJobFailureResult')
+    self.results.append((jobId, 'failure', failureDetails))
+
+
+class ECRStandIn(StandIn):
+
+  OPERATIONS = ('describe_images',)
+
+  def describe_images(self, repositoryName, imageIds):
+    self._call('DescribeImages')
+    return {'imageDetails': [{'imageDigest': 'sha256:' + hashlib.sha256(imageIds[0]['imageTag'].encode()).hexdigest()}]}
+
+
+# A zip like the source artifact CodePipeline hands the Train action: manifest.json and the rest of the repo, here a
+# stored (uncompressed) blob of random bytes so the artifact really is size_mb big.
+def build_artifact(path, size_mb, manifest, seed=0):
+  rng = random.Random(seed)
+  with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+    archive.writestr('manifest.json', json.dumps(manifest))
+    archive.writestr('Dockerfile', 'FROM python:3.12-slim\n')
+    if size_mb > 0:
+      info = zipfile.ZipInfo('data/padding.bin')
+      info.compress_type = zipfile.ZIP_STORED
+      archive.writestr(info, rng.getrandbits(int(size_mb * 1048576) * 8).to_bytes(int(size_mb * 1048576), 'little'))
+
+
+def codepipeline_event(job_id, key, template='event.json'):
+  with open(template) as f:
+    event = json.load(f)
+  job = event['CodePipeline.job']
+  job['id'] = job_id
+  job['data']['inputArtifacts'][0]['location']['s3Location'] = {'bucketName': ARTIFACT_BUCKET, 'objectKey': key}
+  return event
+
+
+class Context(object):
+
+  def __init__(self, request_id, timeout=300):
+    self.aws_request_id = request_id
+    self.deadline = time.time() + timeout
+
+  def get_remaining_time_in_millis(self):
+    return int((self.deadline - time.time()) * 1000)
+
+
+def make_stand_ins(settings, artifact, invocations, same_artifact, seed):
+  objects = {('bench-input', 'adult.data'): b'x' * 1024, ('bench-input', 'adult.test'): b'y' * 1024}
+  for i in range(1 if same_artifact else invocations):
+    objects[(ARTIFACT_BUCKET, 'ml_pipeline/output/artifact-%d' % i)] = artifact
+  classes = {'s3': S3StandIn, 'codecommit': CodeCommitStandIn, 'sagemaker': SageMakerStandIn,
+             'codepipeline': CodePipelineStandIn, 'ecr': ECRStandIn}
+  stand_ins = {}
+  for offset, service in enumerate(SERVICES):
+    kwargs = dict(settings[service], seed=seed * 31 + offset)
+    if service == 's3':
+      kwargs['objects'] = objects
+    stand_ins[service] = classes[service](**kwargs)
+  return stand_ins
+
+
+# Registers the stand-ins as sageDispatch's clients before anything builds the real ones, keeping the module's retry
+# policy in front of them as it is in front of the real ones.
+def install(module, stand_ins):
+  for service, stand_in in stand_ins.items():
+    module.clients.install(service, stand_in)
+
+
+# One container: imports sageDispatch in this fresh process, then runs the invocations one after another.
+def container(worker, config, queue):
+  os.environ.update(config['env'])
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  with open(config['artifact_path'], 'rb') as f:
+    artifact = f.read()
+  stand_ins = make_stand_ins(config['services'], artifact, config['invocations'], config['same_artifact'], worker)
+
+  start = time.perf_counter()
+  import sageDispatch
+  init_seconds = time.perf_counter() - start
+  install(sageDispatch, stand_ins)
+
+  latencies = []
+  retries = 0
+  for i in range(config['invocations']):
+    key = 'ml_pipeline/output/artifact-%d' % (0 if config['same_artifact'] else i)
+    event = codepipeline_event('bench-%d-%d' % (worker, i), key)
+    start = time.perf_counter()
+    sageDispatch.lambda_handler(event, Context('request-%d-%d' % (worker, i)))
+    latencies.append(time.perf_counter() - start)
+    retries += sageDispatch.retry_policy.stats()['retries']
+
+  outcomes = [outcome for _, outcome, _ in stand_ins['codepipeline'].results]
+  queue.put({
+    'init_seconds': init_seconds,
+    'latencies': latencies,
+    'failures': outcomes.count('failure') + config['invocations'] - len(outcomes),
+    'retries': retries,
+    'calls': dict((service, stand_in.calls) for service, stand_in in stand_ins.items()),
+    'throttled': sum(stand_in.throttled for stand_in in stand_ins.values()),
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+  })
+
+
+def percentile(values, p):
+  ordered = sorted(values)
+  if not ordered:
+    return None
+  return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))]
+
+
+def summarize(seconds):
+  if not seconds:
+    return None
+  ms = [value * 1000.0 for value in seconds]
+  return {
+    'count': len(ms),
+    'mean_ms': round(sum(ms) / len(ms), 2),
+    'p50_ms': round(percentile(ms, 50), 2),
+    'p95_ms': round(percentile(ms, 95), 2),
+    'p99_ms': round(percentile(ms, 99), 2),
+    'max_ms': round(max(ms), 2)
+  }
+
+
+def run(artifact_mb, concurrency, config):
+  context = multiprocessing.get_context('spawn')
+  queue = context.Queue()
+  processes = [context.Process(target=container, args=(worker, config, queue)) for worker in range(concurrency)]
+  start = time.perf_counter()
+  for process in processes:
+    process.start()
+  containers = [queue.get() for _ in processes]
+  for process in processes:
+    process.join()
+  elapsed = time.perf_counter() - start
+
+  cold = [c['init_seconds'] + c['latencies'][0] for c in containers if c['latencies']]
+  warm = [latency for c in containers for latency in c['latencies'][1:]]
+  calls = {}
+  for c in containers:
+    for service, count in c['calls'].items():
+      calls[service] = calls.get(service, 0) + count
+  return {
+    'artifact_mb': artifact_mb,
+    'concurrency': concurrency,
+    'invocations': sum(len(c['latencies']) for c in containers),
+    'seconds': round(elapsed, 2),
+    'init': summarize([c['init_seconds'] for c in containers]),
+    'cold': summarize(cold),
+    'warm': summarize(warm),
+    'failures': sum(c['failures'] for c in containers),
+    'retries': sum(c['retries'] for c in containers),
+    'throttled': sum(c['throttled'] for c in containers),
+    'calls': calls,
+    'peak_rss_mb': round(max(c['peak_rss_mb'] for c in containers), 1)
+  }
+
+
+# Turns ['5', 'sagemaker=150'] into a value per service, the bare number being the default for the rest.
+def per_service(values, scale=1.0):
+  settings = dict((service, 0.0) for service in SERVICES)
+  for value in values or []:
+    service, _, number = value.rpartition('=')
+    targets = [service] if service else SERVICES
+    for target in targets:
+      if target not in settings:
+        raise SystemExit('unknown service %r, expected one of %s' % (target, ', '.join(SERVICES)))
+      settings[target] = float(number) * scale
+  return settings
+
+
+def compare(report, baseline):
+  previous = dict(((r['artifact_mb'], r['concurrency']), r) for r in baseline['runs'])
+  for r in report['runs']:
+    old = previous.get((r['artifact_mb'], r['concurrency']))
+    if old is None:
+      continue
+    changes = {}
+    for kind in ('cold', 'warm'):
+      if r[kind] and old[kind]:
+        for stat in ('p50_ms', 'p95_ms', 'p99_ms'):
+          changes['%s_%s' % (kind, stat)] = '%+.1f%%' % ((r[kind][stat] / old[kind][stat] - 1) * 100.0
+                                                        if old[kind][stat] else 0.0)
+    changes['peak_rss_mb'] = '%+.1f' % (r['peak_rss_mb'] - old['peak_rss_mb'])
+    print(json.dumps(dict(artifact_mb=r['artifact_mb'], concurrency=r['concurrency'], **changes)))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark sageDispatch.lambda_handler against stand-in aws services.')
+  parser.add_argument('--artifact-mb', type=float, nargs='+', default=[0.1, 10, 50])
+  parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4])
+  parser.add_argument('--invocations', type=int, default=20, help='per container, the first one cold')
+  parser.add_argument('--latency-ms', nargs='*', default=['5'], help='ms per call, or SERVICE=ms')
+  parser.add_argument('--jitter-ms', nargs='*', default=['5'])
+  parser.add_argument('--throttle-rate', nargs='*', default=['0'], help='share of calls throttled, or SERVICE=share')
+  parser.add_argument('--same-artifact', action='store_true', help='every invocation reads the same artifact')
+  parser.add_argument('--dedup', action='store_true', help="leave the manifest's SkipIfUnchanged on")
+  parser.add_argument('--env', nargs='*', default=[], help='KEY=VALUE overrides of the lambda environment')
+  parser.add_argument('--out', help='write the report here as well as printing it')
+  parser.add_argument('--compare', help='an earlier report to compare p50/p95/p99 and memory against')
+  args = parser.parse_args()
+
+  latency = per_service(args.latency_ms, 0.001)
+  jitter = per_service(args.jitter_ms, 0.001)
+  throttle = per_service(args.throttle_rate)
+  services = dict((service, {'latency': latency[service], 'jitter': jitter[service],
+                             'throttle_rate': throttle[service]}) for service in SERVICES)
+  env = dict(BENCH_ENV, **dict(value.split('=', 1) for value in args.env))
+  manifest = dict(MANIFEST, SkipIfUnchanged=args.dedup)
+
+  report = {
+    'generated': datetime.datetime.utcnow().isoformat() + 'Z',
+    'python': sys.version.split()[0],
+    'config': {'invocations': args.invocations, 'services': services, 'same_artifact': args.same_artifact,
+               'dedup': args.dedup, 'env': args.env},
+    'runs': []
+  }
+  workdir = tempfile.mkdtemp()
+  for artifact_mb in args.artifact_mb:
+    artifact_path = os.path.join(workdir, 'artifact-%s.zip' % artifact_mb)
+    build_artifact(artifact_path, artifact_mb, manifest)
+    config = {'env': env, 'services': services, 'artifact_path': artifact_path, 'invocations': args.invocations,
+              'same_artifact': args.same_artifact}
+    for concurrency in args.concurrency:
+      result = run(artifact_mb, concurrency, config)
+      print(json.dumps(result))
+      report['runs'].append(result)
+    os.remove(artifact_path)
+  os.rmdir(workdir)
+
+  if args.out:
+    with open(args.out, 'w') as f:
+      json.dump(report, f, indent=2, sort_keys=True)
+  if args.compare:
+    with open(args.compare) as f:
+      compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+  main()
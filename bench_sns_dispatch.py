@@ -0,0 +1,71 @@
+import argparse
+import copy
+import json
+import random
+import time
+
+import dispatch_cache
+import sns_sage_dispatch
+
+# Benchmarks sns_sage_dispatch.process_batch on synthetic batches built from sns_event.json: sns_records SNS records,
+# each carrying codecommit_records CodeCommit records, with a share of the pushes repeated to exercise the dedup. Each
+# dispatch sleeps for --dispatch-ms to stand in for the work a real one does, so the numbers show what the pool buys
+# over dispatching one push at a time. Nothing here touches aws.
+
+
+def build_batch(template, sns_records, codecommit_records, duplicate_ratio, repos=4, seed=0):
+  rng = random.Random(seed)
+  outer_template = template['Records'][0]
+  inner_template = json.loads(outer_template['Sns']['Message'])['Records'][0]
+  pushes = []
+  records = []
+  for i in range(sns_records):
+    inner = []
+    for j in range(codecommit_records):
+      if pushes and rng.random() < duplicate_ratio:
+        repo, commit = rng.choice(pushes)
+      else:
+        repo, commit = 'repo-%d' % rng.randrange(repos), '%040x' % rng.getrandbits(160)
+        pushes.append((repo, commit))
+      record = copy.deepcopy(inner_template)
+      record['eventSourceARN'] = record['eventSourceARN'].rsplit(':', 1)[0] + ':' + repo
+      record['codecommit']['references'] = [{'commit': commit, 'ref': 'refs/heads/master'}]
+      inner.append(record)
+    outer = copy.deepcopy(outer_template)
+    outer['Sns']['MessageId'] = '%08x-0000-0000-0000-%012x' % (i, i)
+    outer['Sns']['Message'] = json.dumps({'Records': inner})
+    records.append(outer)
+  return {'Records': records}
+
+
+def run(event, workers, dispatch_seconds):
+  def dispatch(push):
+    time.sleep(dispatch_seconds)
+    return sns_sage_dispatch.clone_url(push['region'], push['repo'])
+
+  start = time.time()
+  counts = sns_sage_dispatch.process_batch(event, dispatch, workers, dispatch_cache.TTLCache(maxsize=100000))
+  elapsed = time.time() - start
+  return dict(counts, workers=workers, seconds=round(elapsed, 3),
+              pushes_per_second=round(counts['pushes'] / elapsed, 1))
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--template', default='sns_event.json')
+  parser.add_argument('--sns-records', type=int, default=100)
+  parser.add_argument('--codecommit-records', type=int, default=10)
+  parser.add_argument('--duplicate-ratio', type=float, default=0.3)
+  parser.add_argument('--dispatch-ms', type=float, default=20)
+  parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16])
+  args = parser.parse_args()
+
+  with open(args.template) as f:
+    template = json.load(f)
+  event = build_batch(template, args.sns_records, args.codecommit_records, args.duplicate_ratio)
+  for workers in args.workers:
+    print(json.dumps(run(event, workers, args.dispatch_ms / 1000.0)))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from bench_dispatch import BENCH_ENV
+
+# Fails when importing a lambda module (the part of a cold start that happens before the handler runs) costs more
+# than a budget. Each run imports the module in a fresh interpreter under python -X importtime and reads the module's
+# cumulative import time off stderr, so pycache and the interpreter's own startup aren't counted. The median of the
+# runs is held against --budget-ms, and any of --forbid showing up among the imports fails the check too: boto3 by
+# default, since sageDispatch builds its clients on first use and only pays for boto3 then.
+#
+#   python check_import_time.py                               # sageDispatch against the default budget
+#   python check_import_time.py --budget-ms 80 --runs 9 --top 15
+#
+# The environment is bench_dispatch's, so nothing here needs credentials or talks to aws, less the settings in
+# --unset (OUTPUT_BUCKET by default): a module that reads one of those at import fails the check instead of passing
+# because the benchmark happened to set it.
+
+DEFAULT_BUDGET_MS = 150
+
+
+# (depth, self us, cumulative us, name) for each line of -X importtime output, in the order python printed them. A
+# module's own imports come before it, one level deeper.
+def parse_importtime(stderr):
+  entries = []
+  for line in stderr.splitlines():
+    if not line.startswith('import time:'):
+      continue
+    fields = line[len('import time:'):].split('|')
+    if len(fields) != 3 or not fields[0].strip().isdigit():
+      continue
+    name = fields[2].rstrip()
+    depth = (len(name) - len(name.lstrip())) // 2
+    entries.append((depth, int(fields[0]), int(fields[1]), name.strip()))
+  return entries
+
+
+# The entry for module and everything it imported, or None if the interpreter had already imported it.
+def subtree(entries, module):
+  for i, (depth, _, _, name) in enumerate(entries):
+    if name == module:
+      start = i
+      while start > 0 and entries[start - 1][0] > depth:
+        start -= 1
+      return entries[start:i + 1]
+  return None
+
+
+def measure(module, env):
+  result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module], env=env,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+  if result.returncode != 0:
+    raise RuntimeError('importing %s failed:\n%s' % (module, result.stderr[-2000:]))
+  entries = subtree(parse_importtime(result.stderr), module)
+  if entries is None:
+    raise RuntimeError('-X importtime printed nothing for %s' % module)
+  return entries
+
+
+# The imports that cost the most under module itself, largest cumulative first.
+def top_imports(entries, count):
+  depth = entries[-1][0] + 1
+  children = [(cumulative, name) for d, _, cumulative, name in entries[:-1] if d == depth]
+  return [{'module': name, 'ms': round(cumulative / 1000.0, 1)} for cumulative, name in sorted(children, reverse=True)
+          [:count]]
+
+
+def check(module, budget_ms, runs, forbid, top, env):
+  measured = [measure(module, env) for _ in range(runs)]
+  import_ms = [entries[-1][2] / 1000.0 for entries in measured]
+  imported = set(name for entries in measured for _, _, _, name in entries)
+  report = {
+    'module': module,
+    'budget_ms': budget_ms,
+    'median_ms': round(statistics.median(import_ms), 1),
+    'runs_ms': [round(ms, 1) for ms in import_ms],
+    'forbidden_imports': sorted(name for name in forbid if name in imported),
+    'top_imports': top_imports(measured[-1], top)
+  }
+  report['ok'] = report['median_ms'] <= budget_ms and not report['forbidden_imports']
+  return report
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Check the import time of a lambda module against a budget.')
+  parser.add_argument('--module', default='sageDispatch')
+  parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS)
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--forbid', nargs='*', default=['boto3'], help='modules the import must not pull in')
+  parser.add_argument('--top', type=int, default=10, help='how many of the costliest imports to list')
+  parser.add_argument('--env', nargs='*', default=[], metavar='NAME=VALUE')
+  parser.add_argument('--unset', nargs='*', default=['OUTPUT_BUCKET'], metavar='NAME',
+                      help='settings the module must not need at import')
+  args = parser.parse_args()
+
+  env = dict(os.environ)
+  env.update(BENCH_ENV)
+  env.update(item.split('=', 1) for item in args.env)
+  for name in args.unset:
+    env.pop(name, None)
+  report = check(args.module, args.budget_ms, args.runs, args.forbid, args.top, env)
+  print(json.dumps(report, indent=2))
+  if not report['ok']:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,34 +1,384 @@
+import argparse
+import json
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
-import datetime
-client = boto3.client('sagemaker', region_name='us-west-2')
-
-project_name = 'census'
-environment = 'production'
-version = '1'
-deploy_name = project_name + "-" + environment
-variant = project_name + "-v" + version
-
-training_job_name = 'census-18-01-23-18-54'
-training_job = client.describe_training_job(TrainingJobName=training_job_name)
-training_tags = client.list_tags(ResourceArn=training_job['TrainingJobArn'])
-model = client.create_model(
-    ModelName=training_job['TrainingJobName'],
-    PrimaryContainer={
-        'Image': training_job['AlgorithmSpecification']['TrainingImage']
-    },
-    ExecutionRoleArn=training_job['RoleArn'],
-    Tags=training_tags['Tags'] 
-)
-endpoint_config = client.create_endpoint_config(
-    EndpointConfigName=variant,
-    ProductionVariants=[
-        {
-            'VariantName': variant,
-            'ModelName': training_job['TrainingJobName'],
-            'InitialInstanceCount': 1,
-            'InstanceType': 'ml.m4.xlarge'
+from botocore.exceptions import ClientError
+
+import aws_retry
+import endpoint_autoscaling
+import s3_urls
+
+# Deploys the model of a finished training job: a model, an endpoint config and an endpoint, created if the endpoint is
+# new and updated in place if it already exists. Several targets (environment and region pairs) are rolled out at the
+# same time, each with its own client.
+#
+# A model can only run an image from the ecr of its own region and reads its artifacts from s3 in that region, so a
+# target outside the training job's region gets the image from the same repository in its own region (which has to be
+# replicated there, e.g. with ecr replication, the image isn't copied) and a copy of model.tar.gz under the
+# --artifact-location given for that region. Both are checked before anything is created in the target region.
+#
+#   python deploy_model.py census-18-01-23-18-54 --target production:us-west-2 --target staging:us-east-1 \
+#     --artifact-location us-east-1=s3://census-models-us-east-1/models/
+#
+# Every step is timed and the report lists how long each one took per target, waiting included. With --max-capacity the
+# variant also gets a target tracking policy on invocations per instance once it's in service (see
+# endpoint_autoscaling.py).
+
+# Endpoint statuses that mean sagemaker is still working on it.
+PENDING_STATUSES = ('Creating', 'Updating', 'SystemUpdating', 'RollingBack')
+
+# <account>.dkr.ecr.<region>.amazonaws.com[.cn]/<repository>(:<tag>|@<digest>)
+ECR_IMAGE = re.compile(r'^(?P<account>\d+)\.dkr\.ecr\.(?P<region>[a-z0-9-]+)\.(?P<domain>amazonaws\.com(?:\.cn)?)/'
+                       r'(?P<repository>[^:@]+)(?:(?::(?P<tag>[^@]+))|(?:@(?P<digest>.+)))?$')
+
+
+class DeploymentFailed(Exception):
+  pass
+
+
+def regional_client(service, region):
+  return aws_retry.RetryingClient(boto3.client(service, region_name=region, config=aws_retry.client_config()),
+                                  aws_retry.RetryPolicy())
+
+
+def sagemaker_client(region):
+  return regional_client('sagemaker', region)
+
+
+# The same image in region's ecr, or image itself if it doesn't come from ecr.
+def regional_image(image, region):
+  match = ECR_IMAGE.match(image)
+  if match is None:
+    return image
+  return '%s.dkr.ecr.%s.%s/%s' % (match.group('account'), region, match.group('domain'),
+                                  image[match.start('repository'):])
+
+
+def image_exists(ecr_client, image):
+  match = ECR_IMAGE.match(image)
+  if match is None:
+    return True
+  image_id = {'imageDigest': match.group('digest')} if match.group('digest') else {
+    'imageTag': match.group('tag') or 'latest'}
+  try:
+    return bool(ecr_client.describe_images(registryId=match.group('account'), repositoryName=match.group('repository'),
+                                           imageIds=[image_id])['imageDetails'])
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('ImageNotFoundException', 'RepositoryNotFoundException'):
+      return False
+    raise
+
+
+def object_exists(s3_client, url):
+  bucket, key = s3_urls.split_s3_url(url)
+  try:
+    s3_client.head_object(Bucket=bucket, Key=key)
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+      return False
+    raise
+  return True
+
+
+def already_exists(error):
+  return (error.response['Error']['Code'] == 'ValidationException' and
+          'already exist' in error.response['Error']['Message'])
+
+
+class Deployment(object):
+
+  # Endpoints take minutes to come up, so polling starts at min_interval and backs off by multiplier up to
+  # max_interval. Every time the status changes it drops back to min_interval since the next change tends to follow
+  # quickly (an update going from Updating to InService after RollingBack, say).
+  #
+  # source_region is where the training job ran. A deployment to any other region needs ecr_client and s3_client for
+  # its own region and an artifact_location there (an s3 url of a prefix) to copy the model artifacts to. tags are the
+  # training job's, which only the source region's client can list, so they're looked up once and handed in.
+  def __init__(self, client, training_job, environment, region=None, tags=(), project_name='census', version='1',
+               instance_type='ml.m4.xlarge', instance_count=1, scaling=None, autoscaling_client=None, min_interval=5.0,
+               max_interval=60.0, multiplier=1.5, timeout=3600, clock=time.time, sleep=time.sleep, source_region=None,
+               ecr_client=None, s3_client=None, artifact_location=None):
+    self.client = client
+    self.training_job = training_job
+    self.environment = environment
+    self.region = region
+    self.tags = list(tags)
+    self.source_region = source_region
+    self.ecr_client = ecr_client
+    self.s3_client = s3_client
+    self.artifact_location = artifact_location
+    self.image = training_job['AlgorithmSpecification']['TrainingImage']
+    self.model_data_url = training_job['ModelArtifacts']['S3ModelArtifacts']
+    self.project_name = project_name
+    self.version = version
+    self.instance_type = instance_type
+    self.instance_count = instance_count
+    self.scaling = scaling
+    self.autoscaling_client = autoscaling_client
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.multiplier = multiplier
+    self.timeout = timeout
+    self.clock = clock
+    self.sleep = sleep
+    self.timings = {}
+    self.polls = 0
+
+  @property
+  def endpoint_name(self):
+    return self.project_name + '-' + self.environment
+
+  @property
+  def variant_name(self):
+    return self.project_name + '-v' + self.version
+
+  # Endpoint configs can't be changed, so every deployment gets its own, named after the endpoint and the model.
+  @property
+  def endpoint_config_name(self):
+    return (self.endpoint_name + '-' + self.training_job['TrainingJobName'])[:63].rstrip('-')
+
+  def _timed(self, step, func, *args):
+    start = self.clock()
+    try:
+      return func(*args)
+    finally:
+      self.timings[step] = round(self.clock() - start, 3)
+
+  @property
+  def cross_region(self):
+    return self.region is not None and self.source_region is not None and self.region != self.source_region
+
+  # Points the model at the image and artifacts in the target region, copying the artifacts over if they aren't there
+  # yet. The copy is named after the training job, whose artifacts never change, so one that's there is up to date.
+  def localize_artifacts(self):
+    if not self.cross_region:
+      return
+    if self.ecr_client is None or self.s3_client is None or not self.artifact_location:
+      raise DeploymentFailed('deploying to %s from %s needs an artifact location in %s' % (
+        self.region, self.source_region, self.region))
+    image = regional_image(self.image, self.region)
+    if not image_exists(self.ecr_client, image):
+      raise DeploymentFailed('%s does not exist, replicate the image to %s first' % (image, self.region))
+    source_bucket, source_key = s3_urls.split_s3_url(self.model_data_url)
+    model_data_url = '%s%s/%s' % (self.artifact_location, self.training_job['TrainingJobName'],
+                                  source_key.split('/')[-1])
+    if not object_exists(self.s3_client, model_data_url):
+      bucket, key = s3_urls.split_s3_url(model_data_url)
+      self.s3_client.copy({'Bucket': source_bucket, 'Key': source_key}, bucket, key)
+      if not object_exists(self.s3_client, model_data_url):
+        raise DeploymentFailed('copying %s to %s did not leave anything there' % (self.model_data_url, model_data_url))
+    self.image = image
+    self.model_data_url = model_data_url
+
+  def create_model(self, tags):
+    try:
+      self.client.create_model(
+        ModelName=self.training_job['TrainingJobName'],
+        PrimaryContainer={
+          'Image': self.image,
+          'ModelDataUrl': self.model_data_url
         },
-    ],
-    Tags=training_tags['Tags']
-)
-print endpoint_config 
+        ExecutionRoleArn=self.training_job['RoleArn'],
+        Tags=tags
+      )
+    except ClientError as e:
+      if not already_exists(e):
+        raise
+
+  def create_endpoint_config(self, tags):
+    try:
+      self.client.create_endpoint_config(
+        EndpointConfigName=self.endpoint_config_name,
+        ProductionVariants=[
+          {
+            'VariantName': self.variant_name,
+            'ModelName': self.training_job['TrainingJobName'],
+            'InitialInstanceCount': self.instance_count,
+            'InstanceType': self.instance_type
+          },
+        ],
+        Tags=tags
+      )
+    except ClientError as e:
+      if not already_exists(e):
+        raise
+
+  def describe_endpoint(self):
+    try:
+      return self.client.describe_endpoint(EndpointName=self.endpoint_name)
+    except ClientError as e:
+      if e.response['Error']['Code'] == 'ValidationException' and 'Could not find' in e.response['Error']['Message']:
+        return None
+      raise
+
+  def create_or_update_endpoint(self, tags):
+    endpoint = self.describe_endpoint()
+    if endpoint is None:
+      self.client.create_endpoint(EndpointName=self.endpoint_name, EndpointConfigName=self.endpoint_config_name,
+                                  Tags=tags)
+      return 'created'
+    if endpoint['EndpointConfigName'] == self.endpoint_config_name:
+      return 'unchanged'
+    # An endpoint that's still being created or updated refuses updates, so let the last change finish first.
+    if endpoint['EndpointStatus'] in PENDING_STATUSES:
+      self.wait_until_settled()
+    self.client.update_endpoint(EndpointName=self.endpoint_name, EndpointConfigName=self.endpoint_config_name)
+    return 'updated'
+
+  def wait_until_settled(self):
+    interval = self.min_interval
+    deadline = self.clock() + self.timeout
+    status = None
+    while True:
+      self.polls += 1
+      endpoint = self.client.describe_endpoint(EndpointName=self.endpoint_name)
+      if endpoint['EndpointStatus'] not in PENDING_STATUSES:
+        return endpoint
+      if endpoint['EndpointStatus'] != status:
+        status = endpoint['EndpointStatus']
+        interval = self.min_interval
+      if self.clock() + interval > deadline:
+        raise DeploymentFailed('%s is still %s after %ss' % (self.endpoint_name, status, self.timeout))
+      self.sleep(interval)
+      interval = min(self.max_interval, interval * self.multiplier)
+
+  # A failed update rolls back and leaves the endpoint InService on its previous config, so InService alone isn't
+  # enough to call it a success.
+  def wait_in_service(self):
+    endpoint = self.wait_until_settled()
+    if endpoint['EndpointStatus'] != 'InService':
+      raise DeploymentFailed('%s is %s: %s' % (self.endpoint_name, endpoint['EndpointStatus'],
+                                               endpoint.get('FailureReason', 'no reason given')))
+    if endpoint['EndpointConfigName'] != self.endpoint_config_name:
+      raise DeploymentFailed('%s rolled back to %s: %s' % (self.endpoint_name, endpoint['EndpointConfigName'],
+                                                           endpoint.get('FailureReason', 'no reason given')))
+    return endpoint
+
+  def run(self):
+    start = self.clock()
+    report = {
+      'environment': self.environment,
+      'region': self.region,
+      'endpoint': self.endpoint_name,
+      'endpoint_config': self.endpoint_config_name,
+      'timings': self.timings
+    }
+    try:
+      self._timed('localize_artifacts', self.localize_artifacts)
+      report['image'] = self.image
+      report['model_data_url'] = self.model_data_url
+      self._timed('create_model', self.create_model, self.tags)
+      self._timed('create_endpoint_config', self.create_endpoint_config, self.tags)
+      report['action'] = self._timed('create_or_update_endpoint', self.create_or_update_endpoint, self.tags)
+      endpoint = self._timed('wait_in_service', self.wait_in_service)
+      report['status'] = endpoint['EndpointStatus']
+      report['endpoint_arn'] = endpoint['EndpointArn']
+      if self.scaling is not None:
+        report['scaling_policy_arn'] = self._timed('register_autoscaling', self.scaling.register,
+                                                   self.autoscaling_client, self.endpoint_name, self.variant_name)
+    except Exception as e:
+      report['status'] = 'Failed'
+      report['error'] = str(e)
+    report['polls'] = self.polls
+    report['seconds'] = round(self.clock() - start, 3)
+    return report
+
+
+# Rolls one training job out to every target, all at once. targets is a list of (environment, region) pairs; the
+# training job is looked up in source_region (the first target's region by default) and client_factory makes the
+# sagemaker client for a region, which is where a stub goes when testing (autoscaling_client_factory likewise, for when
+# a scaling config is passed, and regional_client_factory for the ecr and s3 clients of regions other than the
+# source). artifact_locations maps each of those other regions to the s3 prefix the model artifacts are copied to.
+# Returns one report per target, in order.
+def deploy(training_job_name, targets, source_region=None, client_factory=sagemaker_client,
+           autoscaling_client_factory=endpoint_autoscaling.autoscaling_client, regional_client_factory=regional_client,
+           artifact_locations=None, workers=None, scaling=None, **options):
+  source_region = source_region or targets[0][1]
+  artifact_locations = artifact_locations or {}
+  clients = {}
+  autoscaling_clients = {}
+  regional_clients = {}
+  for region in set([source_region] + [region for _, region in targets]):
+    clients[region] = client_factory(region)
+    if scaling is not None:
+      autoscaling_clients[region] = autoscaling_client_factory(region)
+    if region != source_region:
+      regional_clients[region] = (regional_client_factory('ecr', region), regional_client_factory('s3', region))
+  start = time.time()
+  training_job = clients[source_region].describe_training_job(TrainingJobName=training_job_name)
+  describe_seconds = round(time.time() - start, 3)
+  if training_job['TrainingJobStatus'] != 'Completed':
+    raise DeploymentFailed('%s is %s, only completed training jobs can be deployed' % (
+      training_job_name, training_job['TrainingJobStatus']))
+  start = time.time()
+  tags = clients[source_region].list_tags(ResourceArn=training_job['TrainingJobArn'])['Tags']
+  tags_seconds = round(time.time() - start, 3)
+
+  deployments = [Deployment(clients[region], training_job, environment, region, tags, scaling=scaling,
+                            autoscaling_client=autoscaling_clients.get(region), source_region=source_region,
+                            ecr_client=regional_clients.get(region, (None, None))[0],
+                            s3_client=regional_clients.get(region, (None, None))[1],
+                            artifact_location=artifact_locations.get(region), **options)
+                 for environment, region in targets]
+  with ThreadPoolExecutor(max_workers=workers or len(deployments)) as pool:
+    reports = list(pool.map(lambda deployment: deployment.run(), deployments))
+  for report in reports:
+    report['timings']['describe_training_job'] = describe_seconds
+    report['timings']['list_tags'] = tags_seconds
+  return reports
+
+
+def parse_target(value):
+  environment, _, region = value.partition(':')
+  return environment, region or None
+
+
+def parse_artifact_location(value):
+  region, _, url = value.partition('=')
+  if not region or not url.startswith('s3://'):
+    raise argparse.ArgumentTypeError('expected region=s3://bucket/prefix/, not %r' % value)
+  return region, url if url.endswith('/') else url + '/'
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Deploy the model of a training job to one or more endpoints.')
+  parser.add_argument('training_job_name')
+  parser.add_argument('--target', action='append', type=parse_target, required=True,
+                      help='environment[:region], may be given more than once')
+  parser.add_argument('--source-region', help='region of the training job, defaults to the first target region')
+  parser.add_argument('--artifact-location', action='append', type=parse_artifact_location, default=[],
+                      help='region=s3://bucket/prefix/ to copy the model artifacts to for targets in that region')
+  parser.add_argument('--project-name', default='census')
+  parser.add_argument('--version', default='1')
+  parser.add_argument('--instance-type', default='ml.m4.xlarge')
+  parser.add_argument('--instance-count', type=int, default=1)
+  parser.add_argument('--timeout', type=int, default=3600, help='seconds to wait for each endpoint')
+  parser.add_argument('--max-capacity', type=int, help='autoscale each variant up to this many instances')
+  parser.add_argument('--min-capacity', type=int, default=1)
+  parser.add_argument('--target-invocations', type=float, default=1000,
+                      help='invocations per instance per minute the scaling policy aims for')
+  parser.add_argument('--scale-in-cooldown', type=int, default=300)
+  parser.add_argument('--scale-out-cooldown', type=int, default=60)
+  args = parser.parse_args()
+
+  scaling = None
+  if args.max_capacity:
+    scaling = endpoint_autoscaling.ScalingConfig(args.min_capacity, args.max_capacity, args.target_invocations,
+                                                 args.scale_in_cooldown, args.scale_out_cooldown)
+
+  default_region = boto3.session.Session().region_name or 'us-west-2'
+  targets = [(environment, region or default_region) for environment, region in args.target]
+  reports = deploy(args.training_job_name, targets, source_region=args.source_region,
+                   artifact_locations=dict(args.artifact_location), project_name=args.project_name,
+                   version=args.version, instance_type=args.instance_type, instance_count=args.instance_count,
+                   timeout=args.timeout, scaling=scaling)
+  print(json.dumps(reports, indent=2))
+  if any(report['status'] == 'Failed' for report in reports):
+    raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
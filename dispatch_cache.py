@@ -0,0 +1,48 @@
+import collections
+import threading
+import time
+
+
+# Small in-process cache for the dispatch lambda. It lives at module scope so warm containers keep whatever the last
+# invocation looked up. Entries are evicted least recently used first once maxsize is reached and are treated as
+# missing once they are older than ttl seconds (ttl=None means they never expire).
+class TTLCache(object):
+
+  def __init__(self, maxsize=128, ttl=None, clock=time.time):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.clock = clock
+    self.hits = 0
+    self.misses = 0
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None or (self.ttl is not None and self.clock() - entry[0] > self.ttl):
+        self.misses += 1
+        return default
+      self._entries[key] = entry
+      self.hits += 1
+      return entry[1]
+
+  def put(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (self.clock(), value)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self.hits = 0
+      self.misses = 0
+
+  def stats(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+  def __len__(self):
+    return len(self._entries)
@@ -0,0 +1,161 @@
+import json
+import sys
+import threading
+import time
+
+# Per invocation timings for the dispatch lambda, written out as one CloudWatch embedded metric format record at the
+# end of the invocation. Lambda ships whatever the function prints to CloudWatch Logs, which turns the record into
+# metrics (one per phase, in milliseconds, plus the counters) and keeps the rest of it searchable in Logs Insights.
+#
+#   with metrics.phase('get_manifest'):
+#     manifest = get_manifest_dictionary(artifacts)
+#
+# A phase that runs more than once in an invocation, or on several threads at once, adds up, so the version lookups
+# run side by side can come to more than the lookups phase around them. With no sink (METRICS_SINK=off) phase() hands
+# back a shared do-nothing context manager and the counters return straight away.
+
+UNITS = {'bytes_downloaded': 'Bytes'}
+
+
+class _NoopSpan(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class _Span(object):
+
+  def __init__(self, recorder, name):
+    self.recorder = recorder
+    self.name = name
+
+  def __enter__(self):
+    self.start = self.recorder.clock()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.recorder.add_duration(self.name, self.recorder.clock() - self.start)
+    return False
+
+
+class StdoutSink(object):
+
+  def emit(self, record):
+    sys.stdout.write(json.dumps(record, separators=(',', ':')) + '\n')
+    sys.stdout.flush()
+
+
+# Appends one json line per record, for running the handler locally and reading the records back.
+class FileSink(object):
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+
+  def emit(self, record):
+    with self._lock, open(self.path, 'a') as f:
+      f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class MemorySink(object):
+
+  def __init__(self):
+    self.records = []
+
+  def emit(self, record):
+    self.records.append(record)
+
+
+# off (or empty), stdout or file:<path>.
+def sink_from_env(value):
+  if not value or value == 'off':
+    return None
+  if value == 'stdout':
+    return StdoutSink()
+  if value.startswith('file:'):
+    return FileSink(value[len('file:'):])
+  raise ValueError('METRICS_SINK has to be off, stdout or file:<path>, not %r' % value)
+
+
+class Recorder(object):
+
+  def __init__(self, namespace, sink=None, dimensions=None, clock=time.perf_counter, wall_clock=time.time):
+    self.namespace = namespace
+    self.sink = sink
+    self.dimensions = dimensions or {}
+    self.clock = clock
+    self.wall_clock = wall_clock
+    self.invocations = 0
+    self._lock = threading.Lock()
+    self._reset()
+
+  def _reset(self):
+    self.durations = {}
+    self.counters = {}
+    self.properties = {}
+
+  @property
+  def enabled(self):
+    return self.sink is not None
+
+  # Called at the top of every invocation. The first one in a container is the cold start.
+  def start(self, **properties):
+    with self._lock:
+      self._reset()
+      self.invocations += 1
+      self.properties.update(properties)
+
+  def phase(self, name):
+    if self.sink is None:
+      return NOOP_SPAN
+    return _Span(self, name)
+
+  def add_duration(self, name, seconds):
+    with self._lock:
+      self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+  def add(self, name, value=1):
+    if self.sink is None:
+      return
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def set(self, name, value):
+    if self.sink is None:
+      return
+    with self._lock:
+      self.properties[name] = value
+
+  def record(self):
+    with self._lock:
+      values = dict((name, round(seconds * 1000.0, 3)) for name, seconds in self.durations.items())
+      values.update(self.counters)
+      values['cold_start'] = 1 if self.invocations == 1 else 0
+      metrics = [{'Name': name, 'Unit': 'Milliseconds' if name in self.durations else UNITS.get(name, 'Count')}
+                 for name in sorted(values)]
+      record = dict(self.properties)
+      record.update(self.dimensions)
+      record.update(values)
+      record['_aws'] = {
+        'Timestamp': int(self.wall_clock() * 1000),
+        'CloudWatchMetrics': [{
+          'Namespace': self.namespace,
+          'Dimensions': [sorted(self.dimensions)],
+          'Metrics': metrics
+        }]
+      }
+      return record
+
+  # Writes the invocation's record to the sink and returns it (None when disabled).
+  def flush(self):
+    if self.sink is None:
+      return None
+    record = self.record()
+    self.sink.emit(record)
+    return record
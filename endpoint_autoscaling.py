@@ -0,0 +1,223 @@
+import argparse
+import datetime
+import json
+import math
+
+import boto3
+
+import aws_retry
+
+# Target tracking on SageMakerVariantInvocationsPerInstance for endpoint variants, and a simulator that replays a
+# recorded invocation rate curve through the same rules to show what a policy would have done with it.
+#
+#   python endpoint_autoscaling.py record census-production census-v1 --days 7 > curve.json
+#   python endpoint_autoscaling.py simulate curve.json --min-capacity 1 --max-capacity 6 --target 1000
+
+SCALABLE_DIMENSION = 'sagemaker:variant:DesiredInstanceCount'
+METRIC = 'SageMakerVariantInvocationsPerInstance'
+
+# How application auto scaling's target tracking alarms behave: scale out after 3 one minute datapoints over the
+# target, scale in after 15 datapoints under 90% of it.
+SCALE_OUT_DATAPOINTS = 3
+SCALE_IN_DATAPOINTS = 15
+SCALE_IN_THRESHOLD = 0.9
+
+
+def resource_id(endpoint_name, variant_name):
+  return 'endpoint/%s/variant/%s' % (endpoint_name, variant_name)
+
+
+def autoscaling_client(region):
+  return aws_retry.RetryingClient(
+    boto3.client('application-autoscaling', region_name=region, config=aws_retry.client_config()),
+    aws_retry.RetryPolicy())
+
+
+class ScalingConfig(object):
+
+  # target_invocations is invocations per instance per minute, the unit of SageMakerVariantInvocationsPerInstance.
+  # Cooldowns are in seconds.
+  def __init__(self, min_capacity=1, max_capacity=4, target_invocations=1000, scale_in_cooldown=300,
+               scale_out_cooldown=60):
+    if not 1 <= min_capacity <= max_capacity:
+      raise ValueError('capacity has to satisfy 1 <= min_capacity <= max_capacity')
+    self.min_capacity = min_capacity
+    self.max_capacity = max_capacity
+    self.target_invocations = target_invocations
+    self.scale_in_cooldown = scale_in_cooldown
+    self.scale_out_cooldown = scale_out_cooldown
+
+  def policy_name(self, endpoint_name, variant_name):
+    return '%s-%s-invocations' % (endpoint_name, variant_name)
+
+  def target_tracking_configuration(self):
+    return {
+      'TargetValue': float(self.target_invocations),
+      'PredefinedMetricSpecification': {'PredefinedMetricType': METRIC},
+      'ScaleInCooldown': self.scale_in_cooldown,
+      'ScaleOutCooldown': self.scale_out_cooldown
+    }
+
+  # Registering again with different numbers updates the existing target and policy in place.
+  def register(self, client, endpoint_name, variant_name):
+    client.register_scalable_target(
+      ServiceNamespace='sagemaker',
+      ResourceId=resource_id(endpoint_name, variant_name),
+      ScalableDimension=SCALABLE_DIMENSION,
+      MinCapacity=self.min_capacity,
+      MaxCapacity=self.max_capacity
+    )
+    response = client.put_scaling_policy(
+      PolicyName=self.policy_name(endpoint_name, variant_name),
+      ServiceNamespace='sagemaker',
+      ResourceId=resource_id(endpoint_name, variant_name),
+      ScalableDimension=SCALABLE_DIMENSION,
+      PolicyType='TargetTrackingScaling',
+      TargetTrackingScalingPolicyConfiguration=self.target_tracking_configuration()
+    )
+    return response['PolicyARN']
+
+
+# Replays invocations per minute (one value per period seconds) against a policy. Instances added by a scale out only
+# start taking traffic provisioning_seconds later, which is what makes an undersized max_capacity or a slow scale out
+# show up as minutes over target. Returns the per period timeline and a summary next to a fixed fleet of
+# initial_instances (min_capacity by default) for comparison.
+def simulate(values, config, period=60, provisioning_seconds=420, initial_instances=None):
+  initial_instances = initial_instances or config.min_capacity
+  desired = in_service = initial_instances
+  pending = []
+  over = under = 0
+  last_scale_out = last_scale_in = None
+  timeline = []
+  summary = {
+    'periods': len(values),
+    'instance_hours': 0.0,
+    'peak_instances': in_service,
+    'scale_outs': 0,
+    'scale_ins': 0,
+    'periods_over_target': 0,
+    'max_invocations_per_instance': 0.0,
+    'fixed_fleet_instances': initial_instances,
+    'fixed_fleet_instance_hours': round(initial_instances * len(values) * period / 3600.0, 2),
+    'fixed_fleet_periods_over_target': 0
+  }
+  for step, invocations in enumerate(values):
+    now = step * period
+    in_service += sum(count for ready, count in pending if ready <= now)
+    pending = [(ready, count) for ready, count in pending if ready > now]
+
+    per_minute = invocations * 60.0 / period
+    per_instance = per_minute / in_service
+    over = over + 1 if per_instance > config.target_invocations else 0
+    under = under + 1 if per_instance < config.target_invocations * SCALE_IN_THRESHOLD else 0
+    wanted = min(config.max_capacity, max(config.min_capacity,
+                                          int(math.ceil(per_minute / config.target_invocations))))
+    action = None
+    if over >= SCALE_OUT_DATAPOINTS and wanted > desired and (
+        last_scale_out is None or now - last_scale_out >= config.scale_out_cooldown):
+      pending.append((now + provisioning_seconds, wanted - desired))
+      desired = wanted
+      last_scale_out = now
+      summary['scale_outs'] += 1
+      action = 'scale out to %d' % desired
+    elif under >= SCALE_IN_DATAPOINTS and wanted < desired and all(
+        last is None or now - last >= config.scale_in_cooldown for last in (last_scale_in, last_scale_out)):
+      removed = min(desired - wanted, in_service - config.min_capacity)
+      if removed > 0:
+        desired -= removed
+        in_service -= removed
+        last_scale_in = now
+        summary['scale_ins'] += 1
+        action = 'scale in to %d' % desired
+        under = 0
+
+    timeline.append({'second': now, 'invocations_per_minute': round(per_minute, 1), 'in_service': in_service,
+                     'desired': desired, 'invocations_per_instance': round(per_instance, 1), 'action': action})
+    summary['instance_hours'] += in_service * period / 3600.0
+    summary['peak_instances'] = max(summary['peak_instances'], desired)
+    summary['max_invocations_per_instance'] = max(summary['max_invocations_per_instance'], round(per_instance, 1))
+    if per_instance > config.target_invocations:
+      summary['periods_over_target'] += 1
+    if per_minute / initial_instances > config.target_invocations:
+      summary['fixed_fleet_periods_over_target'] += 1
+  summary['instance_hours'] = round(summary['instance_hours'], 2)
+  return timeline, summary
+
+
+# Invocations of a variant per period from cloudwatch, oldest first, in the format simulate and the cli read back.
+# get_metric_statistics returns at most 1440 datapoints per call so the range is fetched a day at a time.
+def record_curve(cloudwatch, endpoint_name, variant_name, start, end, period=60):
+  values = []
+  chunk = datetime.timedelta(seconds=period * 1440)
+  chunk_start = start
+  while chunk_start < end:
+    chunk_end = min(end, chunk_start + chunk)
+    response = cloudwatch.get_metric_statistics(
+      Namespace='AWS/SageMaker',
+      MetricName='Invocations',
+      Dimensions=[{'Name': 'EndpointName', 'Value': endpoint_name}, {'Name': 'VariantName', 'Value': variant_name}],
+      StartTime=chunk_start,
+      EndTime=chunk_end,
+      Period=period,
+      Statistics=['Sum']
+    )
+    sums = dict((point['Timestamp'].replace(tzinfo=None), point['Sum']) for point in response['Datapoints'])
+    slot = chunk_start
+    while slot < chunk_end:
+      values.append(sums.get(slot, 0.0))
+      slot += datetime.timedelta(seconds=period)
+    chunk_start = chunk_end
+  return {'endpoint': endpoint_name, 'variant': variant_name, 'start': start.isoformat(), 'period': period,
+          'values': values}
+
+
+def load_curve(path):
+  with open(path) as f:
+    curve = json.load(f)
+  if isinstance(curve, list):
+    return {'period': 60, 'values': curve}
+  return curve
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Record endpoint traffic and replay it against a scaling policy.')
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+
+  record = commands.add_parser('record', help='write the invocation curve of a variant as json')
+  record.add_argument('endpoint')
+  record.add_argument('variant')
+  record.add_argument('--days', type=float, default=1)
+  record.add_argument('--period', type=int, default=60)
+  record.add_argument('--region')
+
+  replay = commands.add_parser('simulate', help='replay a recorded curve against a target tracking policy')
+  replay.add_argument('curve', help='json from record, or a plain list of invocations per minute')
+  replay.add_argument('--min-capacity', type=int, default=1)
+  replay.add_argument('--max-capacity', type=int, default=4)
+  replay.add_argument('--target', type=float, default=1000, help='invocations per instance per minute')
+  replay.add_argument('--scale-in-cooldown', type=int, default=300)
+  replay.add_argument('--scale-out-cooldown', type=int, default=60)
+  replay.add_argument('--provisioning-seconds', type=int, default=420)
+  replay.add_argument('--timeline', action='store_true', help='print every period, not just the scaling actions')
+  args = parser.parse_args()
+
+  if args.command == 'record':
+    cloudwatch = boto3.client('cloudwatch', region_name=args.region)
+    end = datetime.datetime.utcnow().replace(second=0, microsecond=0)
+    start = end - datetime.timedelta(days=args.days)
+    print(json.dumps(record_curve(cloudwatch, args.endpoint, args.variant, start, end, args.period)))
+    return
+
+  curve = load_curve(args.curve)
+  config = ScalingConfig(args.min_capacity, args.max_capacity, args.target, args.scale_in_cooldown,
+                         args.scale_out_cooldown)
+  timeline, summary = simulate(curve['values'], config, curve.get('period', 60), args.provisioning_seconds)
+  for entry in timeline:
+    if args.timeline or entry['action']:
+      print(json.dumps(entry))
+  print(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -1,9 +1,19 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import endpoint_autoscaling
+import nested_stacks
 from troposphere.constants import NUMBER
-from troposphere import Output, Ref, Template, Parameter, GetAtt, Join
+from troposphere import Output, Ref, Template, Parameter, GetAtt, Join, If, Equals
 from troposphere.kms import Key
 from troposphere.s3 import Bucket, ServerSideEncryptionByDefault, BucketEncryption, ServerSideEncryptionRule, VersioningConfiguration
 from troposphere.codecommit import Repository
-from troposphere.awslambda import Function, Code, MEMORY_VALUES, Environment as Lambda_Environment
+from troposphere.awslambda import Function, Code, MEMORY_VALUES, Environment as Lambda_Environment, Permission
 from troposphere.iam import Role, Policy
 from troposphere.codepipeline import (
     Pipeline, Stages, Actions, ActionTypeID, OutputArtifacts, InputArtifacts,
@@ -11,6 +21,8 @@ from troposphere.codepipeline import (
 from troposphere.codebuild import Project, Artifacts, Environment, Source
 from troposphere.ecr import Repository as Docker_Repo
 from troposphere.events import Rule, Target
+from troposphere.applicationautoscaling import (
+    ScalableTarget, ScalingPolicy, TargetTrackingScalingPolicyConfiguration, PredefinedMetricSpecification)
 
 # So listen - if this thing ever sees the insides of a production account you'll want to check out deletionpolicy
 # attributes. I haven't enabled them for things like the codecommit repo or the ecr registry as i'm constantly tearing
@@ -21,724 +33,1055 @@ from troposphere.events import Rule, Target
 # account number. In additional you'll have to get your hands on the lambda code that submits the training job which here
 # is referred to as sageDispatch. It is contained in this same github repo. Just shove it into a s3 bucket and make
 # certain that the bucket is referred to in the "lambda_function_bucket" variable.
+#
+# Every value in DEFAULT_CONFIG becomes the default of the matching cloudformation parameter. build_pipeline_template
+# takes a dict that overrides any of them, so one checkout can render templates for several projects:
+#
+#   python hydrate.py                                  # writes pipeline.json from DEFAULT_CONFIG
+#   python hydrate.py projects/*.json --out-dir out/   # one template per project config, rendered in parallel
+DEFAULT_CONFIG = {
+    'projectname': 'mlworkflow',
+    'region': 'us-west-2',
+    'inputbucket': 'inputbucket',
+    'outputbucket': 'outputbucket',
+    'pipelinename': 'pipeline',
+    'reponame': 'mlrepo',
+    'mldockerregistryname': 'mldockerrepo',
+    'lambdafunctionbucket': 'lambdabucket',
+    'loglevel': 'WARNING',
+    'projectkmskey': 'kmskey',
+    'buildcomputetype': 'BUILD_GENERAL1_SMALL',
+    'buildimage': 'aws/codebuild/standard:7.0',
+    'buildcachetype': 'LOCAL'
+}
+
+# Tag the build stage pushes alongside the commit id. It always points at the image of the last commit that was built
+# and every build starts from its layers (see BUILDSPEC).
+BUILD_CACHE_TAG = 'buildcache'
+
+# The buildspec.yml the build stage expects in the root of the model repo, next to the Dockerfile. hydrate.py writes it
+# out next to the template so it can be copied over.
+#
+# The image is pushed with two tags: the commit id, which is what sageDispatch trains with, and the rolling cache tag.
+# Each build hands the cache tag (the previous commit's image) to --cache-from so only the layers from the first
+# changed Dockerfile instruction on get rebuilt. With the LOCAL build cache those layers are usually still on the build
+# host as well; the S3 build cache only keeps the paths listed under cache.
+BUILDSPEC = '''version: 0.2
+
+env:
+  variables:
+    DOCKER_BUILDKIT: "1"
+
+phases:
+  pre_build:
+    commands:
+      - REPOSITORY_URI=$AWS_ACCOUNT_ID.dkr.ecr.$AWS_DEFAULT_REGION.amazonaws.com/$IMAGE_REPO_NAME
+      - COMMIT_ID=$CODEBUILD_RESOLVED_SOURCE_VERSION
+      - aws ecr get-login-password --region $AWS_DEFAULT_REGION | docker login --username AWS --password-stdin $AWS_ACCOUNT_ID.dkr.ecr.$AWS_DEFAULT_REGION.amazonaws.com
+      - docker pull $REPOSITORY_URI:$CACHE_TAG || true
+  build:
+    commands:
+      - docker build --cache-from $REPOSITORY_URI:$CACHE_TAG --build-arg BUILDKIT_INLINE_CACHE=1 -t $REPOSITORY_URI:$COMMIT_ID .
+      - docker tag $REPOSITORY_URI:$COMMIT_ID $REPOSITORY_URI:$CACHE_TAG
+  post_build:
+    commands:
+      - docker push $REPOSITORY_URI:$COMMIT_ID
+      - docker push $REPOSITORY_URI:$CACHE_TAG
+
+# Only used with the S3 build cache. Add anything the build downloads outside of docker, e.g.
+#   - '/root/.cache/pip/**/*'
+cache:
+  paths: []
+'''
+
+
+# Endpoints this template should autoscale, none by default. Each entry of a project config's "autoscaled_endpoints"
+# list names an endpoint and variant and can override any of these. The endpoint has to exist before the stack is
+# deployed (deploy_model.py creates them), and deploy_model.py --max-capacity does the same thing without the template.
+AUTOSCALING_DEFAULTS = {
+    'min_capacity': 1,
+    'max_capacity': 4,
+    'target_invocations': 1000,
+    'scale_in_cooldown': 300,
+    'scale_out_cooldown': 60
+}
+
+
+def add_endpoint_autoscaling(t, endpoint):
+    endpoint = dict(AUTOSCALING_DEFAULTS, **endpoint)
+    scaling = endpoint_autoscaling.ScalingConfig(endpoint['min_capacity'], endpoint['max_capacity'],
+                                                 endpoint['target_invocations'], endpoint['scale_in_cooldown'],
+                                                 endpoint['scale_out_cooldown'])
+    tracking = scaling.target_tracking_configuration()
+    name = ''.join(c for c in endpoint['endpoint'] + endpoint['variant'] if c.isalnum())
+    target = t.add_resource(ScalableTarget(
+        name + 'ScalableTarget',
+        MinCapacity=scaling.min_capacity,
+        MaxCapacity=scaling.max_capacity,
+        ResourceId=endpoint_autoscaling.resource_id(endpoint['endpoint'], endpoint['variant']),
+        RoleARN=Join('', ['arn:aws:iam::', Ref('accountparameter'), ':role/aws-service-role/',
+                          'sagemaker.application-autoscaling.amazonaws.com/',
+                          'AWSServiceRoleForApplicationAutoScaling_SageMakerEndpoint']),
+        ScalableDimension=endpoint_autoscaling.SCALABLE_DIMENSION,
+        ServiceNamespace='sagemaker'
+    ))
+    t.add_resource(ScalingPolicy(
+        name + 'ScalingPolicy',
+        PolicyName=scaling.policy_name(endpoint['endpoint'], endpoint['variant']),
+        PolicyType='TargetTrackingScaling',
+        ScalingTargetId=Ref(target),
+        TargetTrackingScalingPolicyConfiguration=TargetTrackingScalingPolicyConfiguration(
+            PredefinedMetricSpecification=PredefinedMetricSpecification(
+                **tracking['PredefinedMetricSpecification']),
+            TargetValue=tracking['TargetValue'],
+            ScaleInCooldown=tracking['ScaleInCooldown'],
+            ScaleOutCooldown=tracking['ScaleOutCooldown'])
+    ))
+
+
+# The stages of the pipeline and the actions in them. Stages run one after another. Within a stage every action starts
+# straight away unless it lists actions of the same stage in "after", so independent actions (the image build and the
+# manifest check here) run side by side. Configuration values are plain cloudformation json, so a project config can
+# replace the whole graph with a "stages" entry.
+PIPELINE_STAGES = [
+    {'name': 'Source', 'actions': [
+        {'name': 'Source', 'type': 'codecommit',
+         'configuration': {"PollForSourceChanges": "false", "BranchName": "master",
+                           "RepositoryName": {'Ref': 'reponameparameter'}},
+         'outputs': ['source_action_output']}
+    ]},
+    {'name': 'Build', 'actions': [
+        {'name': 'Build', 'type': 'codebuild',
+         'configuration': {"ProjectName": {'Ref': 'build'}},
+         'inputs': ['source_action_output'],
+         'outputs': ['build_action_output']},
+        {'name': 'ValidateManifest', 'type': 'lambda',
+         'configuration': {"FunctionName": 'manifestValidator'},
+         'inputs': ['source_action_output']}
+    ]},
+    {'name': 'Train', 'actions': [
+        {'name': 'Train', 'type': 'lambda',
+         'configuration': {"FunctionName": 'sageDispatch'},
+         'inputs': ['source_action_output']}
+    ]}
+]
+
+# Category and provider of each action type the graph can use.
+ACTION_TYPES = {
+    'codecommit': ('Source', 'CodeCommit'),
+    'codebuild': ('Build', 'CodeBuild'),
+    'lambda': ('Invoke', 'Lambda')
+}
+
+
+# Turns the graph into pipeline stages. An action's RunOrder is one more than the highest RunOrder of the actions it
+# runs after, so everything that doesn't wait on anything shares RunOrder 1. Also catches actions that wait on
+# themselves or on something that isn't in their stage, and inputs that nothing earlier produces.
+def pipeline_stages(stages):
+    produced = set()
+    result = []
+    for stage in stages:
+        actions = dict((action['name'], action) for action in stage['actions'])
+        if len(actions) != len(stage['actions']):
+            raise ValueError('stage %s has two actions with the same name' % stage['name'])
+        run_orders = {}
 
+        def run_order(name, waiting=()):
+            if name not in actions:
+                raise ValueError('%s waits on %s which is not in stage %s' % (waiting[-1], name, stage['name']))
+            if name in waiting:
+                raise ValueError('actions in stage %s wait on each other: %s' % (
+                    stage['name'], ' -> '.join(waiting + (name,))))
+            if name not in run_orders:
+                after = actions[name].get('after', [])
+                run_orders[name] = 1 + max([run_order(other, waiting + (name,)) for other in after] or [0])
+            return run_orders[name]
 
-# CFN Template
-t = Template()
-t.add_description("This template hydrates a machine learning pipeline.")
-
-
-# The name of the ml project you're working on
-project_name_parameter = t.add_parameter(Parameter(
-    'projectnameparameter',
-    Type='String',
-    Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='mlworkflow'
-))
-region_parameter = t.add_parameter(Parameter(
-    'regionparameter',
-    Type='String',
-    Description='This is the region in which you are deploying this template.',
-    MinLength='1',
-    Default='us-west-2'
-))
-
-
-# This is to ensure that buckets created by the cfn template are unique
-account_parameter = t.add_parameter(Parameter(
-    'accountparameter',
-    Type='Number',
-    Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
-    MinValue='12'
-))
-
-# buckets used to store machine learning dataset. Anything in here will be served up to the sagemaker containers
-input_bucket_parameter = t.add_parameter(Parameter(
-    'inputbucketparameter',
-    Type='String',
-    Description='This is the name of the bucket that holds your machine learning training and testing datasets.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='inputbucket'
-))
-
-output_bucket_parameter = t.add_parameter(Parameter(
-    'outputbucketparameter',
-    Type='String',
-    Description='This is the name of the bucket that will receive the output of your machine learning training model.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='outputbucket'
-))
-
-# the name of the pipeline that gets created by this cfn template and the name of the bucket used for the pipeline
-# the name of the artificats that  hold the codecommit code the pipeline downloads.
-pipeline_name_parameter = t.add_parameter(Parameter(
-    'pipelinenameparameter',
-    Type='String',
-    Description='This is the name the pipeline that is going to move the model from the repo to training in sagemaker.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='pipeline'
-))
-
-# the name of the codecommmit repo where machine learning code gets commited to
-# The name of the codebuild project that creates the docker container
-
-repo_name_parameter = t.add_parameter(Parameter(
-    'reponameparameter',
-    Type='String',
-    Description='This is the name of the code commit repo that will be watched to trigger the pipeline as the model is revised and commited.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='mlrepo'
-))
-
-# the name of the ecr registory that contains the docker container built for submission to sagemaker
-ml_docker_registry_name_parameter = t.add_parameter(Parameter(
-    'mldockerregistrynameparameter',
-    Type='String',
-    Description='This is the name of the ecr registry used to contain the docker image with your model code.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='mldockerrepo'
-))
-
-# variables for the name of the lambda function that gets invovked to send the container to training.
-lambda_function_bucket_parameter = t.add_parameter(Parameter(
-    'lambdafunctionbucketparameter',
-    Type='String',
-    Description='This is the name of the bucket that contains the lambda function used to send your model into SageMaker.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='lambdabucket'
-))
-
-loglevelparameter = t.add_parameter(Parameter(
-    'loglevelparameter',
-    Type='String',
-    Description='This is the logging parameter used for the lambda function used to send your model into SageMaker',
-    MinLength='1',
-    AllowedValues=['DEBUG', 'INFO','WARNING', 'ERROR','CRITICAL'],
-    Default='WARNING'
-))
-
-# KMS key used to encrypted the input and output bucks that contain the data sets
-projectkmskeyparameter = t.add_parameter(Parameter(
-    'projectkmskeyparameter',
-    Type='String',
-    Description='This kms key is used to encrypt both the input and output buckets.',
-    MinLength='1',
-    AllowedPattern='([a-z]|[0-9])+',
-    Default='kmskey'
-))
-
-
-t.add_metadata({
-    'AWS::CloudFormation::Interface': {
-        'ParameterGroups': [
+        stage_actions = []
+        for action in stage['actions']:
+            available = produced | set(output for other in stage['actions']
+                                       if run_order(other['name']) < run_order(action['name'])
+                                       for output in other.get('outputs', []))
+            missing = [name for name in action.get('inputs', []) if name not in available]
+            if missing:
+                raise ValueError('nothing before %s produces %s' % (action['name'], ', '.join(missing)))
+            category, provider = ACTION_TYPES[action['type']]
+            stage_actions.append(Actions(
+                ActionTypeId=ActionTypeID(Category=category, Owner='AWS', Provider=provider, Version='1'),
+                Configuration=action.get('configuration', {}),
+                InputArtifacts=[InputArtifacts(Name=name) for name in action.get('inputs', [])],
+                Name=action['name'],
+                RunOrder=run_order(action['name']),
+                OutputArtifacts=[OutputArtifacts(Name=name) for name in action.get('outputs', [])]
+            ))
+        for action in stage['actions']:
+            produced.update(action.get('outputs', []))
+        result.append(Stages(Actions=stage_actions, Name=stage['name']))
+    return result
+
+
+# The pieces below don't depend on the project config (they only reference parameters and resources by name), so
+# they're built once per process and shared by every template rendered in it.
+@functools.lru_cache(maxsize=None)
+def assume_role_policy(*services):
+    return {
+        "Version": "2012-10-17",
+        "Statement": [{
+            "Action": ["sts:AssumeRole"],
+            "Effect": "Allow",
+            "Principal": {
+                "Service": list(services)
+            }
+        }]
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def project_key_policy():
+    return {
+        "Version": "2012-10-17",
+        "Id": 'mlkey',
+        "Statement": [
             {
-                'Label': {'default': 'General project configuration'},
-                'Parameters': ['accountparameter', 'regionparameter', 'projectnameparameter']
+                "Sid": "Enable IAM User Permissions",
+                "Effect": "Allow",
+                "Principal": {
+                    "AWS": Join(":", ["arn:aws:iam:", Ref("AWS::AccountId"), "root"])
+                   },
+                "Action": "kms:*",
+                "Resource": "*"
+            }]
+    }
+
+
+#Encryption configs for input and output buckets
+@functools.lru_cache(maxsize=None)
+def kms_bucket_encryption():
+    bucket_encryption_config = ServerSideEncryptionByDefault(
+        KMSMasterKeyID=GetAtt('projectkey', "Arn"),
+        SSEAlgorithm='aws:kms')
+
+    bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=bucket_encryption_config)
+    return BucketEncryption(ServerSideEncryptionConfiguration=[bucket_encryption_rule])
+
+
+#Encryption configs for codepipeline bucket
+@functools.lru_cache(maxsize=None)
+def aes_bucket_encryption():
+    cp_bucket_encryption_config = ServerSideEncryptionByDefault(
+        SSEAlgorithm='AES256')
+
+    cp_bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=cp_bucket_encryption_config)
+    return BucketEncryption(ServerSideEncryptionConfiguration=[cp_bucket_encryption_rule])
+
+
+@functools.lru_cache(maxsize=None)
+def codebuild_environment():
+    return Environment(
+        ComputeType=Ref('buildcomputetypeparameter'),
+        Image=Ref('buildimageparameter'),
+        PrivilegedMode=True,
+        Type='LINUX_CONTAINER',
+        EnvironmentVariables=[
+            {'Name': 'AWS_DEFAULT_REGION', 'Value': Ref('regionparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'AWS_ACCOUNT_ID', 'Value': Ref('accountparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'IMAGE_REPO_NAME', 'Value': Ref('mldockerregistrynameparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'IMAGE_TAG', 'Value': 'latest', 'Type': 'PLAINTEXT'},
+            {'Name': 'CODE_COMMIT_REPO', 'Value': Ref('reponameparameter'), 'Type': 'PLAINTEXT'},
+            {'Name': 'CACHE_TAG', 'Value': BUILD_CACHE_TAG, 'Type': 'PLAINTEXT'}
+        ]
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def codepipeline_execution_policy():
+    return {
+        "Version": "2012-10-17",
+        "Statement": [{
+            "Action": ["kms:Decrypt"],
+            "Resource": GetAtt('projectkey', "Arn"),
+            "Effect": "Allow"
+        },
+            {
+                "Action": [
+                    "lambda:listfunctions"
+                ],
+                "Resource": "*",
+                "Effect": "Allow"
             },
             {
-                'Label': {'default': 'Encryption'},
-                'Parameters': ['projectkmskeyparameter']
+                "Action": [
+                    "lambda:invokefunction",
+                    "lambda:listfunctions"
+                ],
+                "Resource": [GetAtt('sageDispatch', "Arn"), GetAtt('manifestValidator', "Arn")],
+                "Effect": "Allow"
             },
             {
-                'Label': {'default': 'Input and output s3 buckets for training, testing, and evaultion data.'},
-                'Parameters': ['inputbucketparameter', 'outputbucketparameter']
+                "Action": [
+                    "s3:ListBucket",
+                    "s3:GetBucketPolicy",
+                    "s3:GetObjectAcl",
+                    "s3:PutObjectAcl",
+                    "s3:DeleteObject",
+                    "s3:GetObject",
+                    "s3:PutObject",
+                    "s3:PutObjectTagging"
+                ],
+                "Resource": [
+                    Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
+                    Join('', [GetAtt("OutputBucket", "Arn"), "/*"]),
+                    Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"])
+                ],
+                "Effect": "Allow"
+            },
+            {
+                "Action": [
+                    "codecommit:CancelUploadArchive",
+                    "codecommit:GetBranch",
+                    "codecommit:GetCommit",
+                    "codecommit:GetUploadArchiveStatus",
+                    "codecommit:UploadArchive"
+                ],
+                "Resource": [GetAtt("Repository", "Arn")],
+                "Effect": "Allow"
             },
             {
-                'Label': {'default': 'CI/CD Pipeline information'},
-                'Parameters': ['pipelinenameparameter', 'reponameparameter', 'mldockerregistrynameparameter']
+                "Action": [
+                    "codebuild:BatchGetBuilds",
+                    "codebuild:StartBuild",
+                    "ecr:GetAuthorizationToken",
+                    "iam:PassRole"
+            ],
+                "Resource": "*",
+                "Effect": "Allow"
+            },
+            {
+                "Action": [
+                    "ecr:GetDownloadUrlForLayer",
+                    "ecr:BatchGetImage",
+                    "ecr:BatchCheckLayerAvailability",
+                    "ecr:PutImage",
+                    "ecr:InitiateLayerUpload",
+                    "ecr:UploadLayerPart",
+                    "ecr:CompleteLayerUpload"
+            ],
+                "Resource": Join('', ['arn:aws:ecr:',  Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
+                                      Ref('mldockerregistrynameparameter')]),
+                "Effect": "Allow"
             },
-{
-                'Label': {'default': 'Lambda function information'},
-                'Parameters': ['lambdafunctionbucketparameter', 'loglevelparameter']
+            {
+                "Action": [
+                    "logs:CreateLogGroup",
+                    "logs:CreateLogStream",
+                    "logs:PutLogEvents",
+                    "logs:DescribeLogStreams"
+                ],
+                "Resource": ["arn:aws:logs:*:*:*"],
+                "Effect": "Allow"
             }
-        ],
-        'ParameterLabels': {
-            'accountparameter': {'default': 'Account ID'},
-            'regionparameter': {'default': 'Region'},
-            'projectnameparameter': {'default': 'Project name'},
-            'projectkmskeyparameter': {'default': 'KMS key name'},
-            'inputbucketparameter': {'default': 'Model input bucket name'},
-            'outputbucketparameter': {'default': 'Model output bucket name'},
-            'pipelinenameparameter': {'default': 'Name of the CodePipeline pipeline'},
-            'reponameparameter': {'default': 'Name of the CodeCommit repo'},
-            'mldockerregistrynameparameter': {'default': 'Name of the ECR registry'},
-            'lambdafunctionbucketparameter': {'default': 'Name of the S3 bucket that contains the lambda function zip file called sageDispatch.zip.'},
-            'loglevelparameter': {'default': 'The Lambda logging level to use for this function. Default is set to Warning.'}
-        }
+        ]
     }
-})
-
-# Add the project's kms key to the cfn template
-project_key = t.add_resource(Key('projectkey',
-                                 Description='Key used for ML pipeline',
-                                 Enabled=True,
-                                 EnableKeyRotation=True,
-                                 KeyPolicy={
-                                     "Version": "2012-10-17",
-                                     "Id": 'mlkey',
-                                     "Statement": [
-                                         {
-                                             "Sid": "Enable IAM User Permissions",
-                                             "Effect": "Allow",
-                                             "Principal": {
-                                                 "AWS": Join(":", ["arn:aws:iam:", Ref("AWS::AccountId"), "root"])
-                                                },
-                                             "Action": "kms:*",
-                                             "Resource": "*"
-                                         }]
-                                 }
-                                 ))
 
-#Encryption configs for input and output buckets
-bucket_encryption_config = ServerSideEncryptionByDefault(
-    KMSMasterKeyID=GetAtt('projectkey', "Arn"),
-    SSEAlgorithm='aws:kms')
 
-bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=bucket_encryption_config)
-bucket_encryption = BucketEncryption(ServerSideEncryptionConfiguration=[bucket_encryption_rule])
+@functools.lru_cache(maxsize=None)
+def pipeline_trigger_policy():
+    return {
+        "Version": "2012-10-17",
+        "Statement": [{
+            "Action": "codepipeline:StartPipelineExecution",
+            "Resource": Join('', ['arn:aws:codepipeline:',  Ref('regionparameter'), ':',  Ref('accountparameter'), ':',  Ref('pipeline')]),
+            "Effect": "Allow"
+        }
+        ]
+    }
+
 
-#Encryption configs for codepipeline bucket
-cp_bucket_encryption_config = ServerSideEncryptionByDefault(
-    SSEAlgorithm='AES256')
-
-cp_bucket_encryption_rule = ServerSideEncryptionRule(ServerSideEncryptionByDefault=cp_bucket_encryption_config)
-cp_bucket_encryption = BucketEncryption(ServerSideEncryptionConfiguration=[cp_bucket_encryption_rule])
-
-
-input_bucket = t.add_resource(Bucket(
-    'InputBucket',
-    AccessControl='Private',
-    BucketName=Join("", [Ref("accountparameter"), Ref("inputbucketparameter")]),
-    BucketEncryption=bucket_encryption,
-    VersioningConfiguration=VersioningConfiguration(Status='Enabled')
-))
-
-output_bucket = t.add_resource(Bucket(
-    'OutputBucket',
-    AccessControl='Private',
-    BucketName=Join("", [Ref("accountparameter"), Ref("outputbucketparameter")]),
-    BucketEncryption=bucket_encryption,
-    VersioningConfiguration=VersioningConfiguration(Status='Enabled'),
-    DependsOn='CodePipelineBucket'
-))
-
-codepipeline_artifact_store_bucket = t.add_resource(Bucket(
-    'CodePipelineBucket',
-    AccessControl='Private',
-    BucketName=Join('', [Ref('accountparameter'), Ref('projectnameparameter'), 'artifactstore']),
-    BucketEncryption=cp_bucket_encryption
-
-))
-
-# Add ecr repo to the cfn template
-ml_docker_repo = t.add_resource(Docker_Repo('mlrepo', RepositoryName=Ref('mldockerregistrynameparameter')))
-
-# Add codecommit repo
-repo = t.add_resource(Repository('Repository', RepositoryDescription='ML repo', RepositoryName=Ref('reponameparameter')))
-
-
-# Start to build out the codeBuild portion of the solution. This part of the pipeline relies on dockerfile being present
-# in the codecommit repo that the pipeline passes onto it. The build details should also be contained in a buildspec.yml
-# file that is also located in the same repo. The buildspec file will use the docker file to create a container based on
-# the dockerfile and then tag it with the commit id that triggered the pipeline. Once the build is complete it will push
-# it to ecr.
-code_build_artifacts = Artifacts(Type='CODEPIPELINE')
-
-environment = Environment(
-    ComputeType='BUILD_GENERAL1_SMALL',
-    Image='aws/codebuild/docker:17.09.0',
-    Type='LINUX_CONTAINER',
-    EnvironmentVariables=[
-        {'Name': 'AWS_DEFAULT_REGION', 'Value': Ref('regionparameter'), 'Type': 'PLAINTEXT'},
-        {'Name': 'AWS_ACCOUNT_ID', 'Value': Ref('accountparameter'), 'Type': 'PLAINTEXT'},
-        {'Name': 'IMAGE_REPO_NAME', 'Value': Ref('mldockerregistrynameparameter'), 'Type': 'PLAINTEXT'},
-        {'Name': 'IMAGE_TAG', 'Value': 'latest', 'Type': 'PLAINTEXT'},
-        {'Name': 'CODE_COMMIT_REPO', 'Value': Ref('reponameparameter'), 'Type': 'PLAINTEXT'}
-    ]
-)
-
-source = Source(
-    Type='CODEPIPELINE'
-)
-
-code_build_project = t.add_resource(Project(
-    'build',
-    Artifacts=code_build_artifacts,
-    Environment=environment,
-    Name=Join('', [Ref('accountparameter'), 'build']),
-    ServiceRole=GetAtt("CodepipelineExecutionRole", "Arn"),
-    Source=source,
-))
-
-
-# The place where codepipeline stores the source that it downloads from codecommit when the pipeline kicks off
-artifactStore = ArtifactStore(Location=Ref('CodePipelineBucket'), Type='S3')
-
-# This is the role that is used by both codepipeline and codebuild to execute it's actions. I tried very hard to keep
-# the policy document to the minimum required access. Bascially the pipeline is allowed to execute the lambda function
-# that is used to send off docker images to training. It's allowed to manipulate the contents of the buckets used to
-# store the machine learning data and the artificats in the codepipeline bucket. It's allowed to use get the source code
-# from the specific code repo defined in the template. It's allowed to push docker images into the registry defined in
-# the cfn template and finally it's allowed to write logs into cloudwatch.
-CodepipelineExecutionRole = t.add_resource(Role(
-    "CodepipelineExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName="CodepipelineExecutionRole",
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [{
-                "Action": ["kms:Decrypt"],
+@functools.lru_cache(maxsize=None)
+def sagemaker_execution_policy():
+    return {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Action": [
+                    "kms:Decrypt",
+                    "kms:GenerateDataKey"
+                ],
                 "Resource": GetAtt('projectkey', "Arn"),
                 "Effect": "Allow"
             },
-                {
-                    "Action": [
-                        "lambda:listfunctions"
-                    ],
-                    "Resource": "*",
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "lambda:invokefunction",
-                        "lambda:listfunctions"
-                    ],
-                    "Resource": [GetAtt('sageDispatch', "Arn")],
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "s3:ListBucket",
-                        "s3:GetBucketPolicy",
-                        "s3:GetObjectAcl",
-                        "s3:PutObjectAcl",
-                        "s3:DeleteObject",
-                        "s3:GetObject",
-                        "s3:PutObject",
-                        "s3:PutObjectTagging"
-                    ],
-                    "Resource": [
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("OutputBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"])
-                    ],
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "codecommit:CancelUploadArchive",
-                        "codecommit:GetBranch",
-                        "codecommit:GetCommit",
-                        "codecommit:GetUploadArchiveStatus",
-                        "codecommit:UploadArchive"
-                    ],
-                    "Resource": [GetAtt("Repository", "Arn")],
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "codebuild:BatchGetBuilds",
-                        "codebuild:StartBuild",
-                        "ecr:GetAuthorizationToken",
-                        "iam:PassRole"
+            {
+                "Action": [
+                    "s3:GetObject",
+                    "s3:PutObject",
+                    "s3:DeleteObject"
                 ],
-                    "Resource": "*",
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "ecr:GetDownloadUrlForLayer",
-                        "ecr:BatchGetImage",
-                        "ecr:BatchCheckLayerAvailability",
-                        "ecr:PutImage",
-                        "ecr:InitiateLayerUpload",
-                        "ecr:UploadLayerPart",
-                        "ecr:CompleteLayerUpload"
+                "Resource": [
+                    Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
+                    Join('', [GetAtt("OutputBucket", "Arn"), "/*"])
                 ],
-                    "Resource": Join('', ['arn:aws:ecr:',  Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
-                                          Ref('mldockerregistrynameparameter')]),
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "logs:CreateLogGroup",
-                        "logs:CreateLogStream",
-                        "logs:PutLogEvents",
-                        "logs:DescribeLogStreams"
-                    ],
-                    "Resource": ["arn:aws:logs:*:*:*"],
-                    "Effect": "Allow"
-                }
-            ]
-        })],
-    AssumeRolePolicyDocument={
-        "Version": "2012-10-17",
-        "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["codepipeline.amazonaws.com", "codebuild.amazonaws.com"]
+                "Effect": "Allow"
+            },
+            {
+                "Effect": "Allow",
+                "Action": [
+                    "s3:CreateBucket",
+                    "s3:GetBucketLocation",
+                    "s3:ListBucket",
+                    "s3:ListAllMyBuckets"
+                ],
+                "Resource": "*"
+            },
+            {
+                # Spot training jobs sync /opt/ml/checkpoints with checkpoints/<job name>/ and big checkpoints go up
+                # in parts, which a job interrupted half way through an upload has to be able to clean up.
+                "Action": [
+                    "s3:GetObject",
+                    "s3:PutObject",
+                    "s3:DeleteObject",
+                    "s3:AbortMultipartUpload",
+                    "s3:ListMultipartUploadParts"
+                ],
+                "Resource": Join('', [GetAtt("OutputBucket", "Arn"), "/output/checkpoints/*"]),
+                "Effect": "Allow"
+            },
+            {
+                "Action": [
+                    "ecr:GetAuthorizationToken",
+                    "ecr:GetDownloadUrlForLayer",
+                    "ecr:BatchGetImage",
+                    "ecr:BatchCheckLayerAvailability"
+                ],
+                "Resource": Join('', ['arn:aws:ecr:', Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
+                                      Ref('mldockerregistrynameparameter')]),
+                "Effect": "Allow"
+            },
+            {
+                "Action": [
+                    "ecr:GetAuthorizationToken"
+                ],
+                "Resource": "*",
+                "Effect": "Allow"
+            },
+    {
+                "Action": [
+                    "cloudwatch:PutMetricData"
+                ],
+                "Resource": "*",
+                "Effect": "Allow"
+            },
+            {
+                "Action": [
+                    "logs:CreateLogGroup",
+                    "logs:CreateLogStream",
+                    "logs:DescribeLogStreams",
+                    "logs:GetLogEvents",
+                    "logs:PutLogEvents"
+                ],
+                "Resource": ["arn:aws:logs:*:*:*"],
+                "Effect": "Allow"
             }
-        }]
-    },
-))
-
-#These are the various states that have to be defined in the pipeline
-
-source_action_id = ActionTypeID(
-    Category='Source',
-    Owner='AWS',
-    Provider='CodeCommit',
-    Version='1'
-)
-
-build_action_id = ActionTypeID(
-    Category='Build',
-    Owner='AWS',
-    Provider='CodeBuild',
-    Version='1'
-)
-
-invoke_action_id = ActionTypeID(
-    Category='Invoke',
-    Owner='AWS',
-    Provider='Lambda',
-    Version='1'
-)
-
-source_action = Actions(
-    ActionTypeId=source_action_id,
-    ###
-    Configuration={
-        "PollForSourceChanges": "false",
-        "BranchName": "master",
-        "RepositoryName": Ref('reponameparameter')
-    },
-    InputArtifacts=[],
-    Name='Source',
-    RunOrder=1,
-    OutputArtifacts=[OutputArtifacts(Name='source_action_output')]
-)
-
-build_action = Actions(
-    ActionTypeId=build_action_id,
-    Configuration={
-        "ProjectName": Ref('build')
-    },
-    InputArtifacts=[InputArtifacts(Name='source_action_output')],
-    Name='Build',
-    RunOrder=1,
-    OutputArtifacts=[OutputArtifacts(Name='build_action_output')]
-)
-
-invoke_action = Actions(
-    ActionTypeId=invoke_action_id,
-    Configuration={
-        "FunctionName": 'sageDispatch'
-    },
-    InputArtifacts=[InputArtifacts(Name='source_action_output')],
-    Name='Train',
-    RunOrder=1,
-    OutputArtifacts=[]
-)
-
-source_stage = Stages(
-    Actions=[source_action],
-    Name='Source'
-)
-
-build_stage = Stages(
-    Actions=[build_action],
-    Name='Build'
-)
-
-invoke_action = Stages(
-    Actions=[invoke_action],
-    Name='Train'
-)
-
-pipeline = t.add_resource(Pipeline(
-    'pipeline',
-    RoleArn=GetAtt("CodepipelineExecutionRole", "Arn"),
-    ArtifactStore=artifactStore,
-    Stages=[source_stage, build_stage, invoke_action]))
-
-# In order for the pipeline to be triggered by a code commit what's required is a cloudwatch event rule. This rule is
-# configured so that whenever a commmit event comes over the cloudwatch event bus for the specific code commit repo it
-# then executtes a startpipelineexecution call to the piepeline. Notice after this pattern that there is also a role
-# that the rule assumes.
-cw_event_pattern = {
-    "source": [
-        "aws.codecommit"
-    ],
-    "resources": [
-        GetAtt("Repository", "Arn")
-    ],
-    "detail-type": [
-        "CodeCommit Repository State Change"
-    ],
-    "detail": {
-        "event": [
-            "referenceCreated",
-            "referenceUpdated"
-        ],
-        "referenceType": [
-            "branch"
-        ],
-        "referenceName": [
-            "master"
         ]
     }
-}
 
-# Role that allows the event rule to execute the start of the pipeline against the specific pipeline created in this cfn
-CloudWatchEventExecutionRole = t.add_resource(Role(
-    "CloudWatchEventExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName='pipelineTargetRulePolicy',
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [{
-                "Action": "codepipeline:StartPipelineExecution",
-                "Resource": Join('', ['arn:aws:codepipeline:',  Ref('regionparameter'), ':',  Ref('accountparameter'), ':',  Ref('pipeline')]),
-                "Effect": "Allow"
-            }
-            ]
-        })],
-    AssumeRolePolicyDocument={
-        "Version": "2012-10-17",
-        "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["events.amazonaws.com"]
-            }
-        }]
-    },
-))
-
-cw_rule_target = Target(
-    Arn=Join('', ["arn:aws:codepipeline:", Ref('regionparameter'), ':', Ref('accountparameter'), ':', Ref('pipeline')]),
-    Id='mlTargert1',
-    RoleArn=GetAtt("CloudWatchEventExecutionRole", "Arn")
-)
-
-pipeline_cw_rule = t.add_resource(Rule(
-    'mlpipelinerule',
-    Description='Triggers codepipeline',
-    EventPattern=cw_event_pattern,
-    State='ENABLED',
-    Targets=[cw_rule_target]
-
-))
-
-# This role allows sagemaker to do things like use the kms key that was used to encrypt the contents of the input and
-# output buckets as well as pull docker container images from the ecr repo.
-SagemakerExecutionRole = t.add_resource(Role(
-    "SagemakerExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName="SagemakerExecutionRole",
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Action": [
-                        "kms:Decrypt",
-                        "kms:GenerateDataKey"
-                    ],
-                    "Resource": GetAtt('projectkey', "Arn"),
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "s3:GetObject",
-                        "s3:PutObject",
-                        "s3:DeleteObject"
-                    ],
-                    "Resource": [
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("OutputBucket", "Arn"), "/*"])
-                    ],
-                    "Effect": "Allow"
-                },
-                {
-                    "Effect": "Allow",
-                    "Action": [
-                        "s3:CreateBucket",
-                        "s3:GetBucketLocation",
-                        "s3:ListBucket",
-                        "s3:ListAllMyBuckets"
-                    ],
-                    "Resource": "*"
-                },
-                {
-                    "Action": [
-                        "ecr:GetAuthorizationToken",
-                        "ecr:GetDownloadUrlForLayer",
-                        "ecr:BatchGetImage",
-                        "ecr:BatchCheckLayerAvailability"
-                    ],
-                    "Resource": Join('', ['arn:aws:ecr:', Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
-                                          Ref('mldockerregistrynameparameter')]),
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "ecr:GetAuthorizationToken"
-                    ],
-                    "Resource": "*",
-                    "Effect": "Allow"
-                },
-{
-                    "Action": [
-                        "cloudwatch:PutMetricData"
-                    ],
-                    "Resource": "*",
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": [
-                        "logs:CreateLogGroup",
-                        "logs:CreateLogStream",
-                        "logs:DescribeLogStreams",
-                        "logs:GetLogEvents",
-                        "logs:PutLogEvents"
-                    ],
-                    "Resource": ["arn:aws:logs:*:*:*"],
-                    "Effect": "Allow"
-                }
-            ]
-        })],
-    AssumeRolePolicyDocument={
+
+@functools.lru_cache(maxsize=None)
+def lambda_execution_policy():
+    return {
         "Version": "2012-10-17",
         "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["sagemaker.amazonaws.com"]
-            }
-        }]
-    },
-))
-
-# This is the role for the lambda function that is used to setup the sagemaker job. It needs permissions to get the
-# commit id so that it can setup a training job with a specific docker container, get the artificats of the pipeline so
-# that it can read the manifest file which defines certain parts of the job information, send a job to sagemaker, and
-# finally to signal back to the pipeline success or failure.
-LambdaExecutionRole = t.add_resource(Role(
-    "LambdaExecutionRole",
-    Path="/",
-    Policies=[Policy(
-        PolicyName='sageDispatch',
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [{
-                "Action": ["logs:*"],
-                "Resource": "arn:aws:logs:*:*:*",
+            "Action": ["logs:*"],
+            "Resource": "arn:aws:logs:*:*:*",
+            "Effect": "Allow"
+        },
+            {
+                "Action": ["kms:Decrypt", "kms:GenerateDataKey"],
+                "Resource": GetAtt('projectkey', "Arn"),
                 "Effect": "Allow"
             },
+            {
+                "Action": ["codepipeline:PutJobFailureResult",
+                           "codepipeline:PutJobSuccessResult"],
+                "Resource": "*",
+                "Effect": "Allow"
+            },
+            {
+                "Action": [
+                    "codecommit:GetBranch"
+                ],
+                "Resource": [GetAtt("Repository", "Arn")],
+                "Effect": "Allow"
+            },
+            {
+                "Action": ["s3:GetObject"],
+                "Resource": [
+                    Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"]),
+                    Join('', [GetAtt("InputBucket", "Arn"), "/*"])
+                ],
+                "Effect": "Allow"
+            },
+            {
+                "Action": [
+                    "s3:GetObjectVersion"
+                ],
+                "Resource": [
+                    Join('', [GetAtt("InputBucket", "Arn"), "/*"])
+                ],
+                "Effect": "Allow"
+            },
+            {
+                "Action": ["s3:ListBucket"],
+                "Resource": [GetAtt("InputBucket", "Arn"), GetAtt("OutputBucket", "Arn")],
+                "Effect": "Allow"
+            },
+            {
+                "Action": ["s3:PutObject"],
+                "Resource": [
+                    Join('', [GetAtt("OutputBucket", "Arn"), "/output/manifests/*"]),
+                    Join('', [GetAtt("OutputBucket", "Arn"), "/output/index/*"])
+                ],
+                "Effect": "Allow"
+            },
+            {
+                "Action": ["s3:GetObject"],
+                "Resource": [
+                    Join('', [GetAtt("OutputBucket", "Arn"), "/output/index/*"]),
+                    Join('', [GetAtt("OutputBucket", "Arn"), "/staged/*"])
+                ],
+                "Effect": "Allow"
+            },
+            {
+                "Action": ["ecr:DescribeImages"],
+                "Resource": Join('', ['arn:aws:ecr:', Ref('regionparameter'), ':', Ref('accountparameter'), ':repository/',
+                                      Ref('mldockerregistrynameparameter')]),
+                "Effect": "Allow"
+            },
+            {
+                "Action": ["sagemaker:CreateTrainingJob", "sagemaker:DescribeTrainingJob", "sagemaker:ListTags"],
+                "Resource": "*",
+                "Effect": "Allow"
+            },
+            {
+                "Action": ["iam:PassRole"],
+                "Resource": "*",
+                "Effect": "Allow"
+            }
+        ]
+    }
+
+
+def build_pipeline_template(config=None):
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+
+    # CFN Template
+    t = Template()
+    t.add_description("This template hydrates a machine learning pipeline.")
+
+
+    # The name of the ml project you're working on
+    project_name_parameter = t.add_parameter(Parameter(
+        'projectnameparameter',
+        Type='String',
+        Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['projectname']
+    ))
+    region_parameter = t.add_parameter(Parameter(
+        'regionparameter',
+        Type='String',
+        Description='This is the region in which you are deploying this template.',
+        MinLength='1',
+        Default=config['region']
+    ))
+
+
+    # This is to ensure that buckets created by the cfn template are unique
+    account_parameter = t.add_parameter(Parameter(
+        'accountparameter',
+        Type='Number',
+        Description='This is the name that will be used as a prefix to all of the assets generated by this cloudformation template.',
+        MinValue='12'
+    ))
+
+    # buckets used to store machine learning dataset. Anything in here will be served up to the sagemaker containers
+    input_bucket_parameter = t.add_parameter(Parameter(
+        'inputbucketparameter',
+        Type='String',
+        Description='This is the name of the bucket that holds your machine learning training and testing datasets.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['inputbucket']
+    ))
+
+    output_bucket_parameter = t.add_parameter(Parameter(
+        'outputbucketparameter',
+        Type='String',
+        Description='This is the name of the bucket that will receive the output of your machine learning training model.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['outputbucket']
+    ))
+
+    # the name of the pipeline that gets created by this cfn template and the name of the bucket used for the pipeline
+    # the name of the artificats that  hold the codecommit code the pipeline downloads.
+    pipeline_name_parameter = t.add_parameter(Parameter(
+        'pipelinenameparameter',
+        Type='String',
+        Description='This is the name the pipeline that is going to move the model from the repo to training in sagemaker.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['pipelinename']
+    ))
+
+    # the name of the codecommmit repo where machine learning code gets commited to
+    # The name of the codebuild project that creates the docker container
+
+    repo_name_parameter = t.add_parameter(Parameter(
+        'reponameparameter',
+        Type='String',
+        Description='This is the name of the code commit repo that will be watched to trigger the pipeline as the model is revised and commited.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['reponame']
+    ))
+
+    # the name of the ecr registory that contains the docker container built for submission to sagemaker
+    ml_docker_registry_name_parameter = t.add_parameter(Parameter(
+        'mldockerregistrynameparameter',
+        Type='String',
+        Description='This is the name of the ecr registry used to contain the docker image with your model code.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['mldockerregistryname']
+    ))
+
+    # variables for the name of the lambda function that gets invovked to send the container to training.
+    lambda_function_bucket_parameter = t.add_parameter(Parameter(
+        'lambdafunctionbucketparameter',
+        Type='String',
+        Description='This is the name of the bucket that contains the lambda function used to send your model into SageMaker.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['lambdafunctionbucket']
+    ))
+
+    loglevelparameter = t.add_parameter(Parameter(
+        'loglevelparameter',
+        Type='String',
+        Description='This is the logging parameter used for the lambda function used to send your model into SageMaker',
+        MinLength='1',
+        AllowedValues=['DEBUG', 'INFO','WARNING', 'ERROR','CRITICAL'],
+        Default=config['loglevel']
+    ))
+
+    # KMS key used to encrypted the input and output bucks that contain the data sets
+    projectkmskeyparameter = t.add_parameter(Parameter(
+        'projectkmskeyparameter',
+        Type='String',
+        Description='This kms key is used to encrypt both the input and output buckets.',
+        MinLength='1',
+        AllowedPattern='([a-z]|[0-9])+',
+        Default=config['projectkmskey']
+    ))
+
+    # How big a box the docker image gets built on and what it keeps between builds. LOCAL keeps docker layers on the
+    # build host, S3 keeps the buildspec's cache paths under buildcache/ in the codepipeline bucket.
+    build_compute_type_parameter = t.add_parameter(Parameter(
+        'buildcomputetypeparameter',
+        Type='String',
+        Description='The CodeBuild compute type used to build the docker image.',
+        AllowedValues=['BUILD_GENERAL1_SMALL', 'BUILD_GENERAL1_MEDIUM', 'BUILD_GENERAL1_LARGE', 'BUILD_GENERAL1_2XLARGE'],
+        Default=config['buildcomputetype']
+    ))
+
+    build_image_parameter = t.add_parameter(Parameter(
+        'buildimageparameter',
+        Type='String',
+        Description='The CodeBuild image the docker image is built in. It has to have docker in it.',
+        MinLength='1',
+        Default=config['buildimage']
+    ))
+
+    build_cache_type_parameter = t.add_parameter(Parameter(
+        'buildcachetypeparameter',
+        Type='String',
+        Description='What CodeBuild keeps between builds: docker layers on the build host (LOCAL), the buildspec cache paths in s3 (S3) or nothing.',
+        AllowedValues=['LOCAL', 'S3', 'NO_CACHE'],
+        Default=config['buildcachetype']
+    ))
+
+    t.add_condition('UseLocalBuildCache', Equals(Ref('buildcachetypeparameter'), 'LOCAL'))
+    t.add_condition('UseS3BuildCache', Equals(Ref('buildcachetypeparameter'), 'S3'))
+
+
+    t.add_metadata({
+        'AWS::CloudFormation::Interface': {
+            'ParameterGroups': [
                 {
-                    "Action": ["kms:Decrypt"],
-                    "Resource": GetAtt('projectkey', "Arn"),
-                    "Effect": "Allow"
-                },
-                {
-                    "Action": ["codepipeline:PutJobFailureResult",
-                               "codepipeline:PutJobSuccessResult"],
-                    "Resource": "*",
-                    "Effect": "Allow"
+                    'Label': {'default': 'General project configuration'},
+                    'Parameters': ['accountparameter', 'regionparameter', 'projectnameparameter']
                 },
                 {
-                    "Action": [
-                        "codecommit:GetBranch"
-                    ],
-                    "Resource": [GetAtt("Repository", "Arn")],
-                    "Effect": "Allow"
+                    'Label': {'default': 'Encryption'},
+                    'Parameters': ['projectkmskeyparameter']
                 },
                 {
-                    "Action": ["s3:GetObject"],
-                    "Resource": [
-                        Join('', [GetAtt("CodePipelineBucket", "Arn"), "/*"]),
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"])
-                    ],
-                    "Effect": "Allow"
+                    'Label': {'default': 'Input and output s3 buckets for training, testing, and evaultion data.'},
+                    'Parameters': ['inputbucketparameter', 'outputbucketparameter']
                 },
                 {
-                    "Action": [
-                        "s3:GetObjectVersion"
-                    ],
-                    "Resource": [
-                        Join('', [GetAtt("InputBucket", "Arn"), "/*"])
-                    ],
-                    "Effect": "Allow"
+                    'Label': {'default': 'CI/CD Pipeline information'},
+                    'Parameters': ['pipelinenameparameter', 'reponameparameter', 'mldockerregistrynameparameter']
                 },
                 {
-                    "Action": ["sagemaker:CreateTrainingJob"],
-                    "Resource": "*",
-                    "Effect": "Allow"
+                    'Label': {'default': 'Docker image build'},
+                    'Parameters': ['buildcomputetypeparameter', 'buildimageparameter', 'buildcachetypeparameter']
                 },
-                {
-                    "Action": ["iam:PassRole"],
-                    "Resource": "*",
-                    "Effect": "Allow"
+    {
+                    'Label': {'default': 'Lambda function information'},
+                    'Parameters': ['lambdafunctionbucketparameter', 'loglevelparameter']
                 }
-            ]
-        })],
-    AssumeRolePolicyDocument={
-        "Version": "2012-10-17",
-        "Statement": [{
-            "Action": ["sts:AssumeRole"],
-            "Effect": "Allow",
-            "Principal": {
-                "Service": ["lambda.amazonaws.com"]
+            ],
+            'ParameterLabels': {
+                'accountparameter': {'default': 'Account ID'},
+                'regionparameter': {'default': 'Region'},
+                'projectnameparameter': {'default': 'Project name'},
+                'projectkmskeyparameter': {'default': 'KMS key name'},
+                'inputbucketparameter': {'default': 'Model input bucket name'},
+                'outputbucketparameter': {'default': 'Model output bucket name'},
+                'pipelinenameparameter': {'default': 'Name of the CodePipeline pipeline'},
+                'reponameparameter': {'default': 'Name of the CodeCommit repo'},
+                'mldockerregistrynameparameter': {'default': 'Name of the ECR registry'},
+                'lambdafunctionbucketparameter': {'default': 'Name of the S3 bucket that contains the lambda function zip file called sageDispatch.zip.'},
+                'loglevelparameter': {'default': 'The Lambda logging level to use for this function. Default is set to Warning.'},
+                'buildcomputetypeparameter': {'default': 'CodeBuild compute type'},
+                'buildimageparameter': {'default': 'CodeBuild image'},
+                'buildcachetypeparameter': {'default': 'CodeBuild cache'}
             }
-        }]
-    },
-))
-
-# I used these environment variables so that the lambda code remains static while these fiddly bits that get setup
-# for the project can just be injected in.
-lambda_env = Lambda_Environment(Variables={
-    'APP_BUNDLE': 'source_action_output',
-    'CODE_COMMIT_REPO': Ref('reponameparameter'),
-    'TRAINING_IMAGE': Join('',[Ref('accountparameter'), ".dkr.ecr.", Ref('regionparameter'), ".amazonaws.com/", Ref('mldockerregistrynameparameter')]),
-    'SAGEMAKER_ROLE_ARN': GetAtt("SagemakerExecutionRole", "Arn"),
-    'INPUT_BUCKET': Join('', ['s3://', Ref('InputBucket'), '/']),
-    'BUCKET_KEY_ARN': GetAtt('projectkey', "Arn"),
-    'OUTPUT_BUCKET': Join('', ['s3://', Ref('OutputBucket'), '/output/']),
-    'LOG_LEVEL': Ref('loglevelparameter')
-}
-)
-
-func = t.add_resource(Function(
-    'sageDispatch',
-    Code=Code(
-        S3Bucket=Ref('lambdafunctionbucketparameter'),
-        S3Key='sageDispatch.zip'
-    ),
-    FunctionName='sageDispatch',
-    Handler="sageDispatch.lambda_handler",
-    Role=GetAtt("LambdaExecutionRole", "Arn"),
-    Runtime="python2.7",
-    Environment=lambda_env,
-    Timeout=300
-))
-
-# This prints out the CFN template. You could of course write this to a file but I is lazy. Oh and don't print to yaml.
-# There's either some bug with tropophere or with CF that causes templates to fail legacy parsing when submitted to CF
-# in yaml format. It's certainly easier to look at but I got tired to troubleshooting.
-text_file = open("pipeline.json", "w")
-text_file.write(t.to_json())
-text_file.close()
-print('Send to file')
+        }
+    })
+
+    # Add the project's kms key to the cfn template
+    project_key = t.add_resource(Key('projectkey',
+                                     Description='Key used for ML pipeline',
+                                     Enabled=True,
+                                     EnableKeyRotation=True,
+                                     KeyPolicy=project_key_policy()
+                                     ))
+
+    input_bucket = t.add_resource(Bucket(
+        'InputBucket',
+        AccessControl='Private',
+        BucketName=Join("", [Ref("accountparameter"), Ref("inputbucketparameter")]),
+        BucketEncryption=kms_bucket_encryption(),
+        VersioningConfiguration=VersioningConfiguration(Status='Enabled')
+    ))
+
+    output_bucket = t.add_resource(Bucket(
+        'OutputBucket',
+        AccessControl='Private',
+        BucketName=Join("", [Ref("accountparameter"), Ref("outputbucketparameter")]),
+        BucketEncryption=kms_bucket_encryption(),
+        VersioningConfiguration=VersioningConfiguration(Status='Enabled'),
+        DependsOn='CodePipelineBucket'
+    ))
+
+    codepipeline_artifact_store_bucket = t.add_resource(Bucket(
+        'CodePipelineBucket',
+        AccessControl='Private',
+        BucketName=Join('', [Ref('accountparameter'), Ref('projectnameparameter'), 'artifactstore']),
+        BucketEncryption=aes_bucket_encryption()
+
+    ))
+
+    # Add ecr repo to the cfn template
+    ml_docker_repo = t.add_resource(Docker_Repo('mlrepo', RepositoryName=Ref('mldockerregistrynameparameter')))
+
+    # Add codecommit repo
+    repo = t.add_resource(Repository('Repository', RepositoryDescription='ML repo', RepositoryName=Ref('reponameparameter')))
+
+
+    # Start to build out the codeBuild portion of the solution. This part of the pipeline relies on dockerfile being present
+    # in the codecommit repo that the pipeline passes onto it. The build details should also be contained in a buildspec.yml
+    # file that is also located in the same repo. The buildspec file will use the docker file to create a container based on
+    # the dockerfile and then tag it with the commit id that triggered the pipeline. Once the build is complete it will push
+    # it to ecr. BUILDSPEC is a buildspec that does all that and reuses the layers of the previous build.
+    code_build_artifacts = Artifacts(Type='CODEPIPELINE')
+
+    source = Source(
+        Type='CODEPIPELINE'
+    )
+
+    code_build_project = t.add_resource(Project(
+        'build',
+        Artifacts=code_build_artifacts,
+        Environment=codebuild_environment(),
+        Cache=If('UseLocalBuildCache',
+                 {'Type': 'LOCAL', 'Modes': ['LOCAL_DOCKER_LAYER_CACHE', 'LOCAL_SOURCE_CACHE']},
+                 If('UseS3BuildCache',
+                    {'Type': 'S3', 'Location': Join('', [Ref('CodePipelineBucket'), '/buildcache'])},
+                    {'Type': 'NO_CACHE'})),
+        Name=Join('', [Ref('accountparameter'), 'build']),
+        ServiceRole=GetAtt("CodepipelineExecutionRole", "Arn"),
+        Source=source,
+    ))
+
+
+    # The place where codepipeline stores the source that it downloads from codecommit when the pipeline kicks off
+    artifactStore = ArtifactStore(Location=Ref('CodePipelineBucket'), Type='S3')
+
+    # This is the role that is used by both codepipeline and codebuild to execute it's actions. I tried very hard to keep
+    # the policy document to the minimum required access. Bascially the pipeline is allowed to execute the lambda function
+    # that is used to send off docker images to training. It's allowed to manipulate the contents of the buckets used to
+    # store the machine learning data and the artificats in the codepipeline bucket. It's allowed to use get the source code
+    # from the specific code repo defined in the template. It's allowed to push docker images into the registry defined in
+    # the cfn template and finally it's allowed to write logs into cloudwatch.
+    CodepipelineExecutionRole = t.add_resource(Role(
+        "CodepipelineExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName="CodepipelineExecutionRole",
+            PolicyDocument=codepipeline_execution_policy())],
+        AssumeRolePolicyDocument=assume_role_policy('codepipeline.amazonaws.com', 'codebuild.amazonaws.com'),
+    ))
+
+    #These are the various states that have to be defined in the pipeline. See PIPELINE_STAGES.
+    stages = pipeline_stages(config.get('stages', PIPELINE_STAGES))
+
+    pipeline = t.add_resource(Pipeline(
+        'pipeline',
+        RoleArn=GetAtt("CodepipelineExecutionRole", "Arn"),
+        ArtifactStore=artifactStore,
+        Stages=stages))
+
+    # In order for the pipeline to be triggered by a code commit what's required is a cloudwatch event rule. This rule is
+    # configured so that whenever a commmit event comes over the cloudwatch event bus for the specific code commit repo it
+    # then executtes a startpipelineexecution call to the piepeline. Notice after this pattern that there is also a role
+    # that the rule assumes.
+    cw_event_pattern = {
+        "source": [
+            "aws.codecommit"
+        ],
+        "resources": [
+            GetAtt("Repository", "Arn")
+        ],
+        "detail-type": [
+            "CodeCommit Repository State Change"
+        ],
+        "detail": {
+            "event": [
+                "referenceCreated",
+                "referenceUpdated"
+            ],
+            "referenceType": [
+                "branch"
+            ],
+            "referenceName": [
+                "master"
+            ]
+        }
+    }
+
+    # Role that allows the event rule to execute the start of the pipeline against the specific pipeline created in this cfn
+    CloudWatchEventExecutionRole = t.add_resource(Role(
+        "CloudWatchEventExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName='pipelineTargetRulePolicy',
+            PolicyDocument=pipeline_trigger_policy())],
+        AssumeRolePolicyDocument=assume_role_policy('events.amazonaws.com'),
+    ))
+
+    cw_rule_target = Target(
+        Arn=Join('', ["arn:aws:codepipeline:", Ref('regionparameter'), ':', Ref('accountparameter'), ':', Ref('pipeline')]),
+        Id='mlTargert1',
+        RoleArn=GetAtt("CloudWatchEventExecutionRole", "Arn")
+    )
+
+    pipeline_cw_rule = t.add_resource(Rule(
+        'mlpipelinerule',
+        Description='Triggers codepipeline',
+        EventPattern=cw_event_pattern,
+        State='ENABLED',
+        Targets=[cw_rule_target]
+
+    ))
+
+    # This role allows sagemaker to do things like use the kms key that was used to encrypt the contents of the input and
+    # output buckets as well as pull docker container images from the ecr repo.
+    SagemakerExecutionRole = t.add_resource(Role(
+        "SagemakerExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName="SagemakerExecutionRole",
+            PolicyDocument=sagemaker_execution_policy())],
+        AssumeRolePolicyDocument=assume_role_policy('sagemaker.amazonaws.com'),
+    ))
+
+    # This is the role for the lambda function that is used to setup the sagemaker job. It needs permissions to get the
+    # commit id so that it can setup a training job with a specific docker container, get the artificats of the pipeline so
+    # that it can read the manifest file which defines certain parts of the job information, send a job to sagemaker, and
+    # finally to signal back to the pipeline success or failure.
+    LambdaExecutionRole = t.add_resource(Role(
+        "LambdaExecutionRole",
+        Path="/",
+        Policies=[Policy(
+            PolicyName='sageDispatch',
+            PolicyDocument=lambda_execution_policy())],
+        AssumeRolePolicyDocument=assume_role_policy('lambda.amazonaws.com'),
+    ))
+
+    # I used these environment variables so that the lambda code remains static while these fiddly bits that get setup
+    # for the project can just be injected in.
+    lambda_env = Lambda_Environment(Variables={
+        'APP_BUNDLE': 'source_action_output',
+        'CODE_COMMIT_REPO': Ref('reponameparameter'),
+        'TRAINING_IMAGE': Join('',[Ref('accountparameter'), ".dkr.ecr.", Ref('regionparameter'), ".amazonaws.com/", Ref('mldockerregistrynameparameter')]),
+        'SAGEMAKER_ROLE_ARN': GetAtt("SagemakerExecutionRole", "Arn"),
+        'INPUT_BUCKET': Join('', ['s3://', Ref('InputBucket'), '/']),
+        'BUCKET_KEY_ARN': GetAtt('projectkey', "Arn"),
+        'OUTPUT_BUCKET': Join('', ['s3://', Ref('OutputBucket'), '/output/']),
+        'STAGING_URL': Join('', ['s3://', Ref('OutputBucket'), '/staged/']),
+        'LOG_LEVEL': Ref('loglevelparameter')
+    }
+    )
+
+    func = t.add_resource(Function(
+        'sageDispatch',
+        Code=Code(
+            S3Bucket=Ref('lambdafunctionbucketparameter'),
+            S3Key='sageDispatch.zip'
+        ),
+        FunctionName='sageDispatch',
+        Handler="sageDispatch.lambda_handler",
+        Role=GetAtt("LambdaExecutionRole", "Arn"),
+        Runtime="python3.12",
+        Environment=lambda_env,
+        Timeout=300
+    ))
+
+    # Same code and role as sageDispatch, only a different entry point. It runs in the Build stage next to the image
+    # build and fails the pipeline early if manifest.json is broken or names data that isn't in the input bucket.
+    validator_func = t.add_resource(Function(
+        'manifestValidator',
+        Code=Code(
+            S3Bucket=Ref('lambdafunctionbucketparameter'),
+            S3Key='sageDispatch.zip'
+        ),
+        FunctionName='manifestValidator',
+        Handler="sageDispatch.validate_handler",
+        Role=GetAtt("LambdaExecutionRole", "Arn"),
+        Runtime="python3.12",
+        Environment=lambda_env,
+        Timeout=60
+    ))
+
+    # Keeps track of every training job from the state changes SageMaker sends to EventBridge: records the time each
+    # phase took, completes the Train action of pipelines that wait for training and relaunches interrupted spot
+    # training jobs from their last checkpoint.
+    training_events_func = t.add_resource(Function(
+        'trainingEvents',
+        Code=Code(
+            S3Bucket=Ref('lambdafunctionbucketparameter'),
+            S3Key='sageDispatch.zip'
+        ),
+        FunctionName='trainingEvents',
+        Handler="sageDispatch.training_event_handler",
+        Role=GetAtt("LambdaExecutionRole", "Arn"),
+        Runtime="python3.12",
+        Environment=lambda_env,
+        Timeout=60
+    ))
+
+    training_events_rule = t.add_resource(Rule(
+        'trainingjobstaterule',
+        Description='Sends training job state changes to trainingEvents',
+        EventPattern={
+            "source": ["aws.sagemaker"],
+            "detail-type": ["SageMaker Training Job State Change"]
+        },
+        State='ENABLED',
+        Targets=[Target(Arn=GetAtt('trainingEvents', 'Arn'), Id='trainingEventsTarget')]
+    ))
+
+    t.add_resource(Permission(
+        'trainingEventsPermission',
+        Action='lambda:InvokeFunction',
+        FunctionName=Ref('trainingEvents'),
+        Principal='events.amazonaws.com',
+        SourceArn=GetAtt('trainingjobstaterule', 'Arn')
+    ))
+
+    for endpoint in config.get('autoscaled_endpoints', []):
+        add_endpoint_autoscaling(t, endpoint)
+    return t
+
+
+# Renders the template as minified json, which is what cloudformation gets anyway and keeps it well under the inline
+# TemplateBody limit. If it still doesn't fit it's split into nested stacks (see nested_stacks.py) and the nested
+# templates have to be uploaded to s3 before the parent is deployed. Returns a dict of file name -> json text.
+def render(config=None, name='pipeline', pretty=False, max_bytes=nested_stacks.TEMPLATE_BODY_LIMIT):
+    return nested_stacks.render_files(build_pipeline_template(config).to_dict(), name, pretty, max_bytes)
+
+
+def write_files(out_dir, files):
+    results = []
+    for file_name, text in sorted(files.items()):
+        path = os.path.join(out_dir, file_name)
+        results.append((path, len(text.encode('utf-8')), write_if_changed(path, text)))
+    return results
+
+
+# Only touches the file when the rendered template actually changed so timestamps (and anything watching them, like
+# make or a sync to s3) stay put for projects whose config didn't change.
+def write_if_changed(path, text):
+    digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if hashlib.sha256(f.read()).hexdigest() == digest:
+                return False
+    with open(path, 'w') as f:
+        f.write(text)
+    return True
+
+
+def _render_config_file(args):
+    config_path, out_dir, pretty, max_bytes = args
+    with open(config_path) as f:
+        config = json.load(f)
+    name = os.path.splitext(os.path.basename(config_path))[0]
+    return write_files(out_dir, render(config, name, pretty, max_bytes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render the ml pipeline cloudformation template.')
+    parser.add_argument('configs', nargs='*', help='json files of DEFAULT_CONFIG overrides, one template per file')
+    parser.add_argument('--out-dir', default='.', help='where templates rendered from config files are written')
+    parser.add_argument('--workers', type=int, help='processes used to render config files')
+    parser.add_argument('--pretty', action='store_true', help='indent the json instead of minifying it')
+    parser.add_argument('--max-bytes', type=int, default=nested_stacks.TEMPLATE_BODY_LIMIT,
+                        help='split into nested stacks when a template is bigger than this')
+    args = parser.parse_args(argv)
+
+    # This prints out the CFN template. You could of course write this to a file but I is lazy. Oh and don't print to
+    # yaml. There's either some bug with tropophere or with CF that causes templates to fail legacy parsing when
+    # submitted to CF in yaml format. It's certainly easier to look at but I got tired to troubleshooting.
+    if not args.configs:
+        for path, size, changed in write_files('.', render(pretty=args.pretty, max_bytes=args.max_bytes)):
+            print('Send to file %s (%d bytes)' % (path, size))
+        write_if_changed('buildspec.yml', BUILDSPEC)
+        return
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    write_if_changed(os.path.join(args.out_dir, 'buildspec.yml'), BUILDSPEC)
+    work = [(path, args.out_dir, args.pretty, args.max_bytes) for path in args.configs]
+    with ProcessPoolExecutor(args.workers) as pool:
+        results = [result for results in pool.map(_render_config_file, work) for result in results]
+    for path, size, changed in results:
+        print('%s %s (%d bytes)' % ('wrote' if changed else 'unchanged', path, size))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
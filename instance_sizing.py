@@ -0,0 +1,276 @@
+import argparse
+import datetime
+import glob
+import json
+import math
+import re
+import statistics
+
+# Keeps a compact history of the training jobs this pipeline started (the ones tagged with a commitID) and uses it to
+# recommend the cheapest instance type and count that still finishes a job within a target wall clock time.
+#
+#   python instance_sizing.py collect --history sizing.jsonl                              # from sagemaker
+#   python instance_sizing.py collect --history sizing.jsonl --fixtures sizing_jobs.json  # recorded describe output
+#   python instance_sizing.py recommend census-wide --history sizing.jsonl --target-seconds 1800
+#
+# sageDispatch applies the recommendation to manifests that ask for it with "RightSize": {"TargetSeconds": 1800}, using
+# the history stored at <OUTPUT_BUCKET>index/sizing/history.jsonl (--history takes s3 urls too).
+#
+# The model is deliberately simple. Time outside the Training phase (starting instances, downloading data, uploading
+# the model) is taken as fixed, and the Training phase of a job is taken to shrink with the instance count to the power
+# of SCALING_EFFICIENCY. Other sizes of an instance family a job has run on (ml.m5.large or ml.m5.4xlarge after runs on
+# ml.m5.2xlarge, say) are estimated the same way from the nearest observed size, taking the Training phase to shrink
+# with the size in the same way. Families a job has never run on aren't considered, there's nothing to go on for them.
+
+SCALING_EFFICIENCY = 0.9
+
+# Approximate on-demand training prices per instance hour in us-west-2. Pass --prices (a json object of the same shape)
+# for current ones or other regions.
+DEFAULT_PRICES = {
+  'ml.m4.xlarge': 0.24,
+  'ml.m4.4xlarge': 0.96,
+  'ml.m5.large': 0.115,
+  'ml.m5.xlarge': 0.23,
+  'ml.m5.2xlarge': 0.461,
+  'ml.m5.4xlarge': 0.922,
+  'ml.c5.xlarge': 0.204,
+  'ml.c5.2xlarge': 0.408,
+  'ml.c5.4xlarge': 0.816,
+  'ml.p2.xlarge': 1.125,
+  'ml.p2.8xlarge': 8.64,
+  'ml.p3.2xlarge': 3.825,
+  'ml.g4dn.xlarge': 0.736
+}
+
+# sageDispatch names jobs <TrainingJobName>-yy-mm-dd-HH-MM, the family is the part before the timestamp.
+TIMESTAMP_SUFFIX = re.compile(r'-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}$')
+
+
+def job_family(training_job_name):
+  return TIMESTAMP_SUFFIX.sub('', training_job_name)
+
+
+# ml.m5.2xlarge -> ('ml.m5', 2.0). Within a family the resources of an instance go up with the multiple of xlarge in
+# its size (a large has half of an xlarge's vcpus, a 4xlarge four times as many and so on).
+def instance_size(instance_type):
+  family, _, size = instance_type.rpartition('.')
+  if size == 'large':
+    return family, 0.5
+  if size == 'xlarge':
+    return family, 1.0
+  if size.endswith('xlarge') and size[:-len('xlarge')].isdigit():
+    return family, float(size[:-len('xlarge')])
+  return family, None
+
+
+def _seconds(start, end):
+  if isinstance(start, str):
+    start, end = [datetime.datetime.fromisoformat(value.replace('Z', '+00:00')) for value in (start, end)]
+  return (end - start).total_seconds()
+
+
+# One history record from a describe_training_job response (or a search result, which has the tags in it as well).
+def job_record(job, tags=None):
+  tags = dict((tag['Key'], tag['Value']) for tag in (tags if tags is not None else job.get('Tags', [])))
+  phases = {}
+  for transition in job.get('SecondaryStatusTransitions', []):
+    if transition.get('EndTime'):
+      phases[transition['Status']] = phases.get(transition['Status'], 0) + round(
+        _seconds(transition['StartTime'], transition['EndTime']), 1)
+  record = {
+    'name': job['TrainingJobName'],
+    'family': job_family(job['TrainingJobName']),
+    'commit_id': tags.get('commitID'),
+    'status': job['TrainingJobStatus'],
+    'instance_type': job['ResourceConfig']['InstanceType'],
+    'instance_count': job['ResourceConfig']['InstanceCount'],
+    'billable_seconds': job.get('BillableTimeInSeconds'),
+    'phases': phases
+  }
+  if job.get('TrainingStartTime') and job.get('TrainingEndTime'):
+    record['wall_seconds'] = round(_seconds(job['TrainingStartTime'], job['TrainingEndTime']), 1)
+  return record
+
+
+# History kept as json lines, one record per job, so collecting again only appends what's new.
+def load_history(lines):
+  history = {}
+  for line in lines:
+    if line.strip():
+      record = json.loads(line)
+      history[record['name']] = record
+  return history
+
+
+def dump_history(history):
+  return ''.join(json.dumps(history[name], sort_keys=True) + '\n' for name in sorted(history))
+
+
+def _read(path):
+  if path.startswith('s3://'):
+    import boto3
+    bucket, _, key = path[len('s3://'):].partition('/')
+    s3_client = boto3.client('s3')
+    try:
+      return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    except s3_client.exceptions.NoSuchKey:
+      return ''
+  try:
+    with open(path) as f:
+      return f.read()
+  except IOError:
+    return ''
+
+
+def _write(path, text):
+  if path.startswith('s3://'):
+    import boto3
+    bucket, _, key = path[len('s3://'):].partition('/')
+    boto3.client('s3').put_object(Bucket=bucket, Key=key, Body=text.encode('utf-8'), ContentType='application/json')
+  else:
+    with open(path, 'w') as f:
+      f.write(text)
+
+
+# The pipeline's jobs straight from sagemaker. search returns the describe_training_job fields and the tags together,
+# a hundred jobs a call, instead of a describe and a list_tags per job.
+def search_pipeline_jobs(sagemaker_client, since=None):
+  filters = [{'Name': 'Tags.commitID', 'Operator': 'Exists'}]
+  if since is not None:
+    filters.append({'Name': 'CreationTime', 'Operator': 'GreaterThanOrEqualTo', 'Value': since.isoformat()})
+  for page in sagemaker_client.get_paginator('search').paginate(
+      Resource='TrainingJob', SearchExpression={'Filters': filters}, PaginationConfig={'PageSize': 100}):
+    for result in page['Results']:
+      yield result['TrainingJob']
+
+
+# Recorded describe_training_job responses, one per file or a list per file. Only jobs tagged with a commitID count.
+def fixture_jobs(paths):
+  for path in paths:
+    with open(path) as f:
+      data = json.load(f)
+    for job in data if isinstance(data, list) else [data]:
+      if any(tag['Key'] == 'commitID' for tag in job.get('Tags', [])):
+        yield job
+
+
+def collect(history, jobs):
+  added = 0
+  for job in jobs:
+    if job['TrainingJobStatus'] != 'Completed' or job['TrainingJobName'] in history:
+      continue
+    history[job['TrainingJobName']] = job_record(job)
+    added += 1
+  return added
+
+
+def _profile(records):
+  overhead = statistics.median(sum(s for phase, s in r['phases'].items() if phase != 'Training') for r in records)
+  work = statistics.median(r['phases'].get('Training', 0) * r['instance_count'] ** SCALING_EFFICIENCY
+                           for r in records)
+  return overhead, work
+
+
+# The observed instance type of the same family closest in size to instance_type, or None.
+def _nearest_observed(instance_type, observed):
+  family, size = instance_size(instance_type)
+  if size is None:
+    return None
+  sizes = [(abs(math.log(instance_size(other)[1] / size)), other) for other in observed
+           if instance_size(other)[0] == family and instance_size(other)[1] is not None]
+  return min(sizes)[1] if sizes else None
+
+
+# Every candidate (instance type, count) for a job family with its predicted wall clock time and cost, cheapest first.
+# Candidates estimated from another size of the family say which in based_on.
+def estimates(history, family, max_count=8, prices=None, instance_types=None):
+  prices = prices or DEFAULT_PRICES
+  by_type = {}
+  for record in history.values():
+    if record['family'] == family and record['status'] == 'Completed' and record['phases']:
+      by_type.setdefault(record['instance_type'], []).append(record)
+  candidates = []
+  for instance_type in sorted(prices):
+    if instance_types and instance_type not in instance_types:
+      continue
+    based_on = instance_type if instance_type in by_type else _nearest_observed(instance_type, by_type)
+    if based_on is None:
+      continue
+    overhead, work = _profile(by_type[based_on])
+    if based_on != instance_type:
+      work *= (instance_size(based_on)[1] / instance_size(instance_type)[1]) ** SCALING_EFFICIENCY
+    for count in range(1, max_count + 1):
+      seconds = overhead + work / count ** SCALING_EFFICIENCY
+      candidate = {
+        'instance_type': instance_type,
+        'instance_count': count,
+        'seconds': round(seconds, 1),
+        'cost': round(seconds / 3600.0 * count * prices[instance_type], 4),
+        'observed_jobs': len(by_type[based_on])
+      }
+      if based_on != instance_type:
+        candidate['based_on'] = based_on
+      candidates.append(candidate)
+  candidates.sort(key=lambda c: (c['cost'], c['seconds']))
+  return candidates
+
+
+# The cheapest candidate that finishes within target_seconds, or the fastest one if none do. None when the family has no
+# usable history.
+def recommend(history, family, target_seconds, max_count=8, prices=None, instance_types=None):
+  candidates = estimates(history, family, max_count, prices, instance_types)
+  if not candidates:
+    return None
+  fitting = [c for c in candidates if c['seconds'] <= target_seconds]
+  if fitting:
+    return dict(fitting[0], meets_target=True)
+  return dict(min(candidates, key=lambda c: (c['seconds'], c['cost'])), meets_target=False)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Collect training job history and recommend instance sizes.')
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+
+  collect_parser = commands.add_parser('collect', help='add completed pipeline jobs to the history')
+  collect_parser.add_argument('--history', required=True, help='json lines file or s3 url')
+  collect_parser.add_argument('--fixtures', nargs='*', help='recorded describe_training_job json instead of sagemaker')
+  collect_parser.add_argument('--days', type=int, help='only look at jobs created in the last this many days')
+  collect_parser.add_argument('--region')
+
+  recommend_parser = commands.add_parser('recommend', help='cheapest instance type and count for a job family')
+  recommend_parser.add_argument('family', help='TrainingJobName from the manifest, without the timestamp')
+  recommend_parser.add_argument('--history', required=True)
+  recommend_parser.add_argument('--target-seconds', type=float, required=True)
+  recommend_parser.add_argument('--max-count', type=int, default=8)
+  recommend_parser.add_argument('--prices', help='json file of instance type -> price per hour')
+  recommend_parser.add_argument('--all', action='store_true', help='list every candidate')
+  args = parser.parse_args()
+
+  history = load_history(_read(args.history).splitlines())
+  if args.command == 'collect':
+    if args.fixtures:
+      jobs = fixture_jobs(path for pattern in args.fixtures for path in sorted(glob.glob(pattern)))
+    else:
+      import boto3
+      since = None
+      if args.days:
+        since = datetime.datetime.utcnow() - datetime.timedelta(days=args.days)
+      jobs = search_pipeline_jobs(boto3.client('sagemaker', region_name=args.region), since)
+    added = collect(history, jobs)
+    _write(args.history, dump_history(history))
+    print('added %d jobs, %d in %s' % (added, len(history), args.history))
+    return
+
+  prices = None
+  if args.prices:
+    with open(args.prices) as f:
+      prices = json.load(f)
+  if args.all:
+    for candidate in estimates(history, args.family, args.max_count, prices):
+      print(json.dumps(candidate))
+  print(json.dumps(recommend(history, args.family, args.target_seconds, args.max_count, prices), indent=2))
+
+
+if __name__ == '__main__':
+  main()
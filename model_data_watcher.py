@@ -1,6 +1,278 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import time
+from urllib.parse import quote, unquote_plus
+
 import boto3
+from botocore.exceptions import ClientError
 
+# Starts the pipeline when new training data lands in the input bucket. A dataset uploaded as thousands of objects sends
+# thousands of events, so rather than one execution each, events are collected per pipeline and input prefix and the
+# pipeline is started once the prefix has had no new objects for QUIET_SECONDS (or has been busy for MAX_WAIT_SECONDS,
+# so a prefix that never settles still gets trained on). A schedule invokes the handler every minute or so to start
+# whatever has gone quiet.
+#
+# Pending prefixes are kept as one small json object each under STATE_URL (s3://bucket/prefix/), which mustn't be
+# somewhere the watcher gets events for. Without STATE_URL every event starts the pipeline straight away, as this always
+# used to. Entries are only written and deleted if nobody changed them since they were read (If-Match on the ETag), so
+# concurrent invocations can't lose each other's events and a sweep never throws away events that landed after it
+# looked.
+#
+#   python model_data_watcher.py simulate --bursts 4 --objects 2000    # executions started for a bursty upload
 code_pipeline = boto3.client('codepipeline')
+s3 = boto3.client('s3')
+
+pipeline_name = os.environ.get('PIPELINE_NAME', 'ml_pipeline')
+quiet_seconds = float(os.environ.get('QUIET_SECONDS', '300'))
+max_wait_seconds = float(os.environ.get('MAX_WAIT_SECONDS', '3600'))
+prefix_depth = int(os.environ.get('PREFIX_DEPTH', '1'))
+
 
 def handler(event, context):
-  code_pipeline.start_pipeline_execution(name='ml_pipeline')
+  state_url = os.environ.get('STATE_URL')
+  if not state_url:
+    code_pipeline.start_pipeline_execution(name=pipeline_name)
+    return None
+  trigger = CoalescingTrigger(S3Store(s3, state_url), start_pipeline, quiet_seconds, max_wait_seconds)
+  if event.get('source') == 'aws.events' and event.get('detail-type') == 'Scheduled Event':
+    return {'started': trigger.sweep(time.time())}
+  pending = trigger.record_all(
+    ((pipeline_name, bucket, input_prefix(key, prefix_depth)) for bucket, key in object_events(event)), time.time())
+  return {'pending': pending}
+
+
+# Bucket and key of every object in an s3 notification or an EventBridge Object Created event.
+def object_events(event):
+  if 'Records' in event:
+    for record in event['Records']:
+      if 's3' in record:
+        yield record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key'])
+  elif 'detail' in event and 'object' in event['detail']:
+    yield event['detail']['bucket']['name'], event['detail']['object']['key']
+
+
+# The first depth directories of a key, e.g. census/2018/adult.data -> census/ at a depth of one.
+def input_prefix(key, depth):
+  parts = key.split('/')[:-1]
+  return ''.join(part + '/' for part in parts[:depth])
+
+
+# The token makes CodePipeline start a burst's execution only once even if two sweeps both find it due. It covers the
+# entry as the sweep saw it, so events recorded after that get an execution of their own.
+def start_pipeline(entry):
+  token = hashlib.sha256(json.dumps([entry['pipeline'], entry['bucket'], entry['prefix'], entry['first'],
+                                     entry['last'], entry['events']]).encode('utf-8')).hexdigest()[:32]
+  response = code_pipeline.start_pipeline_execution(name=entry['pipeline'], clientRequestToken=token)
+  return response['pipelineExecutionId']
+
+
+class CoalescingTrigger(object):
+
+  def __init__(self, store, start, quiet_seconds=300, max_wait_seconds=3600):
+    self.store = store
+    self.start = start
+    self.quiet_seconds = quiet_seconds
+    self.max_wait_seconds = max_wait_seconds
+
+  @staticmethod
+  def _key(pipeline, bucket, prefix):
+    return quote(pipeline, safe='') + '/' + quote(bucket + '/' + prefix, safe='') + '.json'
+
+  # Notes events for (pipeline, bucket, prefix) groups at now. Events of one invocation are folded together first so a
+  # batch of notifications for the same prefix costs one read and one write. A write that lost to another invocation
+  # (or to a sweep deleting the entry) is redone on top of what's there now. Returns how many groups were touched.
+  def record_all(self, groups, now):
+    counts = {}
+    for group in groups:
+      counts[group] = counts.get(group, 0) + 1
+    for (pipeline, bucket, prefix), count in counts.items():
+      key = self._key(pipeline, bucket, prefix)
+      while True:
+        entry, version = self.store.read(key)
+        if entry is None:
+          entry = {'pipeline': pipeline, 'bucket': bucket, 'prefix': prefix, 'first': now, 'events': 0}
+        entry['last'] = now
+        entry['events'] += count
+        if self.store.put(key, entry, version):
+          break
+    return len(counts)
+
+  def record(self, pipeline, bucket, prefix, now):
+    return self.record_all([(pipeline, bucket, prefix)], now)
+
+  def is_due(self, entry, now):
+    return now - entry['last'] >= self.quiet_seconds or now - entry['first'] >= self.max_wait_seconds
+
+  # Starts an execution for every group that has gone quiet, then forgets it unless events came in meanwhile; those
+  # stay pending and get an execution (with a token of their own) once they're due. If starting fails the entry is
+  # kept and the next sweep retries it under the same token. Returns what was started.
+  def sweep(self, now):
+    started = []
+    for key in self.store.keys():
+      entry, version = self.store.read(key)
+      if entry is None or not self.is_due(entry, now):
+        continue
+      execution = self.start(entry)
+      self.store.delete(key, version)
+      started.append({'pipeline': entry['pipeline'], 'prefix': 's3://%s/%s' % (entry['bucket'], entry['prefix']),
+                      'events': entry['events'], 'last_event': entry['last'], 'execution': execution})
+    return started
+
+
+# Stores hand out a version with every entry they read; put and delete only go through if the entry is still at that
+# version (a put with None only if there's no entry yet) and say whether they did.
+class S3Store(object):
+
+  # What s3 answers a conditional request that lost: the object changed, or another conditional write was in flight.
+  CONFLICTS = ('PreconditionFailed', 'ConditionalRequestConflict', '409', '412')
+
+  def __init__(self, s3_client, url):
+    self.s3_client = s3_client
+    self.bucket, _, self.prefix = url[len('s3://'):].partition('/')
+
+  def read(self, key):
+    try:
+      response = self.s3_client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+        return None, None
+      raise
+    return json.loads(response['Body'].read()), response['ETag']
+
+  def get(self, key):
+    return self.read(key)[0]
+
+  def put(self, key, entry, version=None):
+    condition = {'IfMatch': version} if version is not None else {'IfNoneMatch': '*'}
+    return self._conditional(self.s3_client.put_object, Bucket=self.bucket, Key=self.prefix + key,
+                             Body=json.dumps(entry).encode('utf-8'), ContentType='application/json', **condition)
+
+  def delete(self, key, version):
+    return self._conditional(self.s3_client.delete_object, Bucket=self.bucket, Key=self.prefix + key, IfMatch=version)
+
+  def _conditional(self, call, **kwargs):
+    try:
+      call(**kwargs)
+    except ClientError as e:
+      if e.response['Error']['Code'] in self.CONFLICTS:
+        return False
+      raise
+    return True
+
+  def keys(self):
+    for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+      for item in page.get('Contents', []):
+        yield item['Key'][len(self.prefix):]
+
+
+class MemoryStore(object):
+
+  def __init__(self):
+    self.entries = {}
+    self.versions = {}
+    self.writes = 0
+
+  def read(self, key):
+    if key not in self.entries:
+      return None, None
+    return dict(self.entries[key]), self.versions[key]
+
+  def get(self, key):
+    return self.read(key)[0]
+
+  def put(self, key, entry, version=None):
+    if self.versions.get(key) != version:
+      return False
+    self.writes += 1
+    self.entries[key] = dict(entry)
+    self.versions[key] = self.writes
+    return True
+
+  def delete(self, key, version):
+    if key not in self.entries or self.versions[key] != version:
+      return False
+    del self.entries[key]
+    del self.versions[key]
+    return True
+
+  def keys(self):
+    return sorted(self.entries)
+
+
+# bursts uploads of objects objects each, every one spread over burst_seconds with gap_seconds of nothing in between and
+# going to the next of prefixes. Returns (second, key) pairs in time order.
+def bursty_timeline(bursts=4, objects=2000, burst_seconds=120, gap_seconds=900, prefixes=('census/',), seed=0):
+  rng = random.Random(seed)
+  timeline = []
+  start = 0.0
+  for burst in range(bursts):
+    prefix = prefixes[burst % len(prefixes)]
+    for i in range(objects):
+      timeline.append((start + rng.uniform(0, burst_seconds), '%spart-%05d.csv' % (prefix, i)))
+    start += burst_seconds + gap_seconds
+  timeline.sort()
+  return timeline
+
+
+# Replays (second, key) pairs through a trigger swept every sweep_seconds and counts the executions it starts, next to
+# the one per event the watcher used to start. delay is how long after a group's last event its execution started.
+def simulate(timeline, quiet_seconds=300, max_wait_seconds=3600, sweep_seconds=60, bucket='input', depth=1):
+  store = MemoryStore()
+  executions = []
+
+  def start(entry):
+    executions.append(entry)
+    return 'execution-%d' % len(executions)
+
+  trigger = CoalescingTrigger(store, start, quiet_seconds, max_wait_seconds)
+  delays = []
+  next_sweep = sweep_seconds
+  end = (timeline[-1][0] if timeline else 0) + quiet_seconds + 2 * sweep_seconds
+  position = 0
+  while position < len(timeline) or next_sweep <= end:
+    if position < len(timeline) and timeline[position][0] < next_sweep:
+      second, key = timeline[position]
+      trigger.record(pipeline_name, bucket, input_prefix(key, depth), second)
+      position += 1
+      continue
+    for started in trigger.sweep(next_sweep):
+      delays.append(next_sweep - started['last_event'])
+    next_sweep += sweep_seconds
+  return {
+    'events': len(timeline),
+    'executions_without_coalescing': len(timeline),
+    'executions': len(executions),
+    'events_per_execution': [entry['events'] for entry in executions],
+    'max_delay_seconds': round(max(delays), 1) if delays else None
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay upload timelines through the coalescing pipeline trigger.')
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+  replay = commands.add_parser('simulate', help='count the executions a bursty upload would start')
+  replay.add_argument('--timeline', help='json list of [second, key] pairs instead of a generated one')
+  replay.add_argument('--bursts', type=int, default=4)
+  replay.add_argument('--objects', type=int, default=2000, help='objects per burst')
+  replay.add_argument('--burst-seconds', type=float, default=120)
+  replay.add_argument('--gap-seconds', type=float, default=900)
+  replay.add_argument('--prefixes', nargs='+', default=['census/'])
+  replay.add_argument('--quiet-seconds', type=float, default=quiet_seconds)
+  replay.add_argument('--max-wait-seconds', type=float, default=max_wait_seconds)
+  replay.add_argument('--sweep-seconds', type=float, default=60)
+  args = parser.parse_args()
+
+  if args.timeline:
+    with open(args.timeline) as f:
+      timeline = sorted((float(second), key) for second, key in json.load(f))
+  else:
+    timeline = bursty_timeline(args.bursts, args.objects, args.burst_seconds, args.gap_seconds, args.prefixes)
+  print(json.dumps(simulate(timeline, args.quiet_seconds, args.max_wait_seconds, args.sweep_seconds), indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,282 @@
+import json
+import re
+
+# CloudFormation refuses a TemplateBody bigger than this. Anything larger has to be uploaded to s3 and passed by
+# TemplateURL, and past that it's easier to live with nested stacks than to keep trimming policy documents.
+TEMPLATE_BODY_LIMIT = 51200
+
+# Which nested stack a resource goes to when a template has to be split, matched on the resource type prefix. The last
+# group takes everything that doesn't match an earlier one.
+DEFAULT_GROUPS = (
+    ('iam', ('AWS::IAM::',)),
+    ('storage', ('AWS::S3::', 'AWS::KMS::', 'AWS::ECR::', 'AWS::CodeCommit::')),
+    ('pipeline', ()),
+)
+
+# Parameter of the parent stack that says where the nested templates were uploaded, e.g.
+# https://s3.amazonaws.com/mybucket/templates/
+URL_PARAMETER = 'nestedtemplateurlparameter'
+
+
+def to_json(template, pretty=False):
+    if pretty:
+        return json.dumps(template, indent=4, sort_keys=True, separators=(',', ': '))
+    return json.dumps(template, sort_keys=True, separators=(',', ':'))
+
+
+def template_size(template, pretty=False):
+    return len(to_json(template, pretty).encode('utf-8'))
+
+
+def _reference(node):
+    if isinstance(node, dict) and len(node) == 1:
+        if 'Ref' in node and isinstance(node['Ref'], str):
+            return node['Ref'], None
+        if 'Fn::GetAtt' in node:
+            target = node['Fn::GetAtt']
+            if isinstance(target, str):
+                target = target.split('.', 1)
+            return target[0], target[1]
+    return None
+
+
+def _walk_references(node):
+    reference = _reference(node)
+    if reference is not None:
+        yield reference
+    elif isinstance(node, dict):
+        for value in node.values():
+            for reference in _walk_references(value):
+                yield reference
+    elif isinstance(node, list):
+        for value in node:
+            for reference in _walk_references(value):
+                yield reference
+
+
+def _walk_conditions(node):
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'Fn::If' and isinstance(value, list):
+                yield value[0]
+            elif key == 'Condition' and isinstance(value, str):
+                yield value
+            for condition in _walk_conditions(value):
+                yield condition
+    elif isinstance(node, list):
+        for value in node:
+            for condition in _walk_conditions(value):
+                yield condition
+
+
+# Conditions used by the resources, including ones only named by other conditions.
+def _used_conditions(resources, conditions):
+    used, pending = set(), list(_walk_conditions(resources))
+    while pending:
+        condition = pending.pop()
+        if condition in conditions and condition not in used:
+            used.add(condition)
+            pending.extend(_walk_conditions(conditions[condition]))
+    return dict((condition, conditions[condition]) for condition in used)
+
+
+def _rewrite(node, replace):
+    reference = _reference(node)
+    if reference is not None:
+        replacement = replace(*reference)
+        return node if replacement is None else replacement
+    if isinstance(node, dict):
+        return dict((key, _rewrite(value, replace)) for key, value in node.items())
+    if isinstance(node, list):
+        return [_rewrite(value, replace) for value in node]
+    return node
+
+
+def _depends_on(resource):
+    depends_on = resource.get('DependsOn', [])
+    return [depends_on] if isinstance(depends_on, str) else list(depends_on)
+
+
+def _export_name(name, attribute):
+    return re.sub('[^A-Za-z0-9]', '', name + (attribute or ''))
+
+
+def _stack_name(group):
+    return ''.join(part.capitalize() for part in re.split('[^A-Za-z0-9]', group)) + 'Stack'
+
+
+def assign_groups(resources, groups=DEFAULT_GROUPS):
+    assignment = {}
+    for name, resource in resources.items():
+        for group, prefixes in groups:
+            if not prefixes or any(resource['Type'].startswith(prefix) for prefix in prefixes):
+                assignment[name] = group
+                break
+        else:
+            assignment[name] = groups[-1][0]
+    return assignment
+
+
+# Stacks can't reference each other in a loop, so groups that end up depending on each other (a role that names the
+# lambda function that runs as it, say) are folded into one stack.
+def _merge_cycles(resources, assignment, order):
+    while True:
+        edges = dict((group, set()) for group in set(assignment.values()))
+        for name, resource in resources.items():
+            targets = [target for target, _ in _walk_references(resource)] + _depends_on(resource)
+            for target in targets:
+                if target in assignment and assignment[target] != assignment[name]:
+                    edges[assignment[name]].add(assignment[target])
+
+        def reachable(start):
+            seen, pending = set(), [start]
+            while pending:
+                for group in edges[pending.pop()]:
+                    if group not in seen:
+                        seen.add(group)
+                        pending.append(group)
+            return seen
+
+        reach = dict((group, reachable(group)) for group in edges)
+        cycle = None
+        for group in sorted(edges, key=order.index):
+            members = [other for other in reach[group] if group in reach[other]]
+            if members:
+                cycle = sorted(set(members + [group]), key=order.index)
+                break
+        if cycle is None:
+            return assignment
+        merged = '-'.join(cycle)
+        order.insert(order.index(cycle[0]), merged)
+        for name in assignment:
+            if assignment[name] in cycle:
+                assignment[name] = merged
+
+
+# Splits a template (as a dict) into a parent stack and one nested stack per group. References that cross stacks are
+# rewired: the stack owning the resource exports it as an Output, the stack using it takes it as a Parameter and the
+# parent passes one to the other with Fn::GetAtt <stack>.Outputs.<name>. Parameters of the original template stay on
+# the parent and are passed down to whichever nested stacks use them.
+#
+# Returns the parent template and a dict of file name -> nested template. The parent expects the nested templates to be
+# uploaded next to each other under the url given in its nestedtemplateurlparameter parameter.
+def split_template(template, groups=DEFAULT_GROUPS, name='pipeline'):
+    resources = template['Resources']
+    parameters = template.get('Parameters', {})
+    order = [group for group, _ in groups]
+    assignment = _merge_cycles(resources, assign_groups(resources, groups), order)
+    used = sorted(set(assignment.values()), key=order.index)
+
+    exports = dict((group, set()) for group in used)
+    for resource_name, resource in resources.items():
+        for target, attribute in _walk_references(resource):
+            if target in assignment and assignment[target] != assignment[resource_name]:
+                exports[assignment[target]].add((target, attribute))
+    for target, attribute in _walk_references(template.get('Outputs', {})):
+        if target in assignment:
+            exports[assignment[target]].add((target, attribute))
+
+    def stack_output(target, attribute):
+        output = _export_name(target, attribute)
+        return {'Fn::GetAtt': [_stack_name(assignment[target]), 'Outputs.' + output]}
+
+    children = {}
+    parent_resources = {}
+    for group in used:
+        imports = {}
+
+        def replace(target, attribute):
+            if target in assignment and assignment[target] != group:
+                imports[_export_name(target, attribute)] = stack_output(target, attribute)
+                return {'Ref': _export_name(target, attribute)}
+            return None
+
+        child_resources = {}
+        stack_depends_on = set()
+        for resource_name in sorted(resources):
+            if assignment[resource_name] != group:
+                continue
+            resource = _rewrite(resources[resource_name], replace)
+            depends_on = _depends_on(resource)
+            if depends_on:
+                local = [target for target in depends_on if assignment.get(target) == group]
+                stack_depends_on.update(_stack_name(assignment[target]) for target in depends_on
+                                        if assignment.get(target, group) != group)
+                resource = dict(resource)
+                if local:
+                    resource['DependsOn'] = local
+                else:
+                    del resource['DependsOn']
+            child_resources[resource_name] = resource
+
+        child = {
+            'AWSTemplateFormatVersion': template.get('AWSTemplateFormatVersion', '2010-09-09'),
+            'Description': '%s (%s)' % (template.get('Description', name), group),
+            'Resources': child_resources
+        }
+        if 'Mappings' in template:
+            child['Mappings'] = template['Mappings']
+        conditions = _used_conditions(child_resources, template.get('Conditions', {}))
+        if conditions:
+            child['Conditions'] = conditions
+
+        child_parameters = {}
+        stack_parameters = {}
+        for target, _ in _walk_references(child):
+            if target in parameters:
+                child_parameters[target] = parameters[target]
+                stack_parameters[target] = {'Ref': target}
+        for parameter, value in imports.items():
+            child_parameters[parameter] = {'Type': 'String'}
+            stack_parameters[parameter] = value
+        if child_parameters:
+            child['Parameters'] = child_parameters
+
+        if exports[group]:
+            child['Outputs'] = dict(
+                (_export_name(target, attribute),
+                 {'Value': {'Ref': target} if attribute is None else {'Fn::GetAtt': [target, attribute]}})
+                for target, attribute in exports[group])
+
+        file_name = '%s-%s.json' % (name, group)
+        children[file_name] = child
+        stack = {
+            'Type': 'AWS::CloudFormation::Stack',
+            'Properties': {
+                'TemplateURL': {'Fn::Join': ['', [{'Ref': URL_PARAMETER}, file_name]]},
+                'Parameters': stack_parameters
+            }
+        }
+        if stack_depends_on:
+            stack['DependsOn'] = sorted(stack_depends_on)
+        parent_resources[_stack_name(group)] = stack
+
+    parent = dict((key, value) for key, value in template.items() if key not in ('Resources', 'Outputs'))
+    parent['Parameters'] = dict(parameters)
+    parent['Parameters'][URL_PARAMETER] = {
+        'Type': 'String',
+        'Description': 'The https url of the s3 prefix the nested templates were uploaded to, ending in a slash.',
+        'MinLength': '1'
+    }
+    parent['Resources'] = parent_resources
+    if 'Outputs' in template:
+        parent['Outputs'] = _rewrite(template['Outputs'], lambda target, attribute: (
+            stack_output(target, attribute) if target in assignment else None))
+    return parent, children
+
+
+# The template as a dict of file name -> json text: just <name>.json if it fits in max_bytes, otherwise the parent and
+# the nested templates from split_template. Raises ValueError if any of those is still too big.
+def render_files(template, name='pipeline', pretty=False, max_bytes=TEMPLATE_BODY_LIMIT):
+    if template_size(template, pretty) <= max_bytes:
+        return {name + '.json': to_json(template, pretty)}
+
+    parent, children = split_template(template, name=name)
+    files = {name + '.json': to_json(parent, pretty)}
+    for file_name, child in children.items():
+        files[file_name] = to_json(child, pretty)
+    too_big = ['%s (%d bytes)' % (file_name, len(text.encode('utf-8'))) for file_name, text in sorted(files.items())
+               if len(text.encode('utf-8')) > max_bytes]
+    if too_big:
+        raise ValueError('still over %d bytes after splitting into nested stacks: %s' % (max_bytes, ', '.join(too_big)))
+    return files
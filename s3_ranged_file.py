@@ -0,0 +1,130 @@
+import io
+import os
+import logging
+import tempfile
+import zipfile
+
+from botocore.exceptions import ClientError
+
+log = logging.getLogger()
+
+# zipfile looks for the end of central directory record in the last 64KB + 22 bytes of the archive, so a block of at
+# least that size lets the first read pick up the record and (for small repos) the whole central directory in one GET.
+DEFAULT_BLOCK_SIZE = 128 * 1024
+
+
+class RangedReadNotSupported(Exception):
+  pass
+
+
+# A read only, seekable file object over an s3 object. Every read turns into a ranged GET so zipfile can jump straight
+# to the central directory at the end of the artifact and then to the one member it wants. Small reads are widened to
+# a whole block and the last block is kept around because zipfile does lots of tiny header reads close together.
+class S3RangedFile(io.RawIOBase):
+
+  def __init__(self, client, bucket, key, size=None, etag=None, block_size=DEFAULT_BLOCK_SIZE):
+    self.client = client
+    self.bucket = bucket
+    self.key = key
+    self.block_size = block_size
+    if size is None:
+      head = client.head_object(Bucket=bucket, Key=key)
+      size = head['ContentLength']
+      etag = head.get('ETag')
+    self.size = size
+    self.etag = etag
+    self.requests = 0
+    self.bytes_transferred = 0
+    self._pos = 0
+    self._block_start = 0
+    self._block = b''
+
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def tell(self):
+    return self._pos
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      pos = offset
+    elif whence == io.SEEK_CUR:
+      pos = self._pos + offset
+    elif whence == io.SEEK_END:
+      pos = self.size + offset
+    else:
+      raise ValueError('invalid whence (%r)' % whence)
+    # OSError like a real file, zipfile counts that as not a zip when it seeks back from the end of a tiny object.
+    if pos < 0:
+      raise OSError('negative seek position %d' % pos)
+    self._pos = pos
+    return self._pos
+
+  def read(self, n=-1):
+    if n is None or n < 0:
+      n = self.size - self._pos
+    end = min(self._pos + n, self.size)
+    if end <= self._pos:
+      return b''
+    if not (self._block_start <= self._pos and end <= self._block_start + len(self._block)):
+      if end - self._pos >= self.block_size:
+        data = self._get_range(self._pos, end)
+        self._pos = end
+        return data
+      start = min(self._pos, max(0, self.size - self.block_size))
+      self._block_start = start
+      self._block = self._get_range(start, min(start + self.block_size, self.size))
+    offset = self._pos - self._block_start
+    data = self._block[offset:offset + (end - self._pos)]
+    self._pos += len(data)
+    return data
+
+  def readinto(self, b):
+    data = self.read(len(b))
+    b[:len(data)] = data
+    return len(data)
+
+  def _get_range(self, start, end):
+    kwargs = {'Bucket': self.bucket, 'Key': self.key, 'Range': 'bytes=%d-%d' % (start, end - 1)}
+    if self.etag:
+      kwargs['IfMatch'] = self.etag
+    response = self.client.get_object(**kwargs)
+    if 'ContentRange' not in response:
+      response['Body'].close()
+      raise RangedReadNotSupported('s3://%s/%s did not honour the range request' % (self.bucket, self.key))
+    data = response['Body'].read()
+    self.requests += 1
+    self.bytes_transferred += len(data)
+    return data
+
+
+# Pulls a single member out of a zip in s3 using ranged reads. If the object can't be read that way we fall back to
+# the old behaviour of downloading the whole thing into a temp file. A stats dict, if given, gets the number of requests
+# and bytes it took added to it.
+def read_zip_member(client, bucket, key, member, size=None, etag=None, stats=None):
+  if stats is None:
+    stats = {}
+  try:
+    ranged = S3RangedFile(client, bucket, key, size=size, etag=etag)
+    with zipfile.ZipFile(ranged, 'r') as archive:
+      data = archive.read(member)
+    log.debug('read %s from s3://%s/%s with %d ranged requests and %d of %d bytes', member, bucket, key,
+              ranged.requests, ranged.bytes_transferred, ranged.size)
+    stats['requests'] = stats.get('requests', 0) + ranged.requests
+    stats['bytes'] = stats.get('bytes', 0) + ranged.bytes_transferred
+    return data
+  except (RangedReadNotSupported, ClientError, zipfile.BadZipfile) as e:
+    log.warning('ranged read of s3://%s/%s failed, downloading the whole artifact: %s', bucket, key, e)
+  return _read_zip_member_from_download(client, bucket, key, member, stats)
+
+
+def _read_zip_member_from_download(client, bucket, key, member, stats):
+  with tempfile.NamedTemporaryFile() as tmp_file:
+    client.download_file(bucket, key, tmp_file.name)
+    stats['requests'] = stats.get('requests', 0) + 1
+    stats['bytes'] = stats.get('bytes', 0) + os.path.getsize(tmp_file.name)
+    with zipfile.ZipFile(tmp_file.name, 'r') as archive:
+      return archive.read(member)
@@ -0,0 +1,4 @@
+# s3://bucket/some/key -> ('bucket', 'some/key'). Every module that takes s3 urls splits them with this one.
+def split_s3_url(url):
+  bucket, _, key = url[len('s3://'):].partition('/')
+  return bucket, key
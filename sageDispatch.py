@@ -1,127 +1,761 @@
-import boto3
-import json
-import tempfile
-import zipfile
+import collections
+import copy
 import datetime
-import os
+import itertools
+import json
 import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-log_level = os.environ['LOG_LEVEL']
-formatter = logging.Formatter('[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
-                              '%m-%d %H:%M:%S')
-if log_level not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
-  log_level = 'WARNING'
+from botocore.exceptions import ClientError
+
+import aws_retry
+import dispatch_cache
+import dispatch_metrics
+import instance_sizing
+import s3_ranged_file
+import s3_urls
+import shard_planner
+import token_bucket
+import training_index
+import training_tracker
+
+# Logging is set up by the first invocation rather than at import, and only once per container, so importing the
+# module (the cold start) doesn't depend on LOG_LEVEL being set and warm invocations don't stack up handlers.
 log = logging.getLogger()
-log.setLevel(log_level)
-ch = logging.StreamHandler()
-ch.setLevel(log_level)
-log.addHandler(ch)
-ch.setFormatter(formatter)
+logging_configured = False
+
+
+def configure_logging():
+  global logging_configured
+  if logging_configured:
+    return
+  log_level = os.environ.get('LOG_LEVEL', 'WARNING')
+  if log_level not in ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']:
+    log_level = 'WARNING'
+  formatter = logging.Formatter('[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s',
+                                '%m-%d %H:%M:%S')
+  log.setLevel(log_level)
+  ch = logging.StreamHandler()
+  ch.setLevel(log_level)
+  ch.setFormatter(formatter)
+  log.addHandler(ch)
+  logging_configured = True
+  log.info("The log level is %s", log_level)
+
+
+# Every client goes through the same retry policy so throttling from a burst of pipelines gets backed off instead of
+# failing the job, and the retry counts reported at the end cover the whole invocation. The clients are built on first
+# use from one shared session (see aws_retry.ClientRegistry), so neither boto3 nor any client is loaded at import and an
+# invocation that fails before reaching a service never pays for its client.
+retry_policy = aws_retry.RetryPolicy()
+clients = aws_retry.ClientRegistry(retry_policy)
+code_pipeline = clients.lazy('codepipeline')
+s3 = clients.lazy('s3')
+sagemaker = clients.lazy('sagemaker')
+codecommit = clients.lazy('codecommit')
+ecr = clients.lazy('ecr')
+
+# One embedded metric format record per invocation with the time each phase of the dispatch took, the artifact bytes
+# read, retries and whether it was a cold start (see dispatch_metrics.py). METRICS_SINK=off turns it off and
+# file:<path> writes the records to a local file instead of the log.
+metrics = dispatch_metrics.Recorder(
+  os.environ.get('METRICS_NAMESPACE', 'MLPipeline/Dispatch'),
+  dispatch_metrics.sink_from_env(os.environ.get('METRICS_SINK', 'stdout')),
+  {'FunctionName': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'sageDispatch')})
+
+# Warm containers hang on to these between invocations. Retries and re-runs of a pipeline execution point at the same
+# artifact so the parsed manifest is keyed on the object's etag. The branch head moves whenever someone pushes so the
+# commit id is only trusted for a short while.
+manifest_cache = dispatch_cache.TTLCache(maxsize=int(os.environ.get('MANIFEST_CACHE_SIZE', '32')))
+commit_cache = dispatch_cache.TTLCache(maxsize=16, ttl=float(os.environ.get('COMMIT_CACHE_TTL', '15')))
+
+# None of the lookups that feed the training jobs depend on each other so they're run side by side on a small pool that
+# is shared across warm invocations. Each one gets LOOKUP_TIMEOUT seconds before the dispatch is abandoned. The same
+# pool submits the training jobs once a manifest fans out into several, with the submissions held under SageMaker's
+# CreateTrainingJob rate limit.
+dispatch_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('DISPATCH_WORKERS', '8')))
+lookup_timeout = float(os.environ.get('LOOKUP_TIMEOUT', '10'))
+max_training_jobs = int(os.environ.get('MAX_TRAINING_JOBS', '16'))
+create_job_limiter = token_bucket.TokenBucket(rate=float(os.environ.get('CREATE_JOB_TPS', '1')),
+                                              capacity=float(os.environ.get('CREATE_JOB_BURST', '2')))
 
-log.info("The log level is %s", log_level)
+# Commits that don't change the container, the hyperparameters, the data or the hardware (readme edits and the like)
+# shouldn't cost another training run. Dispatched jobs are recorded here by what they'd produce and later identical
+# dispatches reuse them once they've completed, or while they're still running if the dispatch waits for its jobs
+# (WaitForTraining). A manifest can set "SkipIfUnchanged": false to always train.
+dedup_index = training_index.LazyIndex(s3, lambda: os.environ['OUTPUT_BUCKET'] + 'index/training/')
 
-code_pipeline = boto3.client('codepipeline')
-s3 = boto3.client('s3')
-s3resource = boto3.resource('s3')
-sagemaker = boto3.client('sagemaker')
-codecommit = boto3.client('codecommit')
+# What trainingEvents has heard about each training job, and the pipeline jobs waiting for training jobs to finish
+# (see training_tracker.py). Both are one small json object per training job, same as the dedup index. All three are
+# built on first use, so OUTPUT_BUCKET is only needed by the invocations that get that far.
+job_states = training_index.LazyIndex(s3, lambda: os.environ['OUTPUT_BUCKET'] + 'index/jobs/')
+pipeline_waits = training_index.LazyIndex(s3, lambda: os.environ['OUTPUT_BUCKET'] + 'index/waits/')
 
 
 def lambda_handler(event, context):
+  configure_logging()
   log.debug(event)
+  retry_policy.start(context)
+  metrics.start(RequestId=getattr(context, 'aws_request_id', None))
 
   try:
     job_id = event['CodePipeline.job']['id']
+    metrics.set('PipelineJobId', job_id)
     job_data = event['CodePipeline.job']['data']
+    if job_data.get('continuationToken'):
+      with metrics.phase('wait_for_training'):
+        wait_for_training(job_id, job_data['continuationToken'])
+      return
     artifacts = job_data['inputArtifacts']
     log.debug(artifacts)
-    manifest = get_manifest_dictionary(artifacts)
+    with metrics.phase('get_manifest'):
+      manifest = get_manifest_dictionary(artifacts)
     log.info("got manifest and sending job")
-    result = send_to_training(manifest)
-    log.debug(result)
-    if 'TrainingJobArn' in result:
-      put_job_success(job_id, 'started job: ' + result['TrainingJobArn'])
+    with metrics.phase('send_to_training'):
+      results = send_to_training(manifest)
+    log.debug(results)
+    log.info("manifest cache %s, commit cache %s, retries %s", manifest_cache.stats(), commit_cache.stats(),
+             retry_policy.stats())
+    arns = [result['TrainingJobArn'] for result in results if 'TrainingJobArn' in result]
+    if len(arns) == len(results) and manifest.get('WaitForTraining'):
+      token = json.dumps({'TrainingJobs': [result['TrainingJobName'] for result in results]})
+      put_job_success(job_id, summarize_results(results), continuation_token=token)
+    elif len(arns) == len(results):
+      put_job_success(job_id, summarize_results(results))
     else:
-      put_job_failure(job_id, 'Sagemaker training job failed.')
+      put_job_failure(job_id, 'Sagemaker training job failed. %d of %d jobs ok. %s' % (
+        len(arns), len(results), summarize_results(results)))
   except Exception as e:
     log.critical(e)
-    code_pipeline.put_job_failure_result(jobId=job_id,
-                                         failureDetails={'message': 'some sort of exception', 'type': 'JobFailed'})
+    put_job_failure(job_id, 'some sort of exception: %s' % e)
+  finally:
+    flush_metrics()
+
+
+def flush_metrics():
+  if not metrics.enabled:
+    return
+  stats = retry_policy.stats()
+  metrics.add('aws_calls', stats['calls'])
+  metrics.add('retries', stats['retries'])
+  metrics.add('throttles', stats['throttles'])
+  metrics.flush()
+
+
+# Handler of the ValidateManifest action, which runs next to the image build. It checks the manifest the way the Train
+# action is going to use it, without starting anything, so a typo or a missing data file fails the pipeline in seconds
+# rather than after the build.
+def validate_handler(event, context):
+  configure_logging()
+  log.debug(event)
+  retry_policy.start(context)
+
+  try:
+    job_id = event['CodePipeline.job']['id']
+    manifest = get_manifest_dictionary(event['CodePipeline.job']['data']['inputArtifacts'])
+    specs, problems = validate_manifest(manifest)
+    if problems:
+      put_job_failure(job_id, 'manifest.json is not valid: %s' % '; '.join(problems))
+    else:
+      put_job_success(job_id, 'manifest.json is valid, %d training jobs' % len(specs))
+  except Exception as e:
+    log.critical(e)
+    put_job_failure(job_id, 'could not validate manifest.json: %s' % e)
+
+
+def validate_manifest(manifest):
+  try:
+    specs = expand_job_specs(manifest)
+  except KeyError as e:
+    return [], ['missing %s' % e]
+  except ValueError as e:
+    return [], [str(e)]
+  problems = []
+  for spec in specs:
+    problems.extend('%s: %s' % (spec['TrainingJobName'], problem) for problem in validate_spec(spec))
+  if problems:
+    return specs, problems
+
+  input_bucket, _ = s3_urls.split_s3_url(os.environ['INPUT_BUCKET'])
+  locations = set((input_bucket, data_key(spec, name)) for spec in specs for name in ('train_data', 'test_data'))
+  if any(spec.get('StagedInput') for spec in specs):
+    locations.add(s3_urls.split_s3_url(os.environ['STAGING_URL'] + 'current.json'))
+  futures = dict((location, dispatch_pool.submit(object_exists, *location)) for location in sorted(locations))
+  deadline = time.time() + lookup_timeout
+  for location, future in sorted(futures.items()):
+    if not future.result(timeout=max(0, deadline - time.time())):
+      problems.append('s3://%s/%s does not exist' % location)
+  return specs, problems
+
+
+# Job names get a "-yy-mm-dd-HH-MM" suffix when they're dispatched and SageMaker caps them at 63 characters.
+JOB_NAME_PATTERN = re.compile(r'^[a-zA-Z0-9](-*[a-zA-Z0-9])*$')
+JOB_NAME_MAX = 63 - len('-yy-mm-dd-HH-MM')
+
+
+def validate_spec(spec):
+  problems = []
+  job_name = spec['TrainingJobName']
+  if not JOB_NAME_PATTERN.match(job_name) or len(job_name) > JOB_NAME_MAX:
+    problems.append('TrainingJobName has to be at most %d letters, digits and hyphens' % JOB_NAME_MAX)
+  hyperparameters = spec.get('HyperParameters', {})
+  for name in ('train_data', 'test_data'):
+    if name not in hyperparameters:
+      problems.append('missing HyperParameters.%s' % name)
+  for name, value in sorted(hyperparameters.items()):
+    if not isinstance(value, str):
+      problems.append('HyperParameters.%s has to be a string' % name)
+  for name in ('InstanceType', 'InstanceCount', 'VolumeSizeInGB'):
+    if name not in spec.get('ResourceConfig', {}):
+      problems.append('missing ResourceConfig.%s' % name)
+  if 'MaxRuntimeInSeconds' not in spec.get('StoppingCondition', {}):
+    problems.append('missing StoppingCondition.MaxRuntimeInSeconds')
+  if spec.get('TrainingInputMode', 'File') not in ('File', 'Pipe', 'FastFile'):
+    problems.append('TrainingInputMode has to be File, Pipe or FastFile')
+  if spec.get('S3DataDistributionType', 'FullyReplicated') not in ('FullyReplicated', 'ShardedByS3Key'):
+    problems.append('S3DataDistributionType has to be FullyReplicated or ShardedByS3Key')
+  if staged_input_problem(spec):
+    problems.append(staged_input_problem(spec))
+  if spec.get('EnableManagedSpotTraining'):
+    max_wait = spec.get('MaxWaitTimeInSeconds', spec.get('StoppingCondition', {}).get('MaxWaitTimeInSeconds'))
+    max_runtime = spec.get('StoppingCondition', {}).get('MaxRuntimeInSeconds')
+    if max_wait is not None and max_runtime is not None and max_wait < max_runtime:
+      problems.append('MaxWaitTimeInSeconds has to be at least StoppingCondition.MaxRuntimeInSeconds')
+  elif 'MaxWaitTimeInSeconds' in spec:
+    problems.append('MaxWaitTimeInSeconds needs "EnableManagedSpotTraining": true')
+  return problems
+
+
+def object_exists(bucket, key):
+  try:
+    s3.head_object(Bucket=bucket, Key=key)
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+      return False
+    raise
+  return True
+
+
+def summarize_results(results):
+  started = [r['TrainingJobArn'] for r in results if 'TrainingJobArn' in r and not r.get('Reused')]
+  reused = ['%s (%s)' % (r['TrainingJobArn'], r.get('ModelArtifacts') or r['TrainingJobStatus'])
+            for r in results if r.get('Reused')]
+  summary = []
+  if started:
+    summary.append('started jobs: ' + ', '.join(started))
+  if reused:
+    summary.append('reused jobs: ' + ', '.join(reused))
+  return '; '.join(summary)
 
 
 def send_to_training(manifest):
   suffix = datetime.datetime.now().strftime("%y-%m-%d-%H-%M")
-  commit_id = codecommit.get_branch(repositoryName=os.environ['CODE_COMMIT_REPO'], branchName='master')['branch'][
-    'commitId']
+  specs = expand_job_specs(manifest)
+  problems = ['%s: %s' % (spec['TrainingJobName'], staged_input_problem(spec)) for spec in specs
+              if staged_input_problem(spec)]
+  if problems:
+    raise ValueError('; '.join(problems))
+  metrics.add('training_jobs', len(specs))
+  if any(spec.get('RightSize') for spec in specs):
+    with metrics.phase('right_sizing'):
+      apply_right_sizing(specs, read_sizing_history())
+  with metrics.phase('lookups'):
+    lookups = prefetch_lookups(specs)
+  if any(spec.get('SkipIfUnchanged', True) for spec in specs):
+    with metrics.phase('image_digest'):
+      lookups['image_digest'] = get_image_digest(lookups['commit_id'])
+  with metrics.phase('create_training_jobs'):
+    futures = [dispatch_pool.submit(create_training_job, spec, suffix, lookups) for spec in specs]
+    return [future.result() for future in futures]
+
+
+# A manifest with "RightSize": {"TargetSeconds": 1800} lets instance_sizing.py pick the cheapest ResourceConfig that
+# past runs of the same job say will finish in time. "InstanceTypes" narrows the choice and "MaxInstanceCount" allows
+# more instances than the manifest's own InstanceCount, which is the cap otherwise. Jobs without history, or for which
+# nothing is expected to meet the target, keep the ResourceConfig they asked for rather than being scaled up to the
+# fastest (and dearest) option. This runs before anything else looks at the ResourceConfig so the shard plan and the
+# dedup key see the recommended one.
+def apply_right_sizing(specs, history):
+  for spec in specs:
+    options = spec.get('RightSize')
+    if not options:
+      continue
+    recommendation = instance_sizing.recommend(history, spec['TrainingJobName'], options['TargetSeconds'],
+                                               options.get('MaxInstanceCount', spec['ResourceConfig']['InstanceCount']),
+                                               instance_types=options.get('InstanceTypes'))
+    if recommendation is None:
+      log.info("no sizing history for %s, keeping %s", spec['TrainingJobName'], spec['ResourceConfig'])
+      continue
+    if not recommendation['meets_target']:
+      log.warning("nothing is expected to train %s within %ss (best is %s), keeping %s", spec['TrainingJobName'],
+                  options['TargetSeconds'], recommendation, spec['ResourceConfig'])
+      continue
+    log.info("right sizing %s: %s", spec['TrainingJobName'], recommendation)
+    spec['ResourceConfig'] = dict(spec['ResourceConfig'], InstanceType=recommendation['instance_type'],
+                                  InstanceCount=recommendation['instance_count'])
+
+
+def read_sizing_history():
+  bucket, key = s3_urls.split_s3_url(os.environ['OUTPUT_BUCKET'] + 'index/sizing/history.jsonl')
   try:
-    training_object = s3resource.Object(os.environ['INPUT_BUCKET'].split('/')[-2],
-                                        manifest['HyperParameters']['train_data'].split('/')[-1])
-    testing_object = s3resource.Object(os.environ['INPUT_BUCKET'].split('/')[-2],
-                                       manifest['HyperParameters']['test_data'].split('/')[-1])
+    body = s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+      return {}
+    raise
+  return instance_sizing.load_history(body.splitlines())
+
+
+def create_training_job(spec, suffix, lookups):
+  commit_id = lookups['commit_id']
+  job_name = spec['TrainingJobName'] + "-" + suffix
+  try:
+    dedup_key = None
+    if spec.get('SkipIfUnchanged', True) and lookups.get('image_digest'):
+      dedup_key = training_key(spec, lookups)
+      previous = find_reusable_job(dedup_key, spec.get('WaitForTraining', False))
+      if previous is not None:
+        return previous
+    input_data_config = build_input_data_config(spec, job_name, lookups)
+    request = training_job_request(spec, job_name, lookups, input_data_config)
+    with metrics.phase('create_job_throttle'):
+      create_job_limiter.acquire()
+    with metrics.phase('create_training_job'):
+      response = sagemaker.create_training_job(**request)
+    if dedup_key is not None:
+      dedup_index.put(dedup_key, {'TrainingJobName': job_name, 'TrainingJobArn': response['TrainingJobArn'],
+                                  'CommitId': commit_id})
+    return dict(response, TrainingJobName=job_name)
   except Exception as e:
     log.critical(e)
+    return {}
+
+
+def training_job_request(spec, job_name, lookups, input_data_config):
+  commit_id = lookups['commit_id']
+  request = {
+    'TrainingJobName': job_name,
+    'HyperParameters': spec['HyperParameters'],
+    'AlgorithmSpecification': {
+      'TrainingInputMode': spec.get('TrainingInputMode', 'File'),
+      'TrainingImage': os.environ['TRAINING_IMAGE'] + ":" + commit_id
+    },
+    'RoleArn': os.environ['SAGEMAKER_ROLE_ARN'],
+    'InputDataConfig': input_data_config,
+    'OutputDataConfig': {
+      "KmsKeyId": os.environ['BUCKET_KEY_ARN'].split('/')[-1],
+      "S3OutputPath": os.environ['OUTPUT_BUCKET']
+    },
+    'ResourceConfig': spec['ResourceConfig'],
+    'StoppingCondition': spec['StoppingCondition'],
+    'Tags': [{'Key': 'commitID', 'Value': commit_id},
+             {'Key': 'training_data_version', 'Value': lookups['versions'][data_key(spec, 'train_data')]},
+             {'Key': 'testing_data_version', 'Value': lookups['versions'][data_key(spec, 'test_data')]}]
+  }
+  request.update(spot_training_config(spec, job_name))
+  return request
 
+
+# "EnableManagedSpotTraining": true runs a job on spot capacity. SageMaker waits up to MaxWaitTimeInSeconds (twice
+# MaxRuntimeInSeconds unless the manifest says otherwise) for capacity, including after interruptions, and syncs
+# the container's checkpoint directory with checkpoints/<job name>/ in the output bucket so a restarted job can pick
+# up where it left off. The container has to write its checkpoints to CheckpointLocalPath (/opt/ml/checkpoints by
+# default) and look there when it starts.
+def spot_training_config(spec, job_name):
+  if not spec.get('EnableManagedSpotTraining'):
+    return {}
+  stopping_condition = dict(spec['StoppingCondition'])
+  stopping_condition['MaxWaitTimeInSeconds'] = spec.get('MaxWaitTimeInSeconds', stopping_condition.get(
+    'MaxWaitTimeInSeconds', 2 * stopping_condition['MaxRuntimeInSeconds']))
+  return {
+    'EnableManagedSpotTraining': True,
+    'StoppingCondition': stopping_condition,
+    'CheckpointConfig': {
+      'S3Uri': checkpoint_uri(job_name),
+      'LocalPath': spec.get('CheckpointLocalPath', '/opt/ml/checkpoints')
+    }
+  }
+
+
+def checkpoint_uri(job_name):
+  return os.environ['OUTPUT_BUCKET'] + 'checkpoints/' + job_name + '/'
+
+
+# Handler for SageMaker Training Job State Change events. Every event updates the job's record in job_states, and a
+# job finishing completes the pipeline job waiting on it, if there is one and the job was the last it was waiting for.
+#
+# A spot job that runs out of MaxWaitTimeInSeconds before it gets its capacity back ends up Stopped (or Failed) with a
+# secondary status saying so. Those get relaunched with the same configuration, including the checkpoint location, so
+# the new job resumes from the last checkpoint the interrupted one wrote. Relaunches are named <job>-r<n> and stop after
+# MAX_SPOT_RESUBMITS. A pipeline waiting on the interrupted job waits on the relaunch instead.
+def training_event_handler(event, context):
+  configure_logging()
+  log.debug(event)
+  retry_policy.start(context)
+  record = training_tracker.track(job_states, event['detail'])
+  if record is None:
+    return None
+  name = record['TrainingJobName']
+  log.info("%s is %s (%s), %s", name, record['TrainingJobStatus'], record['SecondaryStatus'], record['Latencies'])
+  if not training_tracker.is_finished(record):
+    return record
+  if record['TrainingJobStatus'] in ('Stopped', 'Failed'):
+    job = sagemaker.describe_training_job(TrainingJobName=name)
+    if was_interrupted(job):
+      response = resubmit_from_checkpoint(job)
+      if response is not None:
+        record['ResumedAs'] = response['TrainingJobName']
+        job_states.put(name, record)
+        wait = pipeline_waits.get(name)
+        if wait is not None:
+          pipeline_waits.put(record['ResumedAs'], wait)
+        return record
+  wait = pipeline_waits.get(name)
+  if wait is not None:
+    finish_waiting(wait)
+  return record
+
+
+# A manifest with "WaitForTraining": true keeps the Train action going until its training jobs finish, and fails it if
+# any of them don't complete. The first invocation hands CodePipeline the job names as a continuation token, and
+# CodePipeline invokes the function again with them and a new job id. That job is left open with a note on each training
+# job for trainingEvents, which completes it when the last one finishes. The action still fails if training outlasts
+# CodePipeline's timeout for it.
+def wait_for_training(job_id, continuation_token):
+  names = json.loads(continuation_token)['TrainingJobs']
+  wait = training_tracker.wait_for(pipeline_waits, job_id, names)
+  # Reused jobs may have finished before anything was tracking them.
+  for name in names:
+    if job_states.get(name) is None:
+      training_tracker.track(job_states, sagemaker.describe_training_job(TrainingJobName=name))
+  finish_waiting(wait)
+
+
+def finish_waiting(wait):
+  outcome = training_tracker.wait_outcome(job_states, pipeline_waits, wait)
+  if outcome is None:
+    log.info("pipeline job %s is waiting for %s", wait['PipelineJobId'], ', '.join(wait['TrainingJobs']))
+    return None
+  succeeded, records = outcome
+  if succeeded:
+    put_job_success(wait['PipelineJobId'], training_tracker.summarize(records))
+  else:
+    put_job_failure(wait['PipelineJobId'], 'training did not complete: %s' % training_tracker.summarize(records))
+  return succeeded
+
+
+INTERRUPTED_STATUSES = ('Interrupted', 'MaxWaitTimeExceeded')
+RESUBMIT_SUFFIX = re.compile(r'-r(\d+)$')
+RESUBMIT_FIELDS = ('HyperParameters', 'AlgorithmSpecification', 'RoleArn', 'InputDataConfig', 'OutputDataConfig',
+                   'ResourceConfig', 'StoppingCondition', 'EnableManagedSpotTraining', 'CheckpointConfig', 'VpcConfig',
+                   'EnableNetworkIsolation', 'EnableInterContainerTrafficEncryption')
+max_spot_resubmits = int(os.environ.get('MAX_SPOT_RESUBMITS', '3'))
+
+
+# Only the way the job ended counts: an interruption it recovered from before failing on its own or being stopped by
+# someone is still in the transitions, and relaunching that would just fail or undo the stop again.
+def was_interrupted(job):
+  if not job.get('EnableManagedSpotTraining') or not job.get('CheckpointConfig'):
+    return False
+  if job['TrainingJobStatus'] not in ('Stopped', 'Failed'):
+    return False
+  if job.get('SecondaryStatus') == 'Stopped' or 'AlgorithmError' in (job.get('FailureReason') or ''):
+    return False
+  transitions = job.get('SecondaryStatusTransitions') or []
+  last = transitions[-1]['Status'] if transitions else None
+  return job.get('SecondaryStatus') in INTERRUPTED_STATUSES or last in INTERRUPTED_STATUSES
+
+
+def resubmitted_name(job_name):
+  match = RESUBMIT_SUFFIX.search(job_name)
+  attempt = int(match.group(1)) + 1 if match else 1
+  base = job_name[:match.start()] if match else job_name
+  suffix = '-r%d' % attempt
+  return base[:63 - len(suffix)] + suffix, attempt
+
+
+def resubmit_request(job, tags):
+  job_name, attempt = resubmitted_name(job['TrainingJobName'])
+  request = dict((field, job[field]) for field in RESUBMIT_FIELDS if field in job)
+  request['TrainingJobName'] = job_name
+  request['Tags'] = [tag for tag in tags if not tag['Key'].startswith('aws:')] + [
+    {'Key': 'resumedFrom', 'Value': job['TrainingJobName']}]
+  return request, attempt
+
+
+def resubmit_from_checkpoint(job):
+  tags = sagemaker.list_tags(ResourceArn=job['TrainingJobArn'])['Tags']
+  tags = [tag for tag in tags if tag['Key'] != 'resumedFrom']
+  request, attempt = resubmit_request(job, tags)
+  if attempt > max_spot_resubmits:
+    log.warning("%s was interrupted but has already been resubmitted %d times", job['TrainingJobName'], attempt - 1)
+    return None
+  log.info("%s was interrupted (%s), resuming it from %s as %s", job['TrainingJobName'], job.get('SecondaryStatus'),
+           job['CheckpointConfig']['S3Uri'], request['TrainingJobName'])
+  create_job_limiter.acquire()
+  response = sagemaker.create_training_job(**request)
+  return dict(response, TrainingJobName=request['TrainingJobName'])
+
+
+def training_key(spec, lookups):
+  return training_index.training_key(
+    lookups['image_digest'],
+    spec['HyperParameters'],
+    {'train': lookups['versions'][data_key(spec, 'train_data')],
+     'test': lookups['versions'][data_key(spec, 'test_data')]},
+    spec['ResourceConfig'])
+
+
+def find_reusable_job(dedup_key, waiting):
+  entry = dedup_index.get(dedup_key)
+  if entry is None:
+    return None
+  job = sagemaker.describe_training_job(TrainingJobName=entry['TrainingJobName'])
+  reusable = training_index.REUSABLE_STATUSES + (training_index.WAITABLE_STATUSES if waiting else ())
+  if job['TrainingJobStatus'] not in reusable:
+    log.info("previous job %s for %s is %s, training again", entry['TrainingJobName'], dedup_key,
+             job['TrainingJobStatus'])
+    return None
+  log.info("reusing %s job %s for %s", job['TrainingJobStatus'], job['TrainingJobName'], dedup_key)
+  return {
+    'TrainingJobName': job['TrainingJobName'],
+    'TrainingJobArn': job['TrainingJobArn'],
+    'TrainingJobStatus': job['TrainingJobStatus'],
+    'ModelArtifacts': job.get('ModelArtifacts', {}).get('S3ModelArtifacts'),
+    'Reused': True
+  }
+
+
+# The image is pushed by the build stage tagged with the commit id. If it isn't there (or ecr can't be reached) the
+# job still goes ahead, it just can't be deduplicated.
+def get_image_digest(commit_id):
+  repository = os.environ['TRAINING_IMAGE'].split('/', 1)[-1]
   try:
-    response = sagemaker.create_training_job(
-      TrainingJobName=manifest['TrainingJobName'] + "-" + suffix,
-      HyperParameters=manifest['HyperParameters'],
-      AlgorithmSpecification={
-        'TrainingInputMode': 'File',
-        'TrainingImage': os.environ['TRAINING_IMAGE'] + ":" + commit_id
-      },
-      RoleArn=os.environ['SAGEMAKER_ROLE_ARN'],
-      InputDataConfig=[
-        {
-          "CompressionType": "None",
-          "ChannelName": "train",
-          "DataSource": {
-            "S3DataSource": {
-              "S3DataType": "S3Prefix",
-              "S3DataDistributionType": "FullyReplicated",
-              "S3Uri": os.environ['INPUT_BUCKET']
-            }
-          },
-          "RecordWrapperType": "None"
-        }
-      ],
-      OutputDataConfig={
-        "KmsKeyId": os.environ['BUCKET_KEY_ARN'].split('/')[-1],
-        "S3OutputPath": os.environ['OUTPUT_BUCKET']
-      },
-      ResourceConfig=manifest['ResourceConfig'],
-      StoppingCondition=manifest['StoppingCondition'],
-      Tags=[{'Key': 'commitID', 'Value': commit_id},
-            {'Key': 'training_data_version', 'Value': training_object.version_id},
-            {'Key': 'testing_data_version', 'Value': testing_object.version_id}]
-    )
+    images = ecr.describe_images(repositoryName=repository, imageIds=[{'imageTag': commit_id}])['imageDetails']
   except Exception as e:
-    log.critical(e)
-  return response
+    log.warning("couldn't look up the digest of %s:%s: %s", repository, commit_id, e)
+    return None
+  return images[0]['imageDigest'] if images else None
+
+
+# By default every instance gets a full copy of the input bucket. A manifest can instead set S3DataDistributionType to
+# ShardedByS3Key so each instance only downloads (or with a TrainingInputMode of Pipe or FastFile, streams) its own part
+# of it. Adding "BalanceShards": true on a multi instance job lists the input prefix and packs the objects into one
+# group per instance by size, written out as a manifest file next to the job's output, rather than leaving SageMaker
+# to split the prefix by key alone. With "StagedInput": true the job instead gets a train and a test channel reading
+# the compressed shards stage_data.py last wrote under STAGING_URL for its train_data and test_data.
+def build_input_data_config(spec, job_name, lookups):
+  if spec.get('StagedInput'):
+    return [staged_channel(spec, job_name, name, lookups['staged_input'], data_key(spec, hyperparameter))
+            for name, hyperparameter in STAGED_CHANNELS]
+  channel = {
+    "CompressionType": "None",
+    "ChannelName": "train",
+    "RecordWrapperType": "None"
+  }
+  data_source = s3_data_source(spec, os.environ['INPUT_BUCKET'], lookups.get('input_objects'), job_name + '.manifest')
+  channel['DataSource'] = {"S3DataSource": data_source}
+  return [channel]
+
+
+# Only a channel given a manifest_name is spread over the instances (and shard planned), the rest are replicated.
+def s3_data_source(spec, url, objects, manifest_name=None):
+  distribution = spec.get('S3DataDistributionType', 'FullyReplicated') if manifest_name else 'FullyReplicated'
+  data_source = {
+    "S3DataType": "S3Prefix",
+    "S3DataDistributionType": distribution,
+    "S3Uri": url
+  }
+  if manifest_name and needs_shard_plan(spec):
+    bucket, prefix = s3_urls.split_s3_url(url)
+    shards = shard_planner.plan_shards(objects, spec['ResourceConfig']['InstanceCount'])
+    log.info("shard plan for %s: %s", manifest_name, shard_planner.describe_shards(shards))
+    manifest_url = os.environ['OUTPUT_BUCKET'] + 'manifests/' + manifest_name
+    shard_planner.write_manifest(s3, manifest_url, shard_planner.build_manifest(bucket, prefix, shards))
+    data_source['S3DataType'] = 'ManifestFile'
+    data_source['S3Uri'] = manifest_url
+  return data_source
+
+
+# stage_data.py keeps the shards of every source object under a prefix of their own, so train_data and test_data each
+# get a channel of their own instead of being streamed into train together.
+STAGED_CHANNELS = (('train', 'train_data'), ('test', 'test_data'))
+
+
+def staged_channel(spec, job_name, name, staged, key):
+  input_bucket, input_prefix = s3_urls.split_s3_url(os.environ['INPUT_BUCKET'])
+  staged_object = staged.get('objects', {}).get(input_prefix + key)
+  if staged_object is None:
+    raise ValueError('s3://%s/%s%s has not been staged, run stage_data.py again' % (input_bucket, input_prefix, key))
+  objects = [tuple(shard) for shard in staged_object['shards']]
+  return {
+    "CompressionType": staged['compression'],
+    "ChannelName": name,
+    "RecordWrapperType": "None",
+    "ContentType": staged['content_type'],
+    "DataSource": {
+      "S3DataSource": s3_data_source(spec, staged_object['prefix'], objects,
+                                     '%s-%s.manifest' % (job_name, name) if name == 'train' else None)
+    }
+  }
+
+
+# Staged input (see stage_data.py) is gzipped and SageMaker only decompresses channels in Pipe mode, which the job's
+# container has to read from. So a manifest has to ask for Pipe itself rather than have a File mode job switched over.
+def staged_input_problem(spec):
+  if spec.get('StagedInput') and spec.get('TrainingInputMode') != 'Pipe':
+    return 'StagedInput needs "TrainingInputMode": "Pipe"'
+  return None
+
+
+def read_staged_input():
+  bucket, key = s3_urls.split_s3_url(os.environ['STAGING_URL'] + 'current.json')
+  return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+
+def needs_shard_plan(spec):
+  return (spec.get('BalanceShards', False) and spec.get('S3DataDistributionType') == 'ShardedByS3Key' and
+          spec['ResourceConfig'].get('InstanceCount', 1) > 1)
+
+
+# A manifest describes one training job unless it has a TrainingJobs list and/or a HyperParameterGrid. Each entry in
+# TrainingJobs is laid over the top level of the manifest (HyperParameters are merged key by key) and the grid expands
+# every job into one variant per combination of the listed hyperparameter values, e.g.
+#   "HyperParameterGrid": {"model_type": ["wide", "deep"], "train_epochs": ["20", "40"]}
+# Variants that would end up sharing a TrainingJobName get their index appended to it.
+def expand_job_specs(manifest):
+  base = dict((k, v) for k, v in manifest.items() if k not in ('TrainingJobs', 'HyperParameterGrid'))
+  specs = []
+  for entry in manifest.get('TrainingJobs') or [{}]:
+    spec = dict(base, **entry)
+    spec['HyperParameters'] = dict(base.get('HyperParameters', {}), **entry.get('HyperParameters', {}))
+    specs.append(spec)
+
+  grid = manifest.get('HyperParameterGrid') or {}
+  names = sorted(grid)
+  combinations = list(itertools.product(*[grid[name] for name in names]))
+  if names:
+    specs = [dict(spec, HyperParameters=dict(spec['HyperParameters'], **dict(zip(names, [str(v) for v in values]))))
+             for spec in specs for values in combinations]
+
+  if len(specs) > max_training_jobs:
+    raise ValueError('manifest expands to %d training jobs, the limit is %d' % (len(specs), max_training_jobs))
+  counts = collections.Counter(spec['TrainingJobName'] for spec in specs)
+  taken = set(name for name, count in counts.items() if count == 1)
+  for i, spec in enumerate(specs):
+    if counts[spec['TrainingJobName']] > 1:
+      spec['TrainingJobName'] = unique_job_name(spec['TrainingJobName'], i, taken)
+      taken.add(spec['TrainingJobName'])
+  return specs
+
+
+# name with a -<n> suffix, counting up from n until it's none of the taken names and cutting name short to keep it
+# within JOB_NAME_MAX.
+def unique_job_name(name, n, taken):
+  while True:
+    suffix = '-%d' % n
+    candidate = name[:JOB_NAME_MAX - len(suffix)] + suffix
+    if candidate not in taken:
+      return candidate
+    n += 1
+
+
+def data_key(spec, name):
+  return spec['HyperParameters'][name].split('/')[-1]
+
+
+def prefetch_lookups(specs):
+  input_bucket, input_prefix = s3_urls.split_s3_url(os.environ['INPUT_BUCKET'])
+  keys = set(data_key(spec, name) for spec in specs for name in ('train_data', 'test_data'))
+  futures = {('commit_id',): dispatch_pool.submit(timed_call, get_commit_id, os.environ['CODE_COMMIT_REPO'], 'master')}
+  for key in keys:
+    futures[('version', key)] = dispatch_pool.submit(timed_call, get_object_version, input_bucket, key)
+  if any(spec.get('StagedInput') for spec in specs):
+    futures[('staged_input',)] = dispatch_pool.submit(timed_call, read_staged_input)
+  if any(needs_shard_plan(spec) and not spec.get('StagedInput') for spec in specs):
+    futures[('input_objects',)] = dispatch_pool.submit(timed_call, shard_planner.list_objects, s3, input_bucket,
+                                                       input_prefix)
+  deadline = time.time() + lookup_timeout
+  results = {}
+  timings = {}
+  for name, future in futures.items():
+    results[name], timings[' '.join(name)] = future.result(timeout=max(0, deadline - time.time()))
+  log.info("lookup timings %s", timings)
+  return {
+    'commit_id': results[('commit_id',)],
+    'versions': dict((name[1], value) for name, value in results.items() if name[0] == 'version'),
+    'input_objects': results.get(('input_objects',)),
+    'staged_input': results.get(('staged_input',))
+  }
+
+
+def timed_call(func, *args):
+  start = time.time()
+  result = func(*args)
+  return result, time.time() - start
+
+
+def get_object_version(bucket, key):
+  with metrics.phase('version_head'):
+    return s3.head_object(Bucket=bucket, Key=key).get('VersionId')
+
+
+def get_commit_id(repo, branch):
+  commit_id = commit_cache.get((repo, branch))
+  if commit_id is None:
+    with metrics.phase('commit_lookup'):
+      commit_id = codecommit.get_branch(repositoryName=repo, branchName=branch)['branch']['commitId']
+    commit_cache.put((repo, branch), commit_id)
+  return commit_id
 
 
 def get_manifest_dictionary(artifacts):
-  manifest_file = ''
+  manifest = None
   for artifact in artifacts:
     if os.environ['APP_BUNDLE'] in artifact['name']:
       manifiest_bucket = artifact['location']['s3Location']['bucketName']
       manifiest_key = artifact['location']['s3Location']['objectKey']
-      manifest_file = get_manifest_from_s3(manifiest_bucket, manifiest_key)
-  return json.loads(manifest_file)
+      manifest = get_manifest_from_s3(manifiest_bucket, manifiest_key)
+  if manifest is None:
+    raise ValueError('no artifact named %s in the job input' % os.environ['APP_BUNDLE'])
+  return copy.deepcopy(manifest)
 
 
+# The source artifact is a zip of the whole repo which can get big once data and serve files are committed alongside
+# the model. Only manifest.json is needed here so it gets pulled out with ranged reads instead of a full download. The
+# head request is needed for the ranged reads anyway and its etag tells us if we've parsed this artifact before.
 def get_manifest_from_s3(bucket, key):
-  tmp_file = tempfile.NamedTemporaryFile()
-  with tempfile.NamedTemporaryFile() as tmp_file:
-    s3.download_file(bucket, key, tmp_file.name)
-    with zipfile.ZipFile(tmp_file.name, 'r') as zip:
-      return zip.read('manifest.json')
+  with metrics.phase('artifact_head'):
+    head = s3.head_object(Bucket=bucket, Key=key)
+  cache_key = (bucket, key, head.get('ETag'))
+  manifest = manifest_cache.get(cache_key)
+  if manifest is None:
+    stats = {}
+    with metrics.phase('artifact_read'):
+      manifest_file = s3_ranged_file.read_zip_member(s3, bucket, key, 'manifest.json', size=head['ContentLength'],
+                                                     etag=head.get('ETag'), stats=stats)
+    metrics.add('bytes_downloaded', stats.get('bytes', 0))
+    metrics.add('artifact_requests', stats.get('requests', 0))
+    manifest = json.loads(manifest_file)
+    manifest_cache.put(cache_key, manifest)
+  else:
+    metrics.add('manifest_cache_hits')
+  return manifest
 
 
-def put_job_success(job, message):
+def put_job_success(job, message, continuation_token=None):
   log.info('Putting job success')
   log.debug(message)
   try:
-    code_pipeline.put_job_success_result(jobId=job)
+    with metrics.phase('put_job_result'):
+      if continuation_token is not None:
+        code_pipeline.put_job_success_result(jobId=job, executionDetails={'summary': message[:2048]},
+                                             continuationToken=continuation_token)
+      else:
+        code_pipeline.put_job_success_result(jobId=job, executionDetails={'summary': message[:2048]})
   except Exception as e:
     log.critical(e)
 
@@ -130,6 +764,7 @@ def put_job_failure(job, message):
   log.info('Putting job failure')
   log.debug(message)
   try:
-    code_pipeline.put_job_failure_result(jobId=job, failureDetails={'message': message, 'type': 'JobFailed'})
+    with metrics.phase('put_job_result'):
+      code_pipeline.put_job_failure_result(jobId=job, failureDetails={'message': message[:5000], 'type': 'JobFailed'})
   except Exception as e:
     log.critical(e)
\ No newline at end of file
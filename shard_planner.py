@@ -0,0 +1,55 @@
+import json
+
+import s3_urls
+
+
+def list_objects(s3_client, bucket, prefix):
+  objects = []
+  for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+    for obj in page.get('Contents', []):
+      if not obj['Key'].endswith('/'):
+        objects.append((obj['Key'], obj['Size']))
+  return objects
+
+
+# Splits objects (key, size pairs) into shard_count groups with roughly the same number of bytes in each. It's the
+# usual largest-first greedy packing with one twist: no group is allowed more than its share of objects (the counts
+# differ by at most one). That cap rests on an assumption: that for a ManifestFile channel with ShardedByS3Key SageMaker
+# gives each instance a contiguous, equal-count slice of the manifest's keys in order. SageMaker doesn't document how it
+# splits a manifest. If it splits some other way every object still reaches exactly one instance, but the per instance
+# byte totals can come out as uneven as with a plain S3Prefix channel.
+def plan_shards(objects, shard_count):
+  if shard_count < 1:
+    raise ValueError('shard_count must be at least 1')
+  base, extra = divmod(len(objects), shard_count)
+  capacity = [base + (1 if i < extra else 0) for i in range(shard_count)]
+  shards = [[] for _ in range(shard_count)]
+  totals = [0] * shard_count
+  for key, size in sorted(objects, key=lambda obj: (-obj[1], obj[0])):
+    open_shards = [i for i in range(shard_count) if len(shards[i]) < capacity[i]]
+    i = min(open_shards, key=lambda s: (totals[s], s))
+    shards[i].append((key, size))
+    totals[i] += size
+  for shard in shards:
+    shard.sort()
+  return shards
+
+
+# SageMaker manifest file: a prefix followed by keys relative to it. Shards are written one after another so each
+# instance's slice of the keys is one planned shard.
+def build_manifest(bucket, prefix, shards):
+  manifest = [{'prefix': 's3://%s/%s' % (bucket, prefix)}]
+  for shard in shards:
+    manifest.extend(key[len(prefix):] for key, _ in shard)
+  return manifest
+
+
+def write_manifest(s3_client, url, manifest):
+  bucket, key = s3_urls.split_s3_url(url)
+  s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'),
+                       ContentType='application/json')
+  return url
+
+
+def describe_shards(shards):
+  return [{'objects': len(shard), 'bytes': sum(size for _, size in shard)} for shard in shards]
@@ -1,13 +1,73 @@
-import os
-import boto3
 import json
-import subprocess
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import dispatch_cache
+
+# Handles CodeCommit trigger notifications delivered through SNS. One invocation can carry several SNS records, each
+# message can hold several CodeCommit records and each of those several references, so every (repo, ref, commit) in the
+# batch is collected, duplicates are dropped and what's left is dispatched on a small pool. Warm containers remember
+# what they dispatched for DEDUP_TTL seconds, which covers SNS redelivering a message or the same push being published
+# twice.
+max_workers = int(os.environ.get('DISPATCH_WORKERS', '8'))
+recent_pushes = dispatch_cache.TTLCache(maxsize=int(os.environ.get('DEDUP_SIZE', '1024')),
+                                        ttl=float(os.environ.get('DEDUP_TTL', '900')))
+
+
+def clone_url(region, repo):
+  return 'https://git-codecommit.%s.amazonaws.com/v1/repos/%s' % (region, repo)
+
+
+# Every reference update in an SNS event, in order, as dicts of region, repo, ref and commit.
+def pushes(event):
+  for outer in event.get('Records', []):
+    message = json.loads(outer['Sns']['Message'])
+    for record in message.get('Records', []):
+      region = record['awsRegion']
+      repo = record['eventSourceARN'].split(':')[-1]
+      for reference in record.get('codecommit', {}).get('references', []):
+        yield {'region': region, 'repo': repo, 'ref': reference.get('ref'), 'commit': reference.get('commit')}
+
+
+def dispatch(push):
+  url = clone_url(push['region'], push['repo'])
+  print('%s %s %s' % (url, push['ref'], push['commit']))
+  return url
+
+
+# Dispatches every distinct push in the event with at most workers at a time and returns the counts for the batch.
+# dispatch_push is called with one push dict and seen is the cache of pushes already dispatched by earlier batches.
+def process_batch(event, dispatch_push=dispatch, workers=max_workers, seen=recent_pushes):
+  batch = {}
+  counts = {'sns_records': len(event.get('Records', [])), 'pushes': 0, 'duplicates': 0, 'dispatched': 0, 'failed': 0}
+  for push in pushes(event):
+    counts['pushes'] += 1
+    key = (push['region'], push['repo'], push['ref'], push['commit'])
+    if key in batch or seen.get(key) is not None:
+      counts['duplicates'] += 1
+      continue
+    batch[key] = push
+  if batch:
+    with ThreadPoolExecutor(max_workers=min(workers, len(batch))) as pool:
+      futures = dict((key, pool.submit(dispatch_push, push)) for key, push in batch.items())
+    for key, future in futures.items():
+      try:
+        future.result()
+      except Exception as e:
+        print('could not dispatch %s: %s' % (' '.join(str(part) for part in key), e))
+        counts['failed'] += 1
+        continue
+      seen.put(key, True)
+      counts['dispatched'] += 1
+  return counts
+
 
+# Lambda retries a failed asynchronous invocation, and since everything that did get dispatched is remembered a retry
+# only redoes the failures.
 def handler(event, context):
-  sns_message = event['Records'][0]['Sns']['Message']
-  message = json.loads(sns_message)
-  region = message['Records'][0]['awsRegion']
-  arn = message['Records'][0]['eventSourceARN']
-  repo = arn.split(":")[-1]
-  clone_url = 'https://git-codecommit.%s.amazonaws.com/v1/repos/%s' % (region, repo)
-  print clone_url
+  counts = process_batch(event)
+  print(json.dumps(counts))
+  if counts['failed']:
+    raise RuntimeError('%d of %d pushes could not be dispatched' % (
+      counts['failed'], counts['failed'] + counts['dispatched']))
+  return counts
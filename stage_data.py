@@ -0,0 +1,197 @@
+import argparse
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import boto3
+
+import s3_urls
+
+# Converts the raw training data under the input prefix into compressed shards that are cheaper to move into the
+# training containers. Every object is streamed line by line into shards of at most --shard-mb uncompressed bytes and
+# each shard is gzipped as plain lines, which Pipe mode streams into the container as text/csv. Objects are converted in
+# parallel, one per process. gzip is the only format: recordio-protobuf would need every row turned into numeric
+# feature tensors, which raw census csv (with its categorical columns) isn't without a feature pipeline.
+#
+# Shards land under <staging prefix>/<version>/<object>/ where the version is a hash of the source keys and etags and of
+# the shard size and compression level, so restaging unchanged data with the same settings is a no-op, restaging with
+# different ones writes a new version, and a job never reads a half written set of shards. Every source object gets a
+# prefix of its own so training and test data never end up in the same channel. Once a version is complete a pointer
+# at <staging prefix>/current.json is updated with each object's prefix and shards (under "objects", keyed by source
+# key), which is what sageDispatch reads when a manifest has "StagedInput": true.
+#
+# The staging prefix has to live outside the input prefix, otherwise jobs that read the raw input would pick the shards
+# up as well. The template points sageDispatch at staged/ in the output bucket.
+#
+#   python stage_data.py s3://123456789012inputbucket/ s3://123456789012outputbucket/staged/ --format gzip
+
+FORMATS = ('gzip',)
+CONTENT_TYPES = {'gzip': 'text/csv'}
+POINTER = 'current.json'
+CHUNK_SIZE = 1024 * 1024
+
+
+def iter_lines(body, chunk_size=CHUNK_SIZE):
+  pending = b''
+  while True:
+    chunk = body.read(chunk_size)
+    if not chunk:
+      break
+    lines = (pending + chunk).split(b'\n')
+    pending = lines.pop()
+    for line in lines:
+      yield line + b'\n'
+  if pending:
+    yield pending + b'\n'
+
+
+class ShardWriter(object):
+
+  def __init__(self, directory, name, shard_bytes, level=6):
+    self.directory = directory
+    self.name = name
+    self.shard_bytes = shard_bytes
+    self.level = level
+    self.paths = []
+    self.raw_bytes = 0
+    self._file = None
+    self._written = 0
+
+  def _next_shard(self):
+    self.close()
+    path = os.path.join(self.directory, '%s.part-%05d.gz' % (self.name, len(self.paths)))
+    self.paths.append(path)
+    self._file = gzip.open(path, 'wb', compresslevel=self.level)
+    self._written = 0
+
+  def write(self, line):
+    if self._file is None or self._written >= self.shard_bytes:
+      self._next_shard()
+    self._file.write(line)
+    self._written += len(line)
+    self.raw_bytes += len(line)
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
+def convert_stream(body, directory, name, shard_bytes, level=6):
+  writer = ShardWriter(directory, name, shard_bytes, level)
+  try:
+    for line in iter_lines(body):
+      writer.write(line)
+  finally:
+    writer.close()
+  return writer
+
+
+def source_version(objects, shard_bytes, level):
+  digest = hashlib.sha256(('%d %d\n' % (shard_bytes, level)).encode('utf-8'))
+  for obj in sorted(objects, key=lambda o: o['Key']):
+    digest.update(('%s %s\n' % (obj['Key'], obj['ETag'])).encode('utf-8'))
+  return digest.hexdigest()[:16]
+
+
+def _stage_object(args):
+  source_bucket, key, source_prefix, staging_bucket, version_prefix, fmt, shard_bytes, level = args
+  s3_client = boto3.client('s3')
+  directory = tempfile.mkdtemp()
+  try:
+    start = time.time()
+    body = s3_client.get_object(Bucket=source_bucket, Key=key)['Body']
+    name = key[len(source_prefix):].replace('/', '_')
+    writer = convert_stream(body, directory, name, shard_bytes, level)
+    object_prefix = version_prefix + name + '/'
+    shards = []
+    for path in writer.paths:
+      shard_key = object_prefix + os.path.basename(path)
+      s3_client.upload_file(path, staging_bucket, shard_key, ExtraArgs={'ContentType': CONTENT_TYPES[fmt]})
+      shards.append([shard_key, os.path.getsize(path)])
+    return {'key': key, 'prefix': 's3://%s/%s' % (staging_bucket, object_prefix), 'raw_bytes': writer.raw_bytes,
+            'shards': shards, 'seconds': time.time() - start}
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def stage_prefix(source_url, staging_url, fmt='gzip', processes=None, shard_mb=64, level=6, force=False):
+  if fmt not in FORMATS:
+    raise ValueError('format must be one of %s' % ', '.join(FORMATS))
+  source_bucket, source_prefix = s3_urls.split_s3_url(source_url)
+  staging_bucket, staging_prefix = s3_urls.split_s3_url(staging_url)
+  if source_bucket == staging_bucket and staging_prefix.startswith(source_prefix):
+    raise ValueError('the staging prefix %s is inside the input prefix %s' % (staging_url, source_url))
+  s3_client = boto3.client('s3')
+
+  objects = []
+  for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=source_bucket, Prefix=source_prefix):
+    for obj in page.get('Contents', []):
+      if not obj['Key'].endswith('/'):
+        objects.append(obj)
+  version = '%s-%s' % (fmt, source_version(objects, shard_mb * 1024 * 1024, level))
+  version_prefix = staging_prefix + version + '/'
+
+  pointer_key = staging_prefix + POINTER
+  try:
+    pointer = json.loads(s3_client.get_object(Bucket=staging_bucket, Key=pointer_key)['Body'].read())
+    if pointer['version'] == version and 'objects' in pointer and not force:
+      print('%s is already staged at %s' % (source_url, pointer['prefix']))
+      return pointer
+  except s3_client.exceptions.NoSuchKey:
+    pass
+
+  work = [(source_bucket, obj['Key'], source_prefix, staging_bucket, version_prefix, fmt, shard_mb * 1024 * 1024, level)
+          for obj in objects]
+  start = time.time()
+  pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+  try:
+    results = pool.map(_stage_object, work, chunksize=1)
+  finally:
+    pool.close()
+    pool.join()
+  elapsed = time.time() - start
+
+  raw_bytes = sum(r['raw_bytes'] for r in results)
+  shards = [shard for r in results for shard in r['shards']]
+  staged_bytes = sum(size for _, size in shards)
+  pointer = {
+    'version': version,
+    'format': fmt,
+    'prefix': 's3://%s/%s' % (staging_bucket, version_prefix),
+    'compression': 'Gzip',
+    'content_type': CONTENT_TYPES[fmt],
+    'shards': shards,
+    'objects': dict((r['key'], {'prefix': r['prefix'], 'shards': r['shards'], 'raw_bytes': r['raw_bytes']})
+                    for r in results),
+    'raw_bytes': raw_bytes,
+    'staged_bytes': staged_bytes
+  }
+  s3_client.put_object(Bucket=staging_bucket, Key=pointer_key, Body=json.dumps(pointer).encode('utf-8'),
+                       ContentType='application/json')
+  print('staged %d objects into %d shards in %.1fs: %.1f MB -> %.1f MB (%.1f MB/s)' % (
+    len(objects), len(shards), elapsed, raw_bytes / 1048576.0, staged_bytes / 1048576.0,
+    raw_bytes / 1048576.0 / max(elapsed, 1e-9)))
+  return pointer
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Stage raw training data as compressed shards.')
+  parser.add_argument('source', help='s3 url of the raw input prefix, e.g. s3://bucket/')
+  parser.add_argument('staging', help='s3 url of the prefix to stage into, e.g. s3://outputbucket/staged/')
+  parser.add_argument('--format', choices=FORMATS, default='gzip')
+  parser.add_argument('--processes', type=int)
+  parser.add_argument('--shard-mb', type=int, default=64)
+  parser.add_argument('--level', type=int, default=6, help='gzip compression level')
+  parser.add_argument('--force', action='store_true', help='restage even if this version is already staged')
+  args = parser.parse_args()
+  stage_prefix(args.source, args.staging, args.format, args.processes, args.shard_mb, args.level, args.force)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,22 @@
+import os
+
+# sageDispatch and the other lambda modules read their configuration from the environment when imported. These are
+# enough for them to import and run against the fakes in the tests without aws credentials.
+TEST_ENV = {
+  'AWS_DEFAULT_REGION': 'us-west-2',
+  'AWS_ACCESS_KEY_ID': 'test',
+  'AWS_SECRET_ACCESS_KEY': 'test',
+  'LOG_LEVEL': 'ERROR',
+  'METRICS_SINK': 'off',
+  'APP_BUNDLE': 'output',
+  'CODE_COMMIT_REPO': 'census',
+  'TRAINING_IMAGE': '007038732177.dkr.ecr.us-west-2.amazonaws.com/census',
+  'SAGEMAKER_ROLE_ARN': 'arn:aws:iam::007038732177:role/SagemakerExecutionRole',
+  'INPUT_BUCKET': 's3://test-input/',
+  'OUTPUT_BUCKET': 's3://test-output/output/',
+  'STAGING_URL': 's3://test-output/staged/',
+  'BUCKET_KEY_ARN': 'arn:aws:kms:us-west-2:007038732177:key/test'
+}
+
+for name, value in TEST_ENV.items():
+  os.environ.setdefault(name, value)
@@ -0,0 +1,136 @@
+import io
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+import athena_cache
+import s3_urls
+
+
+@pytest.mark.parametrize('url, parts', [
+  ('s3://bucket/some/key.csv', ('bucket', 'some/key.csv')),
+  ('s3://bucket/prefix/', ('bucket', 'prefix/')),
+  ('s3://bucket/', ('bucket', '')),
+  ('s3://bucket', ('bucket', ''))
+])
+def test_split_s3_url(url, parts):
+  assert s3_urls.split_s3_url(url) == parts
+
+
+def test_fingerprints_ignore_whitespace_outside_quotes():
+  a = athena_cache.fingerprint("SELECT  *\n FROM census WHERE name = 'a  b';", 'db', 'v1')
+  assert a == athena_cache.fingerprint("SELECT * FROM census WHERE name = 'a  b'", 'db', 'v1')
+  assert a != athena_cache.fingerprint("SELECT * FROM census WHERE name = 'a b'", 'db', 'v1')
+  assert a != athena_cache.fingerprint("SELECT * FROM census WHERE name = 'a  b'", 'db', 'v2')
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+# Counts loads and saves.
+class MemoryIndex(object):
+
+  def __init__(self, entries=None):
+    self.entries = dict(entries or {})
+    self.loads = 0
+    self.saves = 0
+
+  def load(self):
+    self.loads += 1
+    return dict(self.entries)
+
+  def save(self, entries):
+    self.saves += 1
+    self.entries = dict(entries)
+
+
+def execution(query_id):
+  return {'QueryExecutionId': query_id, 'ResultConfiguration': {'OutputLocation': 's3://results/%s.csv' % query_id}}
+
+
+def test_cache_loads_lazily_and_flushes_only_when_changed():
+  index, clock = MemoryIndex(), FakeClock()
+  cache = athena_cache.QueryResultCache(index, clock=clock)
+  assert index.loads == 0
+  assert cache.get('a') is None
+  cache.flush()
+  assert (index.loads, index.saves) == (1, 0)
+
+  cache.put('a', execution('q-1'))
+  assert cache.get('a')['output_location'] == 's3://results/q-1.csv'
+  cache.flush()
+  cache.flush()
+  assert index.saves == 1
+  assert (cache.hits, cache.misses) == (1, 1)
+  assert index.entries['a'] == {'created': 1000.0, 'query_execution_id': 'q-1',
+                                'output_location': 's3://results/q-1.csv'}
+
+
+def test_expired_entries_are_dropped():
+  clock = FakeClock()
+  index = MemoryIndex({'old': {'created': 0.0, 'query_execution_id': 'q-0', 'output_location': 's3://results/q-0.csv'}})
+  cache = athena_cache.QueryResultCache(index, ttl=500, clock=clock)
+  cache.put('a', execution('q-1'))
+  assert 'old' not in cache._entries
+  clock.now += 501
+  assert cache.get('a') is None
+  cache.flush()
+  assert index.entries == {}
+
+
+def test_the_oldest_entries_go_once_the_cache_is_full():
+  clock = FakeClock()
+  index = MemoryIndex()
+  cache = athena_cache.QueryResultCache(index, ttl=None, max_entries=3, clock=clock)
+  for i in range(5):
+    clock.now += 1
+    cache.put('q%d' % i, execution('q-%d' % i))
+  cache.flush()
+  assert sorted(index.entries) == ['q2', 'q3', 'q4']
+  cache.discard('q3')
+  cache.discard('missing')
+  cache.flush()
+  assert sorted(index.entries) == ['q2', 'q4']
+
+
+def test_local_index_round_trips(tmp_path):
+  index = athena_cache.LocalIndex(str(tmp_path / 'index.json'))
+  assert index.load() == {}
+  index.save({'a': {'created': 1}})
+  assert index.load() == {'a': {'created': 1}}
+  assert [path.name for path in tmp_path.iterdir()] == ['index.json']
+
+
+class FakeS3(object):
+
+  def __init__(self, error=None):
+    self.objects = {}
+    self.error = error
+
+  def get_object(self, Bucket, Key):
+    if self.error:
+      raise ClientError({'Error': {'Code': self.error}}, 'GetObject')
+    if (Bucket, Key) not in self.objects:
+      raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+  def put_object(self, Bucket, Key, Body):
+    self.objects[(Bucket, Key)] = Body
+
+
+def test_s3_index_treats_a_missing_object_as_empty():
+  s3 = FakeS3()
+  index = athena_cache.S3Index(s3, 'cache', 'athena/index.json')
+  assert index.load() == {}
+  index.save({'a': {'created': 1}})
+  assert json.loads(s3.objects[('cache', 'athena/index.json')]) == {'a': {'created': 1}}
+  assert index.load() == {'a': {'created': 1}}
+  with pytest.raises(ClientError):
+    athena_cache.S3Index(FakeS3('AccessDenied'), 'cache', 'athena/index.json').load()
@@ -0,0 +1,186 @@
+import threading
+
+import pytest
+
+import athena_query
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 0.0
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+
+# Queries finish durations[sql] seconds after they're submitted, or fail if the sql says so.
+class FakeAthena(object):
+
+  def __init__(self, clock, durations):
+    self.clock = clock
+    self.durations = durations
+    self.started = {}
+    self.calls = {'start_query_execution': 0, 'batch_get_query_execution': 0}
+    self._lock = threading.Lock()
+
+  def start_query_execution(self, QueryString, QueryExecutionContext, ResultConfiguration):
+    with self._lock:
+      self.calls['start_query_execution'] += 1
+      query_id = 'q-%d' % len(self.started)
+      self.started[query_id] = (QueryString, self.clock.time())
+    return {'QueryExecutionId': query_id}
+
+  def batch_get_query_execution(self, QueryExecutionIds):
+    assert len(QueryExecutionIds) <= athena_query.BATCH_SIZE
+    self.calls['batch_get_query_execution'] += 1
+    executions = []
+    unprocessed = []
+    for query_id in QueryExecutionIds:
+      if query_id not in self.started:
+        unprocessed.append({'QueryExecutionId': query_id, 'ErrorCode': 'InvalidRequestException',
+                            'ErrorMessage': 'QueryExecution %s was not found' % query_id})
+        continue
+      sql, started = self.started[query_id]
+      if self.clock.time() - started < self.durations.get(sql, 0):
+        state = 'RUNNING'
+      else:
+        state = 'FAILED' if 'fail' in sql else 'SUCCEEDED'
+      executions.append({'QueryExecutionId': query_id, 'Query': sql, 'Status': {'State': state},
+                         'ResultConfiguration': {'OutputLocation': 's3://results/%s.csv' % query_id}})
+    return {'QueryExecutions': executions, 'UnprocessedQueryExecutionIds': unprocessed}
+
+
+def runner_for(durations, **kwargs):
+  clock = FakeClock()
+  client = FakeAthena(clock, durations)
+  runner = athena_query.AthenaRunner(client=client, s3_client=object(), clock=clock.time, sleep=clock.sleep, **kwargs)
+  return runner, client, clock
+
+
+def test_run_returns_executions_in_query_order():
+  runner, client, _ = runner_for({'a': 3, 'b': 0.1, 'c': 1})
+  executions = runner.run(['a', 'b', 'c'])
+  assert [e['Query'] for e in executions] == ['a', 'b', 'c']
+  assert all(e['Status']['State'] == 'SUCCEEDED' for e in executions)
+
+
+def test_mixed_batch_latency_and_call_count():
+  durations = dict(('query-%d' % i, [0.1, 0.5, 2, 8, 30][i % 5]) for i in range(120))
+  runner, client, clock = runner_for(durations)
+  runner.run(sorted(durations))
+
+  # Finishes within one (capped) poll interval of the slowest query.
+  assert clock.now < 30 + runner.max_interval
+  # 120 submissions, then one batch call per 50 outstanding ids per round. A fixed 2s poll of each query on its own
+  # would take well over a thousand calls for the same batch.
+  assert client.calls['start_query_execution'] == 120
+  assert runner.api_calls == client.calls['start_query_execution'] + client.calls['batch_get_query_execution']
+  assert runner.api_calls <= 150
+
+
+def test_poll_interval_grows_to_the_cap():
+  runner, _, _ = runner_for({'slow': 60}, min_interval=0.2, max_interval=5.0)
+  sleeps = []
+  clock_sleep = runner.sleep
+
+  def sleep(seconds):
+    sleeps.append(seconds)
+    clock_sleep(seconds)
+  runner.sleep = sleep
+  runner.run(['slow'])
+  assert sleeps[:4] == pytest.approx([0.2, 0.4, 0.8, 1.6])
+  assert max(sleeps) == 5.0
+
+
+def test_concurrent_submissions_are_all_counted():
+  runner, client, _ = runner_for({}, max_submitters=8)
+  runner.submit_all(['query-%d' % i for i in range(200)])
+  assert client.calls['start_query_execution'] == 200
+  assert runner.api_calls == 200
+
+
+def test_failed_query_raises_unless_told_not_to():
+  runner, _, _ = runner_for({})
+  with pytest.raises(athena_query.QueryFailed):
+    runner.run(['ok', 'please fail'])
+  runner, _, _ = runner_for({})
+  executions = runner.run(['ok', 'please fail'], raise_on_failure=False)
+  assert [e['Status']['State'] for e in executions] == ['SUCCEEDED', 'FAILED']
+
+
+def test_wait_times_out():
+  runner, _, _ = runner_for({'forever': 1e9})
+  with pytest.raises(RuntimeError):
+    runner.run(['forever'], timeout=10)
+
+
+def test_ids_athena_cannot_find_fail_instead_of_waiting_forever():
+  runner, _, _ = runner_for({'a': 10})
+  query_id = runner.submit('a')
+  finished = runner.wait([query_id, 'expired'])
+  assert finished[query_id]['Status']['State'] == 'SUCCEEDED'
+  assert finished['expired']['Status']['State'] == 'FAILED'
+  assert 'was not found' in finished['expired']['Status']['StateChangeReason']
+  assert 'expired FAILED' in str(athena_query.QueryFailed([finished['expired']]))
+  assert runner.wait(['expired'])['expired']['Status']['State'] == 'FAILED'
+
+
+# An s3 StreamingBody that hands out at most page_size bytes per read, so a result arrives over many reads with rows
+# (and quoted values) split across them.
+class PagedBody(object):
+
+  def __init__(self, data, page_size):
+    self.data = data
+    self.page_size = page_size
+    self.reads = 0
+    self.closed = False
+
+  def read(self, size=-1):
+    self.reads += 1
+    size = self.page_size if size < 0 else min(size, self.page_size)
+    chunk, self.data = self.data[:size], self.data[size:]
+    return chunk
+
+  def close(self):
+    self.closed = True
+
+
+def csv_result(rows):
+  lines = ['"age","name","note"'] + ['"%d","name-%d","%s"' % (i, i, 'line one\nline two' if i == 3 else '')
+                                      for i in range(rows)]
+  return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def test_record_batches_skip_only_the_header_and_keep_the_remainder():
+  # The last row repeats the header: only the first one is skipped, anything like it further on is data.
+  body = PagedBody(csv_result(25) + b'"age","name","note"\n', page_size=7)
+  batches = list(athena_query.iter_record_batches(body, batch_size=10, chunk_size=16))
+  assert [len(batch) for batch in batches] == [10, 10, 6]
+  rows = [row for batch in batches for row in batch]
+  assert rows[0] == ['0', 'name-0', ''] and rows[24] == ['24', 'name-24', '']
+  assert rows[-1] == ['age', 'name', 'note']
+  assert rows[3][2] == 'line one\nline two'
+  assert body.reads > 25
+
+
+def test_record_batches_of_an_empty_result():
+  assert list(athena_query.iter_record_batches(PagedBody(b'', 7))) == []
+  assert list(athena_query.iter_record_batches(PagedBody(b'"age","name"\n', 7))) == []
+
+
+def test_result_batches_read_from_the_output_location_and_close_the_body():
+  body = PagedBody(csv_result(4), page_size=5)
+
+  class FakeS3(object):
+    def get_object(self, Bucket, Key):
+      assert (Bucket, Key) == ('results', 'q-1.csv')
+      return {'Body': body}
+
+  runner = athena_query.AthenaRunner(client=object(), s3_client=FakeS3())
+  execution = {'ResultConfiguration': {'OutputLocation': 's3://results/q-1.csv'}}
+  assert [len(batch) for batch in runner.iter_result_batches(execution, batch_size=3, chunk_size=8)] == [3, 1]
+  assert body.closed
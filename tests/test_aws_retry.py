@@ -0,0 +1,196 @@
+import boto3.session
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from botocore.stub import Stubber
+
+import aws_retry
+
+
+def client_error(code, status=400):
+  return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'Operation')
+
+
+class Context(object):
+
+  def __init__(self, remaining_ms):
+    self.remaining_ms = remaining_ms
+
+  def get_remaining_time_in_millis(self):
+    return self.remaining_ms
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 1000.0
+    self.sleeps = []
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+
+def policy(clock, **kwargs):
+  # Always back off the most it's allowed to so the delays are predictable.
+  return aws_retry.RetryPolicy(clock=clock.time, sleep=clock.sleep, rand=lambda low, high: high, **kwargs)
+
+
+def failing(errors, result='ok'):
+  errors = list(errors)
+
+  def call():
+    if errors:
+      raise errors.pop(0)
+    return result
+  return call
+
+
+@pytest.mark.parametrize('error, kind', [
+  (client_error('ThrottlingException'), aws_retry.THROTTLING),
+  (client_error('SlowDown', 503), aws_retry.THROTTLING),
+  (client_error('Whatever', 429), aws_retry.THROTTLING),
+  (client_error('InternalError', 500), aws_retry.RETRYABLE),
+  (client_error('Unknown', 502), aws_retry.RETRYABLE),
+  (EndpointConnectionError(endpoint_url='https://s3'), aws_retry.RETRYABLE),
+  (client_error('AccessDenied', 403), aws_retry.FATAL),
+  (client_error('ValidationException'), aws_retry.FATAL),
+  (KeyError('x'), aws_retry.FATAL)
+])
+def test_classify(error, kind):
+  assert aws_retry.classify(error) == kind
+
+
+def test_retries_throttling_until_it_succeeds():
+  clock = FakeClock()
+  retry = policy(clock)
+  retry.start(Context(60000))
+  assert retry.call(failing([client_error('Throttling')] * 3)) == 'ok'
+  assert retry.stats() == {'calls': 4, 'retries': 3, 'throttles': 3, 'backoff_seconds': pytest.approx(0.3 + 0.9 + 2.7)}
+  assert clock.sleeps == pytest.approx([0.3, 0.9, 2.7])
+
+
+def test_backoff_is_capped():
+  clock = FakeClock()
+  retry = policy(clock, cap=1.0)
+  retry.call(failing([client_error('InternalError', 500)] * 5))
+  assert max(clock.sleeps) == 1.0
+
+
+def test_fatal_errors_are_not_retried():
+  clock = FakeClock()
+  retry = policy(clock)
+  with pytest.raises(ClientError):
+    retry.call(failing([client_error('AccessDenied', 403)]))
+  assert retry.stats()['retries'] == 0
+
+
+def test_gives_up_after_max_attempts():
+  clock = FakeClock()
+  retry = policy(clock, max_attempts=3)
+  with pytest.raises(ClientError):
+    retry.call(failing([client_error('Throttling')] * 10))
+  assert retry.stats()['calls'] == 3
+
+
+def test_never_sleeps_past_the_deadline():
+  clock = FakeClock()
+  retry = policy(clock, reserve=5.0)
+  # 7s left less the 5s reserve: 0.3 and 0.9 fit, the next 2.7s backoff doesn't.
+  retry.start(Context(7000))
+  with pytest.raises(ClientError):
+    retry.call(failing([client_error('Throttling')] * 10))
+  assert clock.sleeps == pytest.approx([0.3, 0.9])
+  assert clock.now <= 1000.0 + 2.0
+
+
+def test_start_resets_the_counters_and_deadline():
+  clock = FakeClock()
+  retry = policy(clock)
+  retry.start(Context(60000))
+  retry.call(failing([client_error('Throttling')]))
+  retry.start()
+  assert retry.stats()['calls'] == 0
+  assert retry.remaining() is None
+
+
+TRAINING_JOB = {
+  'TrainingJobName': 'census-26-10-17-10-00',
+  'AlgorithmSpecification': {'TrainingImage': '007038732177.dkr.ecr.us-west-2.amazonaws.com/census:abc123',
+                             'TrainingInputMode': 'File'},
+  'RoleArn': 'arn:aws:iam::007038732177:role/SagemakerExecutionRole',
+  'OutputDataConfig': {'S3OutputPath': 's3://test-output/output/'},
+  'ResourceConfig': {'InstanceType': 'ml.m5.xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 10},
+  'StoppingCondition': {'MaxRuntimeInSeconds': 3600}
+}
+CREATED = {'TrainingJobArn': 'arn:aws:sagemaker:us-west-2:007038732177:training-job/census-26-10-17-10-00'}
+
+
+# A real sagemaker client behind a Stubber, wrapped the way the lambdas wrap theirs.
+@pytest.fixture
+def stubbed():
+  clock = FakeClock()
+  retry = policy(clock)
+  client = boto3.session.Session(region_name='us-west-2').client('sagemaker', config=aws_retry.client_config())
+  with Stubber(client) as stubber:
+    yield aws_retry.RetryingClient(client, retry), stubber, retry, clock
+
+
+def test_stubbed_throttling_is_retried_until_the_job_is_created(stubbed):
+  client, stubber, retry, clock = stubbed
+  for _ in range(3):
+    stubber.add_client_error('create_training_job', 'ThrottlingException', 'Rate exceeded', 400)
+  stubber.add_response('create_training_job', CREATED, TRAINING_JOB)
+  assert client.create_training_job(**TRAINING_JOB) == CREATED
+  stubber.assert_no_pending_responses()
+  assert retry.stats()['throttles'] == 3
+  assert clock.sleeps == pytest.approx([0.3, 0.9, 2.7])
+
+
+def test_stubbed_server_errors_are_retried_on_idempotent_calls(stubbed):
+  client, stubber, retry, _ = stubbed
+  stubber.add_client_error('list_training_jobs', 'InternalFailure', 'oops', 500)
+  stubber.add_client_error('list_training_jobs', 'ServiceUnavailable', 'oops', 503)
+  stubber.add_response('list_training_jobs', {'TrainingJobSummaries': []})
+  assert client.list_training_jobs() == {'TrainingJobSummaries': []}
+  stubber.assert_no_pending_responses()
+  assert retry.stats()['retries'] == 2 and retry.stats()['throttles'] == 0
+
+
+def test_stubbed_server_errors_are_not_retried_on_create_training_job(stubbed):
+  client, stubber, retry, clock = stubbed
+  stubber.add_client_error('create_training_job', 'InternalFailure', 'oops', 500)
+  stubber.add_response('create_training_job', CREATED, TRAINING_JOB)
+  with pytest.raises(ClientError):
+    client.create_training_job(**TRAINING_JOB)
+  assert retry.stats() == {'calls': 1, 'retries': 0, 'throttles': 0, 'backoff_seconds': 0.0}
+  assert clock.sleeps == []
+
+
+def test_stubbed_validation_errors_are_not_retried(stubbed):
+  client, stubber, retry, _ = stubbed
+  stubber.add_client_error('create_training_job', 'ValidationException', 'Training job names must be unique', 400)
+  with pytest.raises(ClientError, match='must be unique'):
+    client.create_training_job(**TRAINING_JOB)
+  stubber.assert_no_pending_responses()
+  assert retry.stats()['calls'] == 1
+
+
+def test_stubbed_retries_stop_at_the_deadline(stubbed):
+  client, stubber, retry, clock = stubbed
+  retry.start(Context(7000))
+  for _ in range(5):
+    stubber.add_client_error('create_training_job', 'ThrottlingException', 'Rate exceeded', 400)
+  with pytest.raises(ClientError, match='Rate exceeded'):
+    client.create_training_job(**TRAINING_JOB)
+  assert clock.sleeps == pytest.approx([0.3, 0.9])
+  assert retry.stats()['calls'] == 3
+
+
+def test_only_api_calls_go_through_the_policy(stubbed):
+  client, _, _, _ = stubbed
+  assert client.meta.service_model.service_name == 'sagemaker'
+  assert client.get_paginator('list_training_jobs') is not None
+  assert client.create_training_job.__name__ == 'create_training_job'
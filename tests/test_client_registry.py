@@ -0,0 +1,115 @@
+import os
+import subprocess
+import sys
+import threading
+
+import boto3.session
+from botocore.stub import Stubber
+
+import aws_retry
+import check_import_time
+import training_index
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class Meta(object):
+  method_to_api_mapping = {'list_buckets': 'ListBuckets'}
+
+
+class FakeClient(object):
+  meta = Meta()
+
+  def __init__(self, service):
+    self.service = service
+
+  def list_buckets(self):
+    return {'Buckets': [], 'Service': self.service}
+
+
+# A boto3 session that counts the clients it builds and holds each one up a little so racing threads overlap.
+class FakeSession(object):
+
+  def __init__(self):
+    self.clients = []
+
+  def client(self, service, config=None):
+    self.clients.append(service)
+    threading.Event().wait(0.01)
+    return FakeClient(service)
+
+
+def test_importing_the_dispatcher_builds_nothing_and_needs_no_output_bucket():
+  env = dict(os.environ)
+  env.pop('OUTPUT_BUCKET', None)
+  script = ('import sys, sageDispatch; '
+            'print("boto3" in sys.modules, sageDispatch.clients.created(), repr(sageDispatch.dedup_index))')
+  result = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env, capture_output=True, text=True)
+  assert result.returncode == 0, result.stderr
+  assert result.stdout.split() == ['False', '[]', '<LazyIndex', '(not', 'built)>']
+
+
+def test_clients_are_built_once_from_one_session_across_threads():
+  sessions = []
+
+  def session_factory():
+    sessions.append(FakeSession())
+    return sessions[-1]
+
+  registry = aws_retry.ClientRegistry(aws_retry.RetryPolicy(), session_factory)
+  s3 = registry.lazy('s3')
+  assert sessions == [] and registry.created() == []
+
+  results = []
+  threads = [threading.Thread(target=lambda service: results.append(registry.get(service)), args=(service,))
+             for service in ('s3', 'sagemaker') * 8]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  assert len(sessions) == 1
+  assert sorted(sessions[0].clients) == ['s3', 'sagemaker']
+  assert registry.created() == ['s3', 'sagemaker']
+  assert len(set(id(client) for client in results)) == 2
+  assert s3.list_buckets()['Service'] == 's3'
+
+
+def test_installed_clients_take_the_place_of_built_ones():
+  registry = aws_retry.ClientRegistry(aws_retry.RetryPolicy(), session_factory=lambda: 1 / 0)
+  registry.install('s3', FakeClient('stand-in'))
+  assert registry.created() == ['s3']
+  assert isinstance(registry.get('s3'), aws_retry.RetryingClient)
+  assert registry.lazy('s3').list_buckets()['Service'] == 'stand-in'
+
+
+def test_a_stubbed_client_answers_through_the_lazy_proxy():
+  client = boto3.session.Session(region_name='us-west-2').client('s3', config=aws_retry.client_config())
+  registry = aws_retry.ClientRegistry(aws_retry.RetryPolicy())
+  registry.install('s3', client)
+  with Stubber(client) as stubber:
+    stubber.add_response('list_buckets', {'Buckets': [{'Name': 'census'}]})
+    assert registry.lazy('s3').list_buckets()['Buckets'][0]['Name'] == 'census'
+    stubber.assert_no_pending_responses()
+
+
+def test_lazy_indexes_look_their_url_up_on_first_use():
+  urls = []
+
+  def url():
+    urls.append('s3://output/index/jobs/')
+    return urls[-1]
+
+  index = training_index.LazyIndex(object(), url)
+  assert urls == []
+  assert (index.bucket, index.prefix) == ('output', 'index/jobs/')
+  assert index.bucket == 'output' and len(urls) == 1
+
+
+# The cold start budget, held in the suite as well as by check_import_time.py. CI machines are slower and noisier than
+# a lambda, so the default is well above the script's; IMPORT_BUDGET_MS tightens or loosens it.
+def test_importing_the_dispatcher_stays_within_the_budget():
+  env = dict(os.environ)
+  env.pop('OUTPUT_BUCKET', None)
+  budget_ms = float(os.environ.get('IMPORT_BUDGET_MS', 4 * check_import_time.DEFAULT_BUDGET_MS))
+  report = check_import_time.check('sageDispatch', budget_ms, runs=3, forbid=['boto3'], top=5, env=env)
+  assert report['ok'], report
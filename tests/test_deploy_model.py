@@ -0,0 +1,194 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import deploy_model
+
+IMAGE = '007038732177.dkr.ecr.us-west-2.amazonaws.com/census:abc123'
+ARTIFACTS = 's3://census-output-us-west-2/output/census-1/output/model.tar.gz'
+TRAINING_JOB = {
+  'TrainingJobName': 'census-1',
+  'TrainingJobArn': 'arn:aws:sagemaker:us-west-2:007038732177:training-job/census-1',
+  'TrainingJobStatus': 'Completed',
+  'AlgorithmSpecification': {'TrainingImage': IMAGE},
+  'ModelArtifacts': {'S3ModelArtifacts': ARTIFACTS},
+  'RoleArn': 'arn:aws:iam::007038732177:role/SagemakerExecutionRole'
+}
+
+
+def not_found(code, message='not found'):
+  return ClientError({'Error': {'Code': code, 'Message': message}}, 'Operation')
+
+
+class FakeClock(object):
+
+  def __init__(self):
+    self.now = 0.0
+    self.sleeps = []
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+
+# A sagemaker client for one region. After a create or update describe_endpoint walks through statuses, ending on the
+# last one. With rolls_back the endpoint ends up back on its previous config. Like the real one it only knows about
+# resources in its own region.
+class FakeSageMaker(object):
+
+  def __init__(self, existing_config=None, statuses=('Creating', 'Creating', 'InService'), rolls_back=False,
+               region='us-west-2'):
+    self.region = region
+    self.calls = []
+    self.models = {}
+    self.config = existing_config
+    self.previous_config = existing_config
+    self.statuses = list(statuses)
+    self.rolls_back = rolls_back
+    self.status = 'InService'
+
+  def describe_training_job(self, TrainingJobName):
+    self.calls.append('describe_training_job')
+    if self.region != 'us-west-2':
+      raise not_found('ValidationException', 'Requested resource not found.')
+    return dict(TRAINING_JOB)
+
+  def list_tags(self, ResourceArn):
+    self.calls.append('list_tags')
+    if ResourceArn.split(':')[3] != self.region:
+      raise not_found('ValidationException', '%s is not in %s' % (ResourceArn, self.region))
+    return {'Tags': [{'Key': 'commitID', 'Value': 'abc123'}]}
+
+  def create_model(self, ModelName, PrimaryContainer, ExecutionRoleArn, Tags):
+    self.calls.append('create_model')
+    self.tags = Tags
+    self.models[ModelName] = PrimaryContainer
+
+  def create_endpoint_config(self, EndpointConfigName, ProductionVariants, Tags):
+    self.calls.append('create_endpoint_config')
+
+  def _changing(self, config):
+    self.previous_config, self.config = self.config, config
+    self.pending = list(self.statuses)
+
+  def create_endpoint(self, EndpointName, EndpointConfigName, Tags):
+    self.calls.append('create_endpoint')
+    self._changing(EndpointConfigName)
+
+  def update_endpoint(self, EndpointName, EndpointConfigName):
+    self.calls.append('update_endpoint')
+    self._changing(EndpointConfigName)
+
+  def describe_endpoint(self, EndpointName):
+    self.calls.append('describe_endpoint')
+    if self.config is None:
+      raise not_found('ValidationException', 'Could not find endpoint %s' % EndpointName)
+    if getattr(self, 'pending', None):
+      self.status = self.pending.pop(0)
+      if not self.pending and self.rolls_back:
+        self.config = self.previous_config
+    return {'EndpointName': EndpointName, 'EndpointArn': 'arn:endpoint/' + EndpointName,
+            'EndpointConfigName': self.config, 'EndpointStatus': self.status, 'FailureReason': 'bad model'}
+
+
+class FakeECR(object):
+
+  def __init__(self, images):
+    self.images = images
+
+  def describe_images(self, registryId, repositoryName, imageIds):
+    if (repositoryName, imageIds[0].get('imageTag')) not in self.images:
+      raise not_found('ImageNotFoundException')
+    return {'imageDetails': [{'imageDigest': 'sha256:1'}]}
+
+
+class FakeS3(object):
+
+  def __init__(self):
+    self.objects = set()
+    self.copies = []
+
+  def head_object(self, Bucket, Key):
+    if (Bucket, Key) not in self.objects:
+      raise not_found('404')
+    return {}
+
+  def copy(self, CopySource, Bucket, Key):
+    self.copies.append((CopySource['Bucket'], CopySource['Key'], Bucket, Key))
+    self.objects.add((Bucket, Key))
+
+
+def run_deploy(targets, sagemakers, regional=None, **kwargs):
+  clock = FakeClock()
+  regional = regional or {}
+  reports = deploy_model.deploy('census-1', targets, source_region='us-west-2',
+                                client_factory=lambda region: sagemakers[region],
+                                regional_client_factory=lambda service, region: regional[(service, region)],
+                                clock=clock.time, sleep=clock.sleep, min_interval=5.0, max_interval=60.0, **kwargs)
+  return reports, clock
+
+
+def test_new_endpoint_is_created_and_waited_for():
+  sagemaker = FakeSageMaker()
+  reports, clock = run_deploy([('production', 'us-west-2')], {'us-west-2': sagemaker})
+  report = reports[0]
+  assert report['status'] == 'InService' and report['action'] == 'created'
+  assert report['polls'] == 3
+  assert clock.sleeps == [5.0, 5.0 * 1.5]
+  assert set(report['timings']) >= set(['list_tags', 'create_model', 'create_endpoint_config',
+                                         'create_or_update_endpoint', 'wait_in_service', 'describe_training_job'])
+  assert sagemaker.models['census-1'] == {'Image': IMAGE, 'ModelDataUrl': ARTIFACTS}
+
+
+def test_update_that_rolls_back_fails():
+  sagemaker = FakeSageMaker(existing_config='census-production-old', statuses=('Updating', 'RollingBack',
+                                                                               'InService'), rolls_back=True)
+  report = run_deploy([('production', 'us-west-2')], {'us-west-2': sagemaker})[0][0]
+  assert report['action'] == 'updated'
+  assert report['status'] == 'Failed' and 'rolled back' in report['error']
+
+
+def test_waiter_backs_off_resets_on_status_change_and_times_out():
+  sagemaker = FakeSageMaker(statuses=['Creating'] * 6 + ['Updating'] * 2 + ['InService'])
+  reports, clock = run_deploy([('production', 'us-west-2')], {'us-west-2': sagemaker})
+  assert reports[0]['status'] == 'InService'
+  assert clock.sleeps[:3] == [5.0, 7.5, 11.25]
+  assert clock.sleeps[6] == 5.0
+
+  sagemaker = FakeSageMaker(statuses=['Creating'] * 1000)
+  report = run_deploy([('production', 'us-west-2')], {'us-west-2': sagemaker}, timeout=600)[0][0]
+  assert report['status'] == 'Failed' and 'still Creating' in report['error']
+
+
+def test_other_regions_get_their_own_image_and_a_copy_of_the_artifacts():
+  home, away, s3 = FakeSageMaker(), FakeSageMaker(region='eu-west-1'), FakeS3()
+  regional = {('ecr', 'eu-west-1'): FakeECR([('census', 'abc123')]), ('s3', 'eu-west-1'): s3}
+  reports, _ = run_deploy([('production', 'us-west-2'), ('production', 'eu-west-1')],
+                          {'us-west-2': home, 'eu-west-1': away}, regional,
+                          artifact_locations={'eu-west-1': 's3://census-models-eu-west-1/models/'})
+  assert [report['status'] for report in reports] == ['InService', 'InService']
+  assert home.models['census-1'] == {'Image': IMAGE, 'ModelDataUrl': ARTIFACTS}
+  assert away.models['census-1'] == {
+    'Image': '007038732177.dkr.ecr.eu-west-1.amazonaws.com/census:abc123',
+    'ModelDataUrl': 's3://census-models-eu-west-1/models/census-1/model.tar.gz'}
+  assert s3.copies == [('census-output-us-west-2', 'output/census-1/output/model.tar.gz', 'census-models-eu-west-1',
+                        'models/census-1/model.tar.gz')]
+  # The tags come from the training job's region, once, and go on every region's resources.
+  assert home.calls.count('list_tags') == 1 and 'list_tags' not in away.calls
+  assert away.tags == [{'Key': 'commitID', 'Value': 'abc123'}]
+
+
+@pytest.mark.parametrize('images, locations, error', [
+  ([], {'eu-west-1': 's3://census-models-eu-west-1/models/'}, 'replicate the image'),
+  ([('census', 'abc123')], {}, 'needs an artifact location')
+])
+def test_other_regions_fail_before_creating_anything(images, locations, error):
+  home, away = FakeSageMaker(), FakeSageMaker(region='eu-west-1')
+  regional = {('ecr', 'eu-west-1'): FakeECR(images), ('s3', 'eu-west-1'): FakeS3()}
+  reports, _ = run_deploy([('production', 'us-west-2'), ('production', 'eu-west-1')],
+                          {'us-west-2': home, 'eu-west-1': away}, regional, artifact_locations=locations)
+  assert reports[0]['status'] == 'InService'
+  assert reports[1]['status'] == 'Failed' and error in reports[1]['error']
+  assert away.calls == []
@@ -0,0 +1,113 @@
+import json
+import os
+
+import aws_retry
+import bench_dispatch
+import dispatch_cache
+import dispatch_metrics
+import sageDispatch
+import token_bucket
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PHASES = ('get_manifest', 'artifact_head', 'artifact_read', 'send_to_training', 'lookups', 'create_training_job')
+
+
+# Turns the first get_branch away with a throttling error.
+class ThrottlingCodeCommit(bench_dispatch.CodeCommitStandIn):
+
+  def get_branch(self, repositoryName, branchName):
+    if not self.throttled:
+      self.throttled += 1
+      raise bench_dispatch.client_error('ThrottlingException', 'GetBranch', message='Rate exceeded')
+    return bench_dispatch.CodeCommitStandIn.get_branch(self, repositoryName, branchName)
+
+
+def run_dispatches(monkeypatch, tmp_path, count):
+  artifact_path = str(tmp_path / 'artifact.zip')
+  bench_dispatch.build_artifact(artifact_path, 2, bench_dispatch.MANIFEST)
+  with open(artifact_path, 'rb') as f:
+    artifact = f.read()
+  stand_ins = {
+    's3': bench_dispatch.S3StandIn({('test-input', 'adult.data'): b'x' * 1024, ('test-input', 'adult.test'): b'y' * 10,
+                                    (bench_dispatch.ARTIFACT_BUCKET, 'artifact'): artifact}),
+    'codecommit': ThrottlingCodeCommit(),
+    'sagemaker': bench_dispatch.SageMakerStandIn(),
+    'code_pipeline': bench_dispatch.CodePipelineStandIn(),
+    'ecr': bench_dispatch.ECRStandIn()
+  }
+  for name, stand_in in stand_ins.items():
+    monkeypatch.setattr(sageDispatch, name, aws_retry.RetryingClient(stand_in, sageDispatch.retry_policy))
+  monkeypatch.setattr(sageDispatch.retry_policy, 'sleep', lambda seconds: None)
+  monkeypatch.setattr(sageDispatch, 'manifest_cache', dispatch_cache.TTLCache(maxsize=4))
+  monkeypatch.setattr(sageDispatch, 'commit_cache', dispatch_cache.TTLCache(maxsize=4, ttl=0))
+  monkeypatch.setattr(sageDispatch, 'create_job_limiter', token_bucket.TokenBucket(rate=1000, capacity=1000))
+
+  metrics_path = str(tmp_path / 'metrics.jsonl')
+  recorder = dispatch_metrics.Recorder('MLPipeline/Dispatch', dispatch_metrics.sink_from_env('file:' + metrics_path),
+                                       {'FunctionName': 'sageDispatch'})
+  monkeypatch.setattr(sageDispatch, 'metrics', recorder)
+  for i in range(count):
+    event = bench_dispatch.codepipeline_event('job-%d' % i, 'artifact', os.path.join(ROOT, 'event.json'))
+    sageDispatch.lambda_handler(event, bench_dispatch.Context('request-%d' % i))
+  assert [outcome for _, outcome, _ in stand_ins['code_pipeline'].results] == ['success'] * count
+  with open(metrics_path) as f:
+    return [json.loads(line) for line in f]
+
+
+def test_each_invocation_writes_one_embedded_metric_format_record(monkeypatch, tmp_path):
+  first, second = run_dispatches(monkeypatch, tmp_path, 2)
+
+  for record in (first, second):
+    metrics = record['_aws']['CloudWatchMetrics'][0]
+    assert metrics['Namespace'] == 'MLPipeline/Dispatch'
+    assert metrics['Dimensions'] == [['FunctionName']]
+    assert record['FunctionName'] == 'sageDispatch'
+    assert isinstance(record['_aws']['Timestamp'], int)
+    # every metric named in the metadata is a value on the record itself
+    units = dict((metric['Name'], metric['Unit']) for metric in metrics['Metrics'])
+    assert all(name in record for name in units)
+    assert units['retries'] == 'Count' and units['cold_start'] == 'Count'
+    assert all(units[phase] == 'Milliseconds' and record[phase] >= 0 for phase in ('get_manifest', 'send_to_training'))
+
+  assert (first['RequestId'], first['PipelineJobId']) == ('request-0', 'job-0')
+  assert set(PHASES) <= set(first)
+  assert first['cold_start'] == 1 and second['cold_start'] == 0
+
+  # The manifest is read with ranged requests once, then comes out of the cache.
+  assert 0 < first['bytes_downloaded'] < 1048576
+  assert {'Name': 'bytes_downloaded', 'Unit': 'Bytes'} in first['_aws']['CloudWatchMetrics'][0]['Metrics']
+  assert 'bytes_downloaded' not in second and second['manifest_cache_hits'] == 1
+  assert 'artifact_read' not in second
+
+  # Only the first dispatch's get_branch was throttled, and the counters start over with every invocation.
+  assert first['retries'] == 1 and first['throttles'] == 1
+  assert second['retries'] == 0 and second['aws_calls'] < first['aws_calls']
+
+
+def test_a_recorder_without_a_sink_does_nothing():
+  recorder = dispatch_metrics.Recorder('MLPipeline/Dispatch', dispatch_metrics.sink_from_env('off'))
+  recorder.start(RequestId='request-0')
+  assert not recorder.enabled
+  assert recorder.phase('get_manifest') is dispatch_metrics.NOOP_SPAN
+  with recorder.phase('get_manifest'):
+    recorder.add('bytes_downloaded', 100)
+    recorder.set('PipelineJobId', 'job-0')
+  assert recorder.durations == {} and recorder.counters == {}
+  assert recorder.flush() is None
+
+
+def test_phases_add_up_and_counters_get_units():
+  times = iter([0.0, 0.25, 1.0, 1.5])
+  sink = dispatch_metrics.MemorySink()
+  recorder = dispatch_metrics.Recorder('ns', sink, {'FunctionName': 'f'}, clock=lambda: next(times),
+                                       wall_clock=lambda: 12.5)
+  recorder.start()
+  for _ in range(2):
+    with recorder.phase('lookups'):
+      pass
+  recorder.add('bytes_downloaded', 512)
+  record = recorder.flush()
+  assert sink.records == [record]
+  assert record['lookups'] == 750.0 and record['bytes_downloaded'] == 512
+  assert record['_aws']['Timestamp'] == 12500
+  assert {'Name': 'bytes_downloaded', 'Unit': 'Bytes'} in record['_aws']['CloudWatchMetrics'][0]['Metrics']
@@ -0,0 +1,55 @@
+import os
+
+import instance_sizing
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sizing_jobs.json')
+
+
+def history():
+  records = {}
+  instance_sizing.collect(records, instance_sizing.fixture_jobs([FIXTURES]))
+  return records
+
+
+def test_collect_keeps_completed_pipeline_jobs_once():
+  records = history()
+  assert len(records) == 8
+  assert not any(name.startswith('notebook') for name in records)
+  assert instance_sizing.collect(records, instance_sizing.fixture_jobs([FIXTURES])) == 0
+  assert instance_sizing.load_history(instance_sizing.dump_history(records).splitlines()) == records
+
+
+def test_instance_size():
+  assert instance_sizing.instance_size('ml.m5.large') == ('ml.m5', 0.5)
+  assert instance_sizing.instance_size('ml.m5.4xlarge') == ('ml.m5', 4.0)
+  assert instance_sizing.instance_size('ml.p3.2xlarge') == ('ml.p3', 2.0)
+
+
+def test_recommends_a_smaller_size_than_it_has_seen():
+  recommendation = instance_sizing.recommend(history(), 'census-wide', 3600)
+  family, size = instance_sizing.instance_size(recommendation['instance_type'])
+  assert recommendation['meets_target']
+  assert family == 'ml.m5' and size < 2
+  assert recommendation['based_on'] == 'ml.m5.2xlarge'
+
+
+def test_recommends_a_larger_size_than_it_has_seen():
+  recommendation = instance_sizing.recommend(history(), 'census-deep', 1200)
+  family, size = instance_sizing.instance_size(recommendation['instance_type'])
+  assert recommendation['meets_target'] and recommendation['seconds'] <= 1200
+  assert family == 'ml.c5' and size > 1
+  assert recommendation['based_on'] == 'ml.c5.xlarge'
+
+
+def test_observed_sizes_are_estimated_from_their_own_runs():
+  candidates = instance_sizing.estimates(history(), 'census-wide', max_count=1)
+  observed = dict((c['instance_type'], c) for c in candidates if 'based_on' not in c)
+  assert sorted(observed) == ['ml.m5.2xlarge', 'ml.p2.8xlarge']
+  # the median 210s outside the Training phase plus the median 1100s in it
+  assert observed['ml.m5.2xlarge']['seconds'] == 1310.0
+  assert all(instance_sizing.instance_size(c['instance_type'])[0] in ('ml.m5', 'ml.p2') for c in candidates)
+
+
+def test_unknown_families_get_no_recommendation():
+  assert instance_sizing.recommend(history(), 'census-unknown', 1800) is None
+  assert instance_sizing.recommend(history(), 'census-wide', 1800, instance_types=['ml.g4dn.xlarge']) is None
@@ -0,0 +1,169 @@
+import io
+
+from botocore.exceptions import ClientError
+
+import model_data_watcher
+
+
+class FakeCodePipeline(object):
+
+  # Like CodePipeline, a start whose clientRequestToken was seen before returns the earlier execution.
+  def __init__(self):
+    self.executions = {}
+
+  def start_pipeline_execution(self, name, clientRequestToken):
+    execution = self.executions.setdefault(clientRequestToken, 'execution-%d' % len(self.executions))
+    return {'pipelineExecutionId': execution}
+
+
+def trigger_for(store, starts):
+  def start(entry):
+    starts.append(dict(entry))
+    return 'execution-%d' % len(starts)
+  return model_data_watcher.CoalescingTrigger(store, start, quiet_seconds=300, max_wait_seconds=3600)
+
+
+def test_bursty_uploads_start_one_execution_per_burst():
+  timeline = model_data_watcher.bursty_timeline(bursts=4, objects=500, prefixes=('census/', 'adult/'))
+  result = model_data_watcher.simulate(timeline, quiet_seconds=300, sweep_seconds=60)
+  assert result['executions'] == 4
+  assert result['events_per_execution'] == [500] * 4
+  assert 300 <= result['max_delay_seconds'] <= 360
+
+
+def test_a_prefix_that_never_settles_starts_after_the_max_wait():
+  timeline = [(second, 'census/part-%05d.csv' % second) for second in range(0, 7200, 30)]
+  result = model_data_watcher.simulate(timeline, quiet_seconds=300, max_wait_seconds=3600, sweep_seconds=60)
+  # The first hour's objects start one execution, the rest once they go quiet.
+  assert result['events_per_execution'] == [120, len(timeline) - 120]
+
+
+def test_events_of_one_invocation_are_folded_per_prefix():
+  store, starts = model_data_watcher.MemoryStore(), []
+  trigger = trigger_for(store, starts)
+  groups = [('ml_pipeline', 'input', 'census/')] * 3 + [('ml_pipeline', 'input', 'adult/')]
+  assert trigger.record_all(groups, 10) == 2
+  assert store.writes == 2
+  assert sorted(trigger.store.get(key)['events'] for key in store.keys()) == [1, 3]
+
+
+def test_a_repeated_start_of_the_same_burst_is_deduplicated(monkeypatch):
+  code_pipeline = FakeCodePipeline()
+  monkeypatch.setattr(model_data_watcher, 'code_pipeline', code_pipeline)
+  entry = {'pipeline': 'ml_pipeline', 'bucket': 'input', 'prefix': 'census/', 'first': 10, 'last': 20, 'events': 5}
+  first = model_data_watcher.start_pipeline(entry)
+  assert model_data_watcher.start_pipeline(dict(entry)) == first
+  assert model_data_watcher.start_pipeline(dict(entry, last=400, events=6)) != first
+
+
+def test_events_recorded_while_a_sweep_starts_get_an_execution_of_their_own(monkeypatch):
+  code_pipeline = FakeCodePipeline()
+  monkeypatch.setattr(model_data_watcher, 'code_pipeline', code_pipeline)
+  store = model_data_watcher.MemoryStore()
+  trigger = model_data_watcher.CoalescingTrigger(store, None, quiet_seconds=300, max_wait_seconds=3600)
+  late = []
+
+  # An object lands between the sweep reading the entry and deleting it.
+  def start(entry):
+    if not late:
+      late.append(trigger.record('ml_pipeline', 'input', 'census/', 400))
+    return model_data_watcher.start_pipeline(entry)
+
+  trigger.start = start
+  trigger.record('ml_pipeline', 'input', 'census/', 0)
+  first = trigger.sweep(360)
+  assert len(first) == 1
+  pending = store.get(store.keys()[0])
+  assert (pending['first'], pending['events']) == (0, 2)
+
+  second = trigger.sweep(760)
+  assert len(second) == 1 and second[0]['events'] == 2
+  assert second[0]['execution'] != first[0]['execution']
+  assert len(code_pipeline.executions) == 2
+  assert store.keys() == []
+
+
+def test_a_failed_start_keeps_the_entry_for_the_next_sweep():
+  store, starts = model_data_watcher.MemoryStore(), []
+  trigger = trigger_for(store, starts)
+  trigger.record('ml_pipeline', 'input', 'census/', 0)
+
+  def fail(entry):
+    raise RuntimeError('throttled')
+
+  trigger.start = fail
+  try:
+    trigger.sweep(360)
+  except RuntimeError:
+    pass
+  assert len(store.keys()) == 1
+  trigger.start = trigger_for(store, starts).start
+  assert len(trigger.sweep(420)) == 1
+  assert store.keys() == []
+
+
+# Lets another invocation write the same entry between this one's read and write, once.
+class RacingStore(model_data_watcher.MemoryStore):
+
+  def __init__(self, racer):
+    super(RacingStore, self).__init__()
+    self.racer = racer
+
+  def read(self, key):
+    found = super(RacingStore, self).read(key)
+    racer, self.racer = self.racer, None
+    if racer:
+      racer(self)
+    return found
+
+
+def test_concurrent_records_keep_each_others_events():
+  other = lambda store: trigger_for(store, []).record_all([('ml_pipeline', 'input', 'census/')] * 4, 5)
+  store = RacingStore(other)
+  trigger_for(store, []).record_all([('ml_pipeline', 'input', 'census/')] * 3, 7)
+  entry = store.get(store.keys()[0])
+  assert (entry['events'], entry['first'], entry['last']) == (7, 5, 7)
+
+
+def conflict(operation):
+  return ClientError({'Error': {'Code': 'PreconditionFailed'}, 'ResponseMetadata': {'HTTPStatusCode': 412}}, operation)
+
+
+# An s3 client with conditional puts and deletes on ETags.
+class FakeS3(object):
+
+  def __init__(self):
+    self.objects = {}
+    self.etags = 0
+
+  def get_object(self, Bucket, Key):
+    if Key not in self.objects:
+      raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+    body, etag = self.objects[Key]
+    return {'Body': io.BytesIO(body), 'ETag': etag}
+
+  def put_object(self, Bucket, Key, Body, ContentType, IfMatch=None, IfNoneMatch=None):
+    current = self.objects.get(Key, (None, None))[1]
+    if (IfNoneMatch == '*' and current is not None) or (IfMatch is not None and IfMatch != current):
+      raise conflict('PutObject')
+    self.etags += 1
+    self.objects[Key] = (Body, '"%d"' % self.etags)
+
+  def delete_object(self, Bucket, Key, IfMatch):
+    if self.objects.get(Key, (None, None))[1] != IfMatch:
+      raise conflict('DeleteObject')
+    del self.objects[Key]
+
+
+def test_s3_store_writes_and_deletes_only_what_it_read():
+  s3 = FakeS3()
+  store = model_data_watcher.S3Store(s3, 's3://state/watcher/')
+  assert store.read('a.json') == (None, None)
+  assert store.put('a.json', {'events': 1}, None)
+  assert not store.put('a.json', {'events': 1}, None)
+  entry, version = store.read('a.json')
+  assert store.put('a.json', {'events': 2}, version)
+  assert not store.put('a.json', {'events': 3}, version)
+  assert not store.delete('a.json', version)
+  assert store.delete('a.json', store.read('a.json')[1])
+  assert list(s3.objects) == []
@@ -0,0 +1,130 @@
+import json
+import os
+
+import pytest
+
+import nested_stacks
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_pipeline():
+  with open(os.path.join(HERE, '..', 'pipeline.json')) as f:
+    return json.load(f)
+
+
+def references(node):
+  return set(target for target, _ in nested_stacks._walk_references(node))
+
+
+def test_minified_json_round_trips():
+  template = load_pipeline()
+  minified = nested_stacks.to_json(template)
+  assert json.loads(minified) == template
+  assert json.loads(nested_stacks.to_json(template, pretty=True)) == template
+  assert '\n' not in minified
+  assert nested_stacks.template_size(template) < nested_stacks.template_size(template, pretty=True)
+  assert nested_stacks.template_size(template) <= nested_stacks.TEMPLATE_BODY_LIMIT
+
+
+def test_split_keeps_every_resource_and_resolves_every_reference():
+  template = load_pipeline()
+  parent, children = nested_stacks.split_template(template)
+  assert len(children) > 1
+
+  seen = {}
+  for file_name, child in children.items():
+    for resource_name in child['Resources']:
+      assert resource_name not in seen
+      seen[resource_name] = file_name
+    known = set(child['Resources']) | set(child.get('Parameters', {}))
+    unresolved = [target for target in references(child) if target not in known and not target.startswith('AWS::')]
+    assert unresolved == [], file_name
+  assert sorted(seen) == sorted(template['Resources'])
+
+  for stack in parent['Resources'].values():
+    file_name = stack['Properties']['TemplateURL']['Fn::Join'][1][1]
+    assert sorted(stack['Properties']['Parameters']) == sorted(children[file_name].get('Parameters', {}))
+  known = set(parent['Resources']) | set(parent['Parameters'])
+  assert all(target in known or target.startswith('AWS::') for target in references(parent))
+
+
+def test_cross_stack_references_go_through_outputs():
+  template = {
+    'Parameters': {'name': {'Type': 'String'}},
+    'Resources': {
+      'role': {'Type': 'AWS::IAM::Role', 'Properties': {'RoleName': {'Ref': 'name'}}},
+      'bucket': {'Type': 'AWS::S3::Bucket', 'Properties': {}},
+      'function': {'Type': 'AWS::Lambda::Function', 'DependsOn': ['bucket'],
+                   'Properties': {'Role': {'Fn::GetAtt': ['role', 'Arn']}, 'Code': {'S3Bucket': {'Ref': 'bucket'}}}}
+    }
+  }
+  parent, children = nested_stacks.split_template(template)
+  assert sorted(children) == ['pipeline-iam.json', 'pipeline-pipeline.json', 'pipeline-storage.json']
+  pipeline = children['pipeline-pipeline.json']
+  function = pipeline['Resources']['function']
+  assert 'DependsOn' not in function
+  for value in (function['Properties']['Role'], function['Properties']['Code']['S3Bucket']):
+    assert value['Ref'] in pipeline['Parameters']
+  assert children['pipeline-iam.json']['Outputs'] and children['pipeline-storage.json']['Outputs']
+  stacks = [s for s in parent['Resources'].values() if 'DependsOn' in s]
+  assert len(stacks) == 1
+
+
+# Roles, buckets and functions using them, padded out with policy statements until the whole template is well over the
+# TemplateBody limit while each of the three groups still fits under it.
+def big_template(count=30):
+  statement = {'Effect': 'Allow', 'Action': ['s3:GetObject', 's3:PutObject'],
+               'Resource': 'arn:aws:s3:::bucket/' + 'x' * 40}
+  resources = {}
+  for i in range(count):
+    resources['role%d' % i] = {'Type': 'AWS::IAM::Role', 'Properties': {
+      'AssumeRolePolicyDocument': {'Statement': [statement] * 6}}}
+    resources['bucket%d' % i] = {'Type': 'AWS::S3::Bucket', 'Properties': {'BucketName': {'Ref': 'name'},
+                                                                           'Tags': [{'Key': 'n', 'Value': 'y' * 200}]}}
+    resources['function%d' % i] = {'Type': 'AWS::Lambda::Function', 'Properties': {
+      'Role': {'Fn::GetAtt': ['role%d' % i, 'Arn']}, 'Code': {'S3Bucket': {'Ref': 'bucket%d' % i}},
+      'Environment': {'Variables': {'PADDING': 'z' * 800}}}}
+  return {'Parameters': {'name': {'Type': 'String'}}, 'Resources': resources,
+          'Outputs': {'first': {'Value': {'Fn::GetAtt': ['function0', 'Arn']}}}}
+
+
+def test_templates_over_the_limit_are_split_into_stacks_that_fit():
+  template = big_template()
+  assert nested_stacks.template_size(template) > nested_stacks.TEMPLATE_BODY_LIMIT
+  files = nested_stacks.render_files(template)
+  assert sorted(files) == ['pipeline-iam.json', 'pipeline-pipeline.json', 'pipeline-storage.json', 'pipeline.json']
+  assert all(len(text.encode('utf-8')) <= nested_stacks.TEMPLATE_BODY_LIMIT for text in files.values())
+  resources = set()
+  for file_name, text in files.items():
+    if file_name != 'pipeline.json':
+      resources.update(json.loads(text)['Resources'])
+  assert resources == set(template['Resources'])
+
+
+def test_templates_under_the_limit_stay_whole():
+  files = nested_stacks.render_files(big_template(count=2), name='small')
+  assert list(files) == ['small.json']
+  assert json.loads(files['small.json']) == big_template(count=2)
+
+
+def test_a_budget_too_small_for_the_nested_stacks_raises():
+  with pytest.raises(ValueError, match='still over 10000 bytes'):
+    nested_stacks.render_files(big_template(), max_bytes=10000)
+
+
+# hydrate needs the troposphere release it was written against, the tests that render are skipped without it.
+def test_render_matches_the_committed_template():
+  hydrate = pytest.importorskip('hydrate', exc_type=ImportError)
+  files = hydrate.render()
+  assert json.loads(files['pipeline.json']) == load_pipeline()
+
+
+def test_render_splits_when_over_the_limit():
+  hydrate = pytest.importorskip('hydrate', exc_type=ImportError)
+  whole = len(hydrate.render()['pipeline.json'].encode('utf-8'))
+  files = hydrate.render(max_bytes=whole - 1)
+  assert len(files) > 1
+  assert all(len(text.encode('utf-8')) < whole for text in files.values())
+  with pytest.raises(ValueError):
+    hydrate.render(max_bytes=1000)
@@ -0,0 +1,97 @@
+import io
+import os
+import zipfile
+
+import pytest
+from botocore.exceptions import ClientError
+
+import s3_ranged_file
+
+
+# An s3 client holding objects in memory. With honour_ranges off it answers a ranged GET with the whole object and no
+# ContentRange, as some s3 compatible stores and proxies do.
+class FakeS3(object):
+
+  def __init__(self, objects, honour_ranges=True):
+    self.objects = objects
+    self.honour_ranges = honour_ranges
+    self.gets = []
+    self.downloads = []
+
+  def head_object(self, Bucket, Key):
+    return {'ContentLength': len(self.objects[Key]), 'ETag': '"v1"'}
+
+  def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+    self.gets.append(Range)
+    if IfMatch is not None and IfMatch != '"v1"':
+      raise ClientError({'Error': {'Code': 'PreconditionFailed'}, 'ResponseMetadata': {'HTTPStatusCode': 412}},
+                        'GetObject')
+    data = self.objects[Key]
+    if Range is None or not self.honour_ranges:
+      return {'Body': io.BytesIO(data), 'ContentLength': len(data)}
+    start, end = [int(part) for part in Range[len('bytes='):].split('-')]
+    body = data[start:end + 1]
+    return {'Body': io.BytesIO(body), 'ContentLength': len(body),
+            'ContentRange': 'bytes %d-%d/%d' % (start, start + len(body) - 1, len(data))}
+
+  def download_file(self, bucket, key, path):
+    self.downloads.append(key)
+    with open(path, 'wb') as f:
+      f.write(self.objects[key])
+
+
+def artifact(padding_bytes):
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, 'w') as archive:
+    archive.writestr('manifest.json', b'{"Training": []}')
+    archive.writestr('padding.bin', os.urandom(padding_bytes), compress_type=zipfile.ZIP_STORED)
+  return buf.getvalue()
+
+
+def test_reads_member_with_a_few_ranged_requests():
+  data = artifact(4 * 1024 * 1024)
+  s3 = FakeS3({'artifact.zip': data})
+  stats = {}
+  assert s3_ranged_file.read_zip_member(s3, 'bucket', 'artifact.zip', 'manifest.json', stats=stats) == \
+    b'{"Training": []}'
+  assert s3.downloads == []
+  assert stats['requests'] <= 3
+  assert stats['bytes'] < len(data) / 10
+
+
+def test_falls_back_to_download_when_ranges_are_ignored():
+  data = artifact(512 * 1024)
+  s3 = FakeS3({'artifact.zip': data}, honour_ranges=False)
+  stats = {}
+  assert s3_ranged_file.read_zip_member(s3, 'bucket', 'artifact.zip', 'manifest.json', stats=stats) == \
+    b'{"Training": []}'
+  assert s3.downloads == ['artifact.zip']
+  assert stats == {'requests': 1, 'bytes': len(data)}
+
+
+def test_falls_back_to_download_when_the_object_changed():
+  s3 = FakeS3({'artifact.zip': artifact(1024)})
+  data = s3_ranged_file.read_zip_member(s3, 'bucket', 'artifact.zip', 'manifest.json', size=len(s3.objects[
+    'artifact.zip']), etag='"v0"')
+  assert data == b'{"Training": []}'
+  assert s3.downloads == ['artifact.zip']
+
+
+def test_falls_back_to_download_when_the_zip_looks_broken():
+  s3 = FakeS3({'artifact.zip': b'not a zip at all'})
+  with pytest.raises(zipfile.BadZipfile):
+    s3_ranged_file.read_zip_member(s3, 'bucket', 'artifact.zip', 'manifest.json')
+  assert s3.downloads == ['artifact.zip']
+
+
+def test_seek_and_read_match_the_object():
+  data = bytes(range(256)) * 1000
+  ranged = s3_ranged_file.S3RangedFile(FakeS3({'blob': data}), 'bucket', 'blob', block_size=1024)
+  assert ranged.read(10) == data[:10]
+  ranged.seek(-20, io.SEEK_END)
+  assert ranged.read() == data[-20:]
+  ranged.seek(5000)
+  assert ranged.read(3000) == data[5000:8000]
+  assert ranged.read(0) == b''
+  with pytest.raises(OSError):
+    ranged.seek(-1)
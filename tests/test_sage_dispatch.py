@@ -0,0 +1,168 @@
+import logging
+import os
+
+import pytest
+
+import instance_sizing
+import sageDispatch
+import token_bucket
+import training_tracker
+
+
+def test_expand_job_specs_renames_duplicates_around_explicit_names():
+  manifest = {'TrainingJobName': 'foo', 'HyperParameters': {'train_data': 'a'},
+              'TrainingJobs': [{}, {'TrainingJobName': 'foo-1'}, {}, {'TrainingJobName': 'foo-2'}]}
+  names = [s['TrainingJobName'] for s in sageDispatch.expand_job_specs(manifest)]
+  assert len(set(names)) == len(names) == 4
+  assert 'foo-1' in names and 'foo-2' in names
+
+
+def test_expand_job_specs_keeps_renamed_jobs_within_the_name_limit():
+  name = 'x' * sageDispatch.JOB_NAME_MAX
+  manifest = {'TrainingJobName': name, 'HyperParameterGrid': {'depth': list(range(12))}}
+  names = [s['TrainingJobName'] for s in sageDispatch.expand_job_specs(manifest)]
+  assert len(set(names)) == 12
+  assert all(len(n) <= sageDispatch.JOB_NAME_MAX for n in names)
+  assert all(sageDispatch.JOB_NAME_PATTERN.match(n) for n in names)
+
+
+def test_expand_job_specs_leaves_unique_names_alone():
+  manifest = {'TrainingJobs': [{'TrainingJobName': 'a'}, {'TrainingJobName': 'b'}]}
+  assert [s['TrainingJobName'] for s in sageDispatch.expand_job_specs(manifest)] == ['a', 'b']
+
+
+def staged_spec(**overrides):
+  spec = {
+    'TrainingJobName': 'census',
+    'HyperParameters': {'train_data': 'adult.data', 'test_data': 'adult.test'},
+    'ResourceConfig': {'InstanceType': 'ml.m5.xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 10},
+    'StoppingCondition': {'MaxRuntimeInSeconds': 3600},
+    'StagedInput': True,
+    'TrainingInputMode': 'Pipe'
+  }
+  spec.update(overrides)
+  return spec
+
+
+STAGED = {
+  'prefix': 's3://test-output/staged/gzip-1/',
+  'compression': 'Gzip',
+  'content_type': 'text/csv',
+  'objects': {
+    'adult.data': {'prefix': 's3://test-output/staged/gzip-1/adult.data/',
+                   'shards': [['staged/gzip-1/adult.data/adult.data.part-00000.gz', 100]]},
+    'adult.test': {'prefix': 's3://test-output/staged/gzip-1/adult.test/',
+                   'shards': [['staged/gzip-1/adult.test/adult.test.part-00000.gz', 50]]}
+  }
+}
+
+
+def test_staged_input_keeps_train_and_test_in_their_own_channels():
+  channels = sageDispatch.build_input_data_config(staged_spec(), 'census-1', {'staged_input': STAGED})
+  uris = dict((c['ChannelName'], c['DataSource']['S3DataSource']['S3Uri']) for c in channels)
+  assert uris == {'train': 's3://test-output/staged/gzip-1/adult.data/',
+                  'test': 's3://test-output/staged/gzip-1/adult.test/'}
+  assert all(c['CompressionType'] == 'Gzip' for c in channels)
+
+
+def test_staged_input_that_was_never_staged_fails():
+  spec = staged_spec(HyperParameters={'train_data': 'other.data', 'test_data': 'adult.test'})
+  with pytest.raises(ValueError):
+    sageDispatch.build_input_data_config(spec, 'census-1', {'staged_input': STAGED})
+
+
+def test_staged_input_needs_pipe_mode_asked_for():
+  assert sageDispatch.validate_spec(staged_spec()) == []
+  unset = staged_spec()
+  del unset['TrainingInputMode']
+  for spec in (staged_spec(TrainingInputMode='File'), staged_spec(TrainingInputMode='FastFile'), unset):
+    assert sageDispatch.validate_spec(spec) == ['StagedInput needs "TrainingInputMode": "Pipe"']
+  with pytest.raises(ValueError, match='Pipe'):
+    sageDispatch.send_to_training(staged_spec(TrainingInputMode='File'))
+
+
+class FakeSageMaker(object):
+
+  def __init__(self):
+    self.jobs = {}
+    self.created = []
+
+  def describe_training_job(self, TrainingJobName):
+    return self.jobs[TrainingJobName]
+
+  def create_training_job(self, **request):
+    self.created.append(request)
+    arn = 'arn:aws:sagemaker:us-west-2:007038732177:training-job/' + request['TrainingJobName']
+    self.jobs[request['TrainingJobName']] = {'TrainingJobName': request['TrainingJobName'], 'TrainingJobArn': arn,
+                                             'TrainingJobStatus': 'InProgress'}
+    return {'TrainingJobArn': arn}
+
+
+LOOKUPS = {'commit_id': 'abc123', 'versions': {'adult.data': 'v1', 'adult.test': 'v2'}, 'input_objects': None,
+           'staged_input': None, 'image_digest': 'sha256:1'}
+
+
+@pytest.fixture
+def sagemaker(monkeypatch):
+  fake = FakeSageMaker()
+  monkeypatch.setattr(sageDispatch, 'sagemaker', fake)
+  monkeypatch.setattr(sageDispatch, 'dedup_index', training_tracker.MemoryStore())
+  monkeypatch.setattr(sageDispatch, 'create_job_limiter', token_bucket.TokenBucket(rate=1000, capacity=1000))
+  return fake
+
+
+def dispatch_twice(sagemaker, status, **overrides):
+  spec = staged_spec(StagedInput=False, TrainingInputMode='File', **overrides)
+  first = sageDispatch.create_training_job(spec, '26-10-17-10-00', LOOKUPS)
+  sagemaker.jobs[first['TrainingJobName']].update(
+    TrainingJobStatus=status, ModelArtifacts={'S3ModelArtifacts': 's3://test-output/output/census/model.tar.gz'})
+  return first, sageDispatch.create_training_job(spec, '26-10-17-11-00', LOOKUPS)
+
+
+def test_an_unchanged_dispatch_reuses_the_completed_job(sagemaker):
+  first, second = dispatch_twice(sagemaker, 'Completed')
+  assert len(sagemaker.created) == 1
+  assert second['Reused'] and second['TrainingJobName'] == first['TrainingJobName']
+  assert second['ModelArtifacts'] == 's3://test-output/output/census/model.tar.gz'
+
+
+@pytest.mark.parametrize('status', ['InProgress', 'Failed', 'Stopped'])
+def test_a_job_without_artifacts_is_trained_again(sagemaker, status):
+  first, second = dispatch_twice(sagemaker, status)
+  assert len(sagemaker.created) == 2
+  assert not second.get('Reused') and second['TrainingJobName'] != first['TrainingJobName']
+
+
+def test_a_running_job_is_reused_by_a_dispatch_that_waits_for_it(sagemaker):
+  first, second = dispatch_twice(sagemaker, 'InProgress', WaitForTraining=True)
+  assert len(sagemaker.created) == 1
+  assert second['Reused'] and second['TrainingJobStatus'] == 'InProgress'
+
+
+def sizing_history():
+  records = {}
+  fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sizing_jobs.json')
+  instance_sizing.collect(records, instance_sizing.fixture_jobs([fixtures]))
+  return records
+
+
+def sized_spec(name, target, **right_size):
+  return {'TrainingJobName': name, 'RightSize': dict(right_size, TargetSeconds=target),
+          'ResourceConfig': {'InstanceType': 'ml.m5.xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 10}}
+
+
+def test_right_sizing_stays_within_the_manifests_instance_count():
+  specs = [sized_spec('census-deep', 1800), sized_spec('census-deep', 1200, MaxInstanceCount=4)]
+  sageDispatch.apply_right_sizing(specs, sizing_history())
+  assert specs[0]['ResourceConfig'] == {'InstanceType': 'ml.c5.4xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 10}
+  # 1200s takes more than one instance, which MaxInstanceCount allows.
+  assert specs[1]['ResourceConfig']['InstanceType'].startswith('ml.c5.')
+  assert 1 < specs[1]['ResourceConfig']['InstanceCount'] <= 4
+
+
+def test_right_sizing_keeps_the_manifests_config_when_nothing_meets_the_target(caplog):
+  spec = sized_spec('census-deep', 1200)
+  with caplog.at_level(logging.WARNING):
+    sageDispatch.apply_right_sizing([spec], sizing_history())
+  assert spec['ResourceConfig'] == {'InstanceType': 'ml.m5.xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 10}
+  assert 'census-deep' in caplog.text and 'keeping' in caplog.text
@@ -0,0 +1,64 @@
+import json
+
+import pytest
+
+import shard_planner
+
+
+def totals(shards):
+  return [sum(size for _, size in shard) for shard in shards]
+
+
+def test_objects_are_packed_largest_first_into_balanced_shards():
+  objects = [('data/part-%d' % i, size) for i, size in enumerate([50, 40, 30, 30, 20, 20, 10, 10, 10])]
+  shards = shard_planner.plan_shards(objects, 3)
+  assert sorted(key for shard in shards for key, _ in shard) == sorted(key for key, _ in objects)
+  assert sorted(totals(shards)) == [70, 70, 80]
+  assert [len(shard) for shard in shards] == [3, 3, 3]
+  assert all(shard == sorted(shard) for shard in shards)
+
+
+def test_no_shard_gets_more_than_its_share_of_objects():
+  # One huge object and many small ones: balancing bytes alone would give the small ones all to the other shard.
+  objects = [('big', 1000)] + [('small-%02d' % i, 1) for i in range(9)]
+  shards = shard_planner.plan_shards(objects, 2)
+  assert [len(shard) for shard in shards] == [5, 5]
+  assert ('big', 1000) in shards[0]
+
+
+def test_more_shards_than_objects_leaves_some_empty():
+  shards = shard_planner.plan_shards([('a', 5), ('b', 3)], 4)
+  assert sorted(len(shard) for shard in shards) == [0, 0, 1, 1]
+  assert shard_planner.describe_shards(shards)[0] == {'objects': 1, 'bytes': 5}
+  with pytest.raises(ValueError):
+    shard_planner.plan_shards([('a', 5)], 0)
+
+
+def test_manifest_lists_each_shard_in_turn_relative_to_the_prefix():
+  shards = [[('input/b.csv', 5), ('input/c.csv', 1)], [('input/a.csv', 6)]]
+  manifest = shard_planner.build_manifest('bucket', 'input/', shards)
+  assert manifest == [{'prefix': 's3://bucket/input/'}, 'b.csv', 'c.csv', 'a.csv']
+
+
+class FakeS3(object):
+
+  def __init__(self):
+    self.put = {}
+
+  def put_object(self, Bucket, Key, Body, ContentType):
+    self.put[(Bucket, Key)] = json.loads(Body)
+
+  def get_paginator(self, name):
+    class Paginator(object):
+      def paginate(self, Bucket, Prefix):
+        yield {'Contents': [{'Key': Prefix + 'a.csv', 'Size': 3}, {'Key': Prefix + 'dir/', 'Size': 0}]}
+        yield {}
+    return Paginator()
+
+
+def test_manifests_are_written_where_the_url_says_and_folders_are_not_listed():
+  s3 = FakeS3()
+  url = shard_planner.write_manifest(s3, 's3://output/manifests/job.manifest', ['x'])
+  assert url == 's3://output/manifests/job.manifest'
+  assert s3.put == {('output', 'manifests/job.manifest'): ['x']}
+  assert shard_planner.list_objects(s3, 'input', 'census/') == [('census/a.csv', 3)]
@@ -0,0 +1,193 @@
+import json
+
+import boto3.session
+import pytest
+from botocore.stub import ANY, Stubber
+
+import aws_retry
+import sageDispatch
+import token_bucket
+import training_tracker
+
+
+def transitions(*statuses):
+  return [{'Status': status, 'StartTime': 1000 + i, 'EndTime': 1001 + i} for i, status in enumerate(statuses)]
+
+
+def spot_job(status, secondary, history, failure=None, name='census-26-10-17-10-00'):
+  job = {
+    'TrainingJobName': name,
+    'TrainingJobArn': 'arn:aws:sagemaker:us-west-2:007038732177:training-job/' + name,
+    'TrainingJobStatus': status,
+    'SecondaryStatus': secondary,
+    'SecondaryStatusTransitions': transitions(*history),
+    'EnableManagedSpotTraining': True,
+    'CheckpointConfig': {'S3Uri': 's3://test-output/output/checkpoints/census/'},
+    'StoppingCondition': {'MaxRuntimeInSeconds': 3600, 'MaxWaitTimeInSeconds': 7200},
+    'CreationTime': 900,
+    'LastModifiedTime': 2000
+  }
+  if failure:
+    job['FailureReason'] = failure
+  return job
+
+
+@pytest.mark.parametrize('job, expected', [
+  (spot_job('Stopped', 'Interrupted', ['Starting', 'Training', 'Interrupted']), True),
+  (spot_job('Stopped', 'MaxWaitTimeExceeded', ['Starting', 'Interrupted', 'MaxWaitTimeExceeded']), True),
+  (spot_job('Failed', 'Failed', ['Starting', 'Training', 'Interrupted']), True),
+  # interrupted once, then the algorithm itself failed
+  (spot_job('Failed', 'Failed', ['Starting', 'Interrupted', 'Training', 'Failed'],
+            'AlgorithmError: ExecuteUserScriptError'), False),
+  (spot_job('Failed', 'Failed', ['Starting', 'Interrupted', 'Training'], 'AlgorithmError: out of memory'), False),
+  # interrupted once, then stopped by someone
+  (spot_job('Stopped', 'Stopped', ['Starting', 'Interrupted', 'Training', 'Stopping', 'Stopped']), False),
+  (spot_job('Stopped', 'Stopped', ['Starting', 'Interrupted']), False),
+  (spot_job('Completed', 'Completed', ['Starting', 'Interrupted', 'Training', 'Completed']), False),
+  (dict(spot_job('Stopped', 'Interrupted', ['Interrupted']), EnableManagedSpotTraining=False), False)
+])
+def test_was_interrupted_looks_at_how_the_job_ended(job, expected):
+  assert sageDispatch.was_interrupted(job) is expected
+
+
+class FakeSageMaker(object):
+
+  def __init__(self, jobs):
+    self.jobs = dict((job['TrainingJobName'], job) for job in jobs)
+    self.created = []
+
+  def describe_training_job(self, TrainingJobName):
+    return self.jobs[TrainingJobName]
+
+  def list_tags(self, ResourceArn):
+    return {'Tags': [{'Key': 'commitID', 'Value': 'abc'}]}
+
+  def create_training_job(self, **request):
+    self.created.append(request)
+    return {'TrainingJobArn': 'arn:aws:sagemaker:us-west-2:007038732177:training-job/' + request['TrainingJobName']}
+
+
+@pytest.fixture
+def event_stores(monkeypatch):
+  states, waits = training_tracker.MemoryStore(), training_tracker.MemoryStore()
+  monkeypatch.setattr(sageDispatch, 'job_states', states)
+  monkeypatch.setattr(sageDispatch, 'pipeline_waits', waits)
+  return states, waits
+
+
+def handle(monkeypatch, job):
+  sagemaker = FakeSageMaker([job])
+  monkeypatch.setattr(sageDispatch, 'sagemaker', sagemaker)
+  record = sageDispatch.training_event_handler({'detail': job}, None)
+  return record, sagemaker.created
+
+
+def test_an_interrupted_job_is_resumed_from_its_checkpoint(monkeypatch, event_stores):
+  record, created = handle(monkeypatch, spot_job('Stopped', 'Interrupted', ['Starting', 'Training', 'Interrupted']))
+  assert [request['TrainingJobName'] for request in created] == ['census-26-10-17-10-00-r1']
+  assert created[0]['CheckpointConfig'] == {'S3Uri': 's3://test-output/output/checkpoints/census/'}
+  assert record['ResumedAs'] == 'census-26-10-17-10-00-r1'
+
+
+@pytest.mark.parametrize('job', [
+  spot_job('Failed', 'Failed', ['Starting', 'Interrupted', 'Training', 'Failed'], 'AlgorithmError: bad input'),
+  spot_job('Stopped', 'Stopped', ['Starting', 'Interrupted', 'Training', 'Stopping', 'Stopped'])
+])
+def test_algorithm_errors_and_user_stops_are_left_alone(monkeypatch, event_stores, job):
+  record, created = handle(monkeypatch, job)
+  assert created == []
+  assert 'ResumedAs' not in record
+
+
+def test_resubmits_stop_at_the_limit(monkeypatch, event_stores):
+  name = 'census-26-10-17-10-00-r%d' % sageDispatch.max_spot_resubmits
+  record, created = handle(monkeypatch, spot_job('Stopped', 'Interrupted', ['Interrupted'], name=name))
+  assert created == []
+
+
+def spot_manifest(**overrides):
+  manifest = {
+    'TrainingJobName': 'census',
+    'SkipIfUnchanged': False,
+    'EnableManagedSpotTraining': True,
+    'HyperParameters': {'train_data': 'adult.data', 'test_data': 'adult.test'},
+    'ResourceConfig': {'InstanceType': 'ml.m5.xlarge', 'InstanceCount': 1, 'VolumeSizeInGB': 10},
+    'StoppingCondition': {'MaxRuntimeInSeconds': 3600}
+  }
+  manifest.update(overrides)
+  return manifest
+
+
+LOOKUPS = {'commit_id': 'abc123', 'versions': {'adult.data': 'v1', 'adult.test': 'v2'}, 'input_objects': None,
+           'staged_input': None}
+
+
+# Dispatches spec through a real sagemaker client whose Stubber expects the spot settings, so the request is also
+# checked against the CreateTrainingJob api model.
+def create_stubbed(monkeypatch, spec, spot_settings):
+  client = boto3.session.Session(region_name='us-west-2').client('sagemaker', config=aws_retry.client_config())
+  monkeypatch.setattr(sageDispatch, 'sagemaker', aws_retry.RetryingClient(client, aws_retry.RetryPolicy()))
+  monkeypatch.setattr(sageDispatch, 'create_job_limiter', token_bucket.TokenBucket(rate=1000, capacity=1000))
+  name = 'census-26-10-17-10-00'
+  expected = dict((key, ANY) for key in ('TrainingJobName', 'HyperParameters', 'AlgorithmSpecification', 'RoleArn',
+                                         'InputDataConfig', 'OutputDataConfig', 'ResourceConfig', 'Tags'))
+  expected.update(spot_settings, TrainingJobName=name)
+  with Stubber(client) as stubber:
+    stubber.add_response('create_training_job', {'TrainingJobArn': 'arn:aws:sagemaker:us-west-2:007038732177:'
+                                                                    'training-job/' + name}, expected)
+    result = sageDispatch.create_training_job(spec, '26-10-17-10-00', LOOKUPS)
+    stubber.assert_no_pending_responses()
+  return result
+
+
+def test_spot_jobs_wait_twice_the_runtime_and_checkpoint_to_the_output_bucket(monkeypatch):
+  result = create_stubbed(monkeypatch, spot_manifest(), {
+    'EnableManagedSpotTraining': True,
+    'StoppingCondition': {'MaxRuntimeInSeconds': 3600, 'MaxWaitTimeInSeconds': 7200},
+    'CheckpointConfig': {'S3Uri': 's3://test-output/output/checkpoints/census-26-10-17-10-00/',
+                         'LocalPath': '/opt/ml/checkpoints'}
+  })
+  assert result['TrainingJobName'] == 'census-26-10-17-10-00'
+
+
+def test_spot_jobs_take_the_manifests_wait_time_and_checkpoint_path(monkeypatch):
+  create_stubbed(monkeypatch, spot_manifest(MaxWaitTimeInSeconds=5400, CheckpointLocalPath='/opt/ml/state'), {
+    'EnableManagedSpotTraining': True,
+    'StoppingCondition': {'MaxRuntimeInSeconds': 3600, 'MaxWaitTimeInSeconds': 5400},
+    'CheckpointConfig': {'S3Uri': 's3://test-output/output/checkpoints/census-26-10-17-10-00/',
+                         'LocalPath': '/opt/ml/state'}
+  })
+
+
+def test_on_demand_jobs_get_no_spot_settings():
+  request = sageDispatch.training_job_request(spot_manifest(EnableManagedSpotTraining=False), 'census-1', LOOKUPS, [])
+  assert 'EnableManagedSpotTraining' not in request and 'CheckpointConfig' not in request
+  assert request['StoppingCondition'] == {'MaxRuntimeInSeconds': 3600}
+
+
+class FakeCodePipeline(object):
+
+  def __init__(self):
+    self.results = []
+
+  def put_job_success_result(self, jobId, executionDetails, continuationToken=None):
+    self.results.append(('success', executionDetails['summary']))
+
+  def put_job_failure_result(self, jobId, failureDetails):
+    self.results.append(('failure', failureDetails['message']))
+
+
+@pytest.mark.parametrize('manifest, problem', [
+  (spot_manifest(MaxWaitTimeInSeconds=1800), 'has to be at least StoppingCondition.MaxRuntimeInSeconds'),
+  (spot_manifest(StoppingCondition={'MaxRuntimeInSeconds': 3600, 'MaxWaitTimeInSeconds': 600}),
+   'has to be at least StoppingCondition.MaxRuntimeInSeconds'),
+  (spot_manifest(EnableManagedSpotTraining=False, MaxWaitTimeInSeconds=7200), 'needs "EnableManagedSpotTraining"')
+])
+def test_the_validator_rejects_spot_wait_times_it_cannot_use(monkeypatch, manifest, problem):
+  code_pipeline = FakeCodePipeline()
+  monkeypatch.setattr(sageDispatch, 'code_pipeline', code_pipeline)
+  monkeypatch.setattr(sageDispatch, 'get_manifest_dictionary', lambda artifacts: json.loads(json.dumps(manifest)))
+  sageDispatch.validate_handler({'CodePipeline.job': {'id': 'validate', 'data': {'inputArtifacts': []}}}, None)
+  assert len(code_pipeline.results) == 1
+  outcome, message = code_pipeline.results[0]
+  assert outcome == 'failure' and 'MaxWaitTimeInSeconds ' + problem in message
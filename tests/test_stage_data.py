@@ -0,0 +1,97 @@
+import gzip
+import io
+
+import pytest
+
+import stage_data
+
+
+class FakeS3(object):
+
+  class exceptions(object):
+
+    class NoSuchKey(Exception):
+      pass
+
+  def __init__(self, objects):
+    self.objects = objects
+    self.uploaded = {}
+    self.put = {}
+
+  def get_paginator(self, name):
+    s3 = self
+
+    class Paginator(object):
+      def paginate(self, Bucket, Prefix):
+        yield {'Contents': [{'Key': key, 'ETag': '"%d"' % len(data)} for key, data in sorted(s3.objects.items())
+                            if key.startswith(Prefix)]}
+    return Paginator()
+
+  def get_object(self, Bucket, Key):
+    objects = self.put if Bucket == 'output' else self.objects
+    if Key not in objects:
+      raise self.exceptions.NoSuchKey(Key)
+    return {'Body': io.BytesIO(objects[Key])}
+
+  def upload_file(self, path, bucket, key, ExtraArgs=None):
+    with open(path, 'rb') as f:
+      self.uploaded[key] = f.read()
+
+  def put_object(self, Bucket, Key, Body, ContentType):
+    self.put[Key] = Body
+
+
+# Runs the conversions in this process so they see the fake client.
+class InlinePool(object):
+
+  def __init__(self, processes):
+    pass
+
+  def map(self, func, work, chunksize=1):
+    return [func(args) for args in work]
+
+  def close(self):
+    pass
+
+  def join(self):
+    pass
+
+
+@pytest.fixture
+def s3(monkeypatch):
+  fake = FakeS3({'adult.data': b'1,a\n2,b\n' * 100, 'adult.test': b'3,c\n' * 50})
+  monkeypatch.setattr(stage_data.boto3, 'client', lambda service: fake)
+  monkeypatch.setattr(stage_data.multiprocessing, 'Pool', InlinePool)
+  return fake
+
+
+def test_every_source_object_is_staged_under_its_own_prefix(s3):
+  pointer = stage_data.stage_prefix('s3://input/', 's3://output/staged/', 'gzip')
+
+  train, test = pointer['objects']['adult.data'], pointer['objects']['adult.test']
+  assert train['prefix'] != test['prefix']
+  assert not test['prefix'].startswith(train['prefix']) and not train['prefix'].startswith(test['prefix'])
+  for staged in (train, test):
+    assert all(('s3://output/' + key).startswith(staged['prefix']) for key, _ in staged['shards'])
+  assert sorted(s3.uploaded) == sorted(key for staged in (train, test) for key, _ in staged['shards'])
+  assert 'staged/current.json' in s3.put
+
+  assert pointer['content_type'] == 'text/csv' and pointer['compression'] == 'Gzip'
+  assert gzip.decompress(s3.uploaded[test['shards'][0][0]]) == b'3,c\n' * 50
+
+
+def test_restaging_is_a_no_op_only_with_the_same_settings(s3):
+  first = stage_data.stage_prefix('s3://input/', 's3://output/staged/', shard_mb=64, level=6)
+  uploads = len(s3.uploaded)
+  assert stage_data.stage_prefix('s3://input/', 's3://output/staged/', shard_mb=64, level=6) == first
+  assert len(s3.uploaded) == uploads
+
+  for settings in ({'shard_mb': 32, 'level': 6}, {'shard_mb': 64, 'level': 9}):
+    restaged = stage_data.stage_prefix('s3://input/', 's3://output/staged/', **settings)
+    assert restaged['version'] != first['version']
+  assert len(s3.uploaded) == 3 * uploads
+
+
+def test_only_gzip_shards_are_supported(s3):
+  with pytest.raises(ValueError, match='gzip'):
+    stage_data.stage_prefix('s3://input/', 's3://output/staged/', 'recordio')
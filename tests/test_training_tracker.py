@@ -0,0 +1,64 @@
+import json
+import os
+
+import training_tracker
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'training_events.json')
+WIDE = 'census-wide-18-01-23-19-00'
+DEEP = 'census-deep-18-01-23-19-00'
+
+
+def events():
+  with open(FIXTURES) as f:
+    return [event['detail'] for event in json.load(f)]
+
+
+def test_replay_keeps_the_latest_state_and_drops_stale_events():
+  states = training_tracker.MemoryStore()
+  tracked = [training_tracker.track(states, job) for job in events()]
+  # census-deep's Downloading event arrives after its Training one
+  assert tracked.count(None) == 1
+  assert states.get(WIDE)['TrainingJobStatus'] == 'Completed'
+  assert states.get(DEEP)['TrainingJobStatus'] == 'Failed'
+  assert states.get(DEEP)['FailureReason']
+  latencies = states.get(WIDE)['Latencies']
+  assert set(latencies) == set(training_tracker.PHASES + ('total',))
+  assert all(seconds >= 0 for seconds in latencies.values())
+  assert latencies['total'] >= latencies['training']
+
+
+def test_wait_outcome_only_once_every_job_finished():
+  states, waits = training_tracker.MemoryStore(), training_tracker.MemoryStore()
+  wait = training_tracker.wait_for(waits, 'pipeline-job', [WIDE, DEEP])
+  assert waits.get(WIDE) == waits.get(DEEP) == wait
+  outcomes = []
+  for job in events():
+    training_tracker.track(states, job)
+    outcomes.append(training_tracker.wait_outcome(states, waits, wait))
+  assert all(outcome is None for outcome in outcomes[:-1])
+  succeeded, records = outcomes[-1]
+  assert not succeeded
+  assert [record['TrainingJobName'] for record in records] == [WIDE, DEEP]
+
+
+def job(name, status, modified):
+  return {'TrainingJobName': name, 'TrainingJobStatus': status, 'SecondaryStatus': status, 'CreationTime': 1000,
+          'LastModifiedTime': modified, 'SecondaryStatusTransitions': []}
+
+
+def test_waits_follow_resumed_jobs():
+  states, waits = training_tracker.MemoryStore(), training_tracker.MemoryStore()
+  wait = training_tracker.wait_for(waits, 'pipeline-job', ['spot'])
+  record = training_tracker.track(states, job('spot', 'Stopped', 2000))
+  record['ResumedAs'] = 'spot-r1'
+  states.put('spot', record)
+  assert not training_tracker.is_finished(record)
+
+  # A late event for the original job keeps the pointer to its relaunch.
+  assert training_tracker.track(states, job('spot', 'Stopped', 3000))['ResumedAs'] == 'spot-r1'
+  training_tracker.track(states, job('spot-r1', 'InProgress', 4000))
+  assert training_tracker.wait_outcome(states, waits, wait) is None
+  assert waits.get('spot-r1') == wait
+  training_tracker.track(states, job('spot-r1', 'Completed', 5000))
+  succeeded, records = training_tracker.wait_outcome(states, waits, wait)
+  assert succeeded and records[0]['TrainingJobName'] == 'spot-r1'
@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+import sageDispatch
+import training_tracker
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'training_events.json')
+WIDE = 'census-wide-18-01-23-19-00'
+DEEP = 'census-deep-18-01-23-19-00'
+
+
+class FakeCodePipeline(object):
+
+  def __init__(self):
+    self.results = []
+
+  def put_job_success_result(self, jobId, executionDetails, continuationToken=None):
+    self.results.append((jobId, 'success', continuationToken))
+
+  def put_job_failure_result(self, jobId, failureDetails):
+    self.results.append((jobId, 'failure', failureDetails['message']))
+
+
+class FakeSageMaker(object):
+
+  def __init__(self, jobs):
+    self.jobs = jobs
+    self.described = []
+
+  def describe_training_job(self, TrainingJobName):
+    self.described.append(TrainingJobName)
+    return self.jobs[TrainingJobName]
+
+
+@pytest.fixture
+def pipeline(monkeypatch):
+  code_pipeline = FakeCodePipeline()
+  monkeypatch.setattr(sageDispatch, 'code_pipeline', code_pipeline)
+  monkeypatch.setattr(sageDispatch, 'job_states', training_tracker.MemoryStore())
+  monkeypatch.setattr(sageDispatch, 'pipeline_waits', training_tracker.MemoryStore())
+  return code_pipeline
+
+
+def events():
+  with open(FIXTURES) as f:
+    return json.load(f)
+
+
+def pipeline_event(job_id, continuation_token=None):
+  data = {'inputArtifacts': []}
+  if continuation_token is not None:
+    data['continuationToken'] = continuation_token
+  return {'CodePipeline.job': {'id': job_id, 'data': data}}
+
+
+def test_dispatch_hands_back_a_continuation_token(monkeypatch, pipeline):
+  monkeypatch.setattr(sageDispatch, 'get_manifest_dictionary', lambda artifacts: {'WaitForTraining': True})
+  monkeypatch.setattr(sageDispatch, 'send_to_training', lambda manifest: [
+    {'TrainingJobArn': 'arn:' + name, 'TrainingJobName': name} for name in (WIDE, DEEP)])
+  sageDispatch.lambda_handler(pipeline_event('first'), None)
+  assert pipeline.results == [('first', 'success', json.dumps({'TrainingJobs': [WIDE, DEEP]}))]
+
+
+def test_continuation_is_completed_by_the_last_training_event(monkeypatch, pipeline):
+  first = dict((event['detail']['TrainingJobName'], event['detail']) for event in reversed(events()))
+  sagemaker = FakeSageMaker(first)
+  monkeypatch.setattr(sageDispatch, 'sagemaker', sagemaker)
+  sageDispatch.lambda_handler(pipeline_event('second', json.dumps({'TrainingJobs': [WIDE, DEEP]})), None)
+  assert sorted(sagemaker.described) == [DEEP, WIDE]
+  assert pipeline.results == []
+
+  for event in events():
+    sageDispatch.training_event_handler(event, None)
+  assert len(pipeline.results) == 1
+  job_id, outcome, message = pipeline.results[0]
+  assert (job_id, outcome) == ('second', 'failure')
+  assert DEEP in message
+
+
+def test_jobs_that_finished_before_the_wait_complete_it_straight_away(monkeypatch, pipeline):
+  finished = {}
+  for event in events():
+    if event['detail']['TrainingJobName'] == WIDE:
+      finished[WIDE] = event['detail']
+  monkeypatch.setattr(sageDispatch, 'sagemaker', FakeSageMaker(finished))
+  sageDispatch.lambda_handler(pipeline_event('second', json.dumps({'TrainingJobs': [WIDE]})), None)
+  assert [(job_id, outcome) for job_id, outcome, _ in pipeline.results] == [('second', 'success')]
@@ -0,0 +1,40 @@
+import threading
+import time
+
+
+# Classic token bucket used to keep bursts of api calls under a service's transactions per second limit. The bucket
+# starts full so the first `capacity` calls go straight through and after that callers are spaced out at `rate` calls a
+# second. It's shared between threads so acquire() blocks the caller until a token is free.
+class TokenBucket(object):
+
+  def __init__(self, rate, capacity=1, clock=time.time, sleep=time.sleep):
+    if rate <= 0:
+      raise ValueError('rate must be positive')
+    self.rate = float(rate)
+    self.capacity = float(capacity)
+    self.clock = clock
+    self.sleep = sleep
+    self.waited = 0.0
+    self._tokens = self.capacity
+    self._updated = clock()
+    self._lock = threading.Lock()
+
+  def _refill(self):
+    now = self.clock()
+    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+    self._updated = now
+
+  # Takes a token, sleeping until one is available. Returns False without taking anything if that would mean waiting
+  # longer than timeout seconds.
+  def acquire(self, timeout=None):
+    with self._lock:
+      self._refill()
+      wait = max(0.0, (1 - self._tokens) / self.rate)
+      if timeout is not None and wait > timeout:
+        return False
+      # The token is claimed before sleeping so other threads queue up behind this one rather than racing for it.
+      self._tokens -= 1
+      self.waited += wait
+    if wait:
+      self.sleep(wait)
+    return True
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import s3_urls
+
+# Statuses of a previously dispatched job that mean there's no point training the same thing again: it finished and
+# its model artifacts are there to reuse. A job that is still running has no artifacts yet and may still fail, so it's
+# only reused by a dispatch that waits for its jobs to finish (WaitForTraining) and so fails if it does.
+REUSABLE_STATUSES = ('Completed',)
+WAITABLE_STATUSES = ('InProgress',)
+
+
+# Everything that decides what a training job produces: the exact container (by digest, not tag, so a rebuild of the
+# same commit with a different base image doesn't match), the hyperparameters, the versions of the data and the
+# hardware it runs on.
+def training_key(image_digest, hyperparameters, data_versions, resource_config):
+  identity = {
+    'image_digest': image_digest,
+    'hyperparameters': hyperparameters,
+    'data_versions': data_versions,
+    'resource_config': resource_config
+  }
+  return hashlib.sha256(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Content addressed index of dispatched training jobs kept as one small json object per key under an s3 prefix. One
+# object per key means concurrent dispatches never have to read-modify-write a shared file.
+class TrainingIndex(object):
+
+  def __init__(self, s3_client, url, clock=time.time):
+    self.s3_client = s3_client
+    self.bucket, self.prefix = s3_urls.split_s3_url(url)
+    self.clock = clock
+
+  def _key(self, key):
+    return self.prefix + key + '.json'
+
+  def get(self, key):
+    try:
+      response = self.s3_client.get_object(Bucket=self.bucket, Key=self._key(key))
+    except ClientError as e:
+      if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+        return None
+      raise
+    return json.loads(response['Body'].read())
+
+  def put(self, key, entry):
+    entry = dict(entry, Created=self.clock())
+    self.s3_client.put_object(Bucket=self.bucket, Key=self._key(key), Body=json.dumps(entry).encode('utf-8'),
+                              ContentType='application/json')
+
+
+# Stands in for a TrainingIndex at module level, like aws_retry.LazyClient does for clients: the url isn't looked up
+# (nor the index built) until the index is first used, so importing a lambda doesn't need its configuration.
+class LazyIndex(object):
+
+  def __init__(self, s3_client, url):
+    self._s3_client = s3_client
+    self._url = url
+    self._index = None
+    self._lock = threading.Lock()
+
+  def _get(self):
+    if self._index is None:
+      with self._lock:
+        if self._index is None:
+          self._index = TrainingIndex(self._s3_client, self._url())
+    return self._index
+
+  def __getattr__(self, name):
+    return getattr(self._get(), name)
+
+  def __repr__(self):
+    if self._index is None:
+      return '<LazyIndex (not built)>'
+    return '<LazyIndex s3://%s/%s>' % (self._index.bucket, self._index.prefix)
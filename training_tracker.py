@@ -0,0 +1,176 @@
+import argparse
+import datetime
+import json
+
+# Follows training jobs through SageMaker's Training Job State Change events instead of polling describe_training_job.
+# Every event carries the job's whole secondary status timeline, so each one is boiled down to a small record (statuses,
+# timestamps in epoch seconds and the time spent in each phase) and stored over the previous one, one json object per
+# job. sageDispatch's trainingEvents function does this for every job, and a pipeline that asked to wait for training
+# leaves a note per job saying which CodePipeline job to complete once they've all finished.
+#
+#   python training_tracker.py replay training_events.json    # recorded events through an in-memory store
+#
+# The phases are how long a job spent waiting for instances (counted from its creation, so spot waits and
+# interruptions land here too), downloading the image and the data, training and uploading the model.
+
+TERMINAL_STATUSES = ('Completed', 'Failed', 'Stopped')
+
+PHASES = ('queue', 'download', 'training', 'upload')
+PHASE_OF_STATUS = {
+  'Starting': 'queue',
+  'Pending': 'queue',
+  'LaunchingMLInstances': 'queue',
+  'PreparingTrainingStack': 'queue',
+  'Interrupted': 'queue',
+  'Restarting': 'queue',
+  'Downloading': 'download',
+  'DownloadingTrainingImage': 'download',
+  'Training': 'training',
+  'Uploading': 'upload'
+}
+
+
+# Events have epoch milliseconds, describe_training_job has datetimes and recorded json has iso strings.
+def _epoch(value):
+  if value is None:
+    return None
+  if isinstance(value, (int, float)):
+    return value / 1000.0
+  if isinstance(value, str):
+    value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+  if value.tzinfo is None:
+    value = value.replace(tzinfo=datetime.timezone.utc)
+  return value.timestamp()
+
+
+# The time spent in each phase so far. Transitions that haven't ended yet aren't counted.
+def latencies(record):
+  spent = dict((phase, 0.0) for phase in PHASES)
+  transitions = record['Transitions']
+  if transitions and record.get('CreationTime') is not None:
+    spent['queue'] += max(0.0, transitions[0][1] - record['CreationTime'])
+  for status, start, end in transitions:
+    if status in PHASE_OF_STATUS and end is not None:
+      spent[PHASE_OF_STATUS[status]] += end - start
+  return dict((phase, round(seconds, 1)) for phase, seconds in spent.items())
+
+
+# A compact record of a job from an event's detail or a describe_training_job response.
+def job_state(job):
+  record = {
+    'TrainingJobName': job['TrainingJobName'],
+    'TrainingJobStatus': job['TrainingJobStatus'],
+    'SecondaryStatus': job.get('SecondaryStatus'),
+    'CreationTime': _epoch(job.get('CreationTime')),
+    'LastModifiedTime': _epoch(job.get('LastModifiedTime')),
+    'TrainingEndTime': _epoch(job.get('TrainingEndTime')),
+    'Transitions': [[t['Status'], _epoch(t['StartTime']), _epoch(t.get('EndTime'))]
+                    for t in job.get('SecondaryStatusTransitions', [])]
+  }
+  if job.get('FailureReason'):
+    record['FailureReason'] = job['FailureReason']
+  record['Latencies'] = latencies(record)
+  if record['TrainingEndTime'] is not None and record['CreationTime'] is not None:
+    record['Latencies']['total'] = round(record['TrainingEndTime'] - record['CreationTime'], 1)
+  return record
+
+
+def is_finished(record):
+  return record is not None and record['TrainingJobStatus'] in TERMINAL_STATUSES and not record.get('ResumedAs')
+
+
+# Stores the state of a job from an event and returns it. EventBridge doesn't promise to deliver in order, so an event
+# older than the stored record is dropped and None returned.
+def track(states, job):
+  record = job_state(job)
+  previous = states.get(record['TrainingJobName'])
+  if previous is not None and (previous.get('LastModifiedTime') or 0) > (record['LastModifiedTime'] or 0):
+    return None
+  if previous is not None and previous.get('ResumedAs'):
+    record['ResumedAs'] = previous['ResumedAs']
+  states.put(record['TrainingJobName'], record)
+  return record
+
+
+# The record of the job that carries on where name left off, following spot relaunches. Each relaunch also gets the
+# note of the pipeline waiting on the original job so its own events find it.
+def latest_state(states, waits, name, wait=None):
+  record = states.get(name)
+  while record is not None and record.get('ResumedAs'):
+    if wait is not None:
+      waits.put(record['ResumedAs'], wait)
+    record = states.get(record['ResumedAs'])
+  return record
+
+
+# Leaves a note on every job of a pipeline that waits for them, pipeline_job being the id of the CodePipeline job to
+# complete. The note is written before the states are read and events write the state before reading the note, so
+# whichever comes last sees both and the pipeline job is completed at least once.
+def wait_for(waits, pipeline_job, names):
+  wait = {'PipelineJobId': pipeline_job, 'TrainingJobs': list(names)}
+  for name in names:
+    waits.put(name, wait)
+  return wait
+
+
+# None while any of the jobs a pipeline waits on is still going, otherwise whether they all completed and their records.
+def wait_outcome(states, waits, wait):
+  records = [latest_state(states, waits, name, wait) for name in wait['TrainingJobs']]
+  if not all(is_finished(record) for record in records):
+    return None
+  return all(record['TrainingJobStatus'] == 'Completed' for record in records), records
+
+
+def summarize(records):
+  return '; '.join('%s %s %s%s' % (
+    record['TrainingJobName'], record['TrainingJobStatus'],
+    ' '.join('%s=%ss' % (phase, record['Latencies'][phase]) for phase in PHASES + ('total',)
+             if phase in record['Latencies']),
+    (' (%s)' % record['FailureReason']) if record.get('FailureReason') else '') for record in records)
+
+
+class MemoryStore(object):
+
+  def __init__(self):
+    self.entries = {}
+
+  def get(self, key):
+    return self.entries.get(key)
+
+  def put(self, key, entry):
+    self.entries[key] = entry
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Replay recorded SageMaker Training Job State Change events.')
+  commands = parser.add_subparsers(dest='command')
+  commands.required = True
+  replay = commands.add_parser('replay', help='track recorded events and print the resulting job records')
+  replay.add_argument('events', nargs='+', help='json files of one event or a list of them')
+  replay.add_argument('--wait', action='store_true', help='also wait on all the jobs as one pipeline job would')
+  args = parser.parse_args()
+
+  events = []
+  for path in args.events:
+    with open(path) as f:
+      data = json.load(f)
+    events.extend(data if isinstance(data, list) else [data])
+  states, waits = MemoryStore(), MemoryStore()
+  if args.wait:
+    wait_for(waits, 'replay', sorted(set(event['detail']['TrainingJobName'] for event in events)))
+  for event in events:
+    record = track(states, event['detail'])
+    if record is None:
+      print(json.dumps({'job': event['detail']['TrainingJobName'], 'stale': True}))
+      continue
+    outcome = None
+    if args.wait and is_finished(record):
+      outcome = wait_outcome(states, waits, waits.get(record['TrainingJobName']))
+    print(json.dumps({'job': record['TrainingJobName'], 'status': record['TrainingJobStatus'],
+                      'secondary_status': record['SecondaryStatus'], 'pipeline': outcome and outcome[0]}))
+  for name in sorted(states.entries):
+    print(json.dumps(states.entries[name], sort_keys=True))
+
+
+if __name__ == '__main__':
+  main()